@@ -6,11 +6,16 @@ app = marimo.App(width="medium")
 
 @app.cell
 def _():
+    import pathlib
+    import sys
+
     import matplotlib.pyplot as plt
     import seaborn as sns
     from safe_result import Err, Ok
 
-    import src.raxtax as rx
+    # The modules of src/ import each other by name (`import utils`), like in the tests. Run from the repository root.
+    sys.path.insert(0, str(pathlib.Path("src").resolve()))
+    import raxtax as rx
 
     sns.set_theme()
     plt.rcParams["figure.dpi"] = 300
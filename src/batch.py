@@ -0,0 +1,151 @@
+import asyncio
+import dataclasses
+import glob
+import os
+import shutil
+from pathlib import Path
+from time import time
+
+import aiofiles as aiof
+import polars as pl
+from clypi import cprint
+from safe_result import Err, Ok
+
+import registry
+from pipeline import PipelineOptions, run_pipeline
+from telemetry import Telemetry
+
+FASTQ_SUFFIXES = (".fastq", ".fq", ".fastq.gz", ".fq.gz")
+
+
+@dataclasses.dataclass
+class Sample:
+    name: str
+    filepath: Path
+
+
+def _is_fastq(filepath: Path) -> bool:
+    return filepath.name.endswith(FASTQ_SUFFIXES) and "reference" not in filepath.name
+
+
+def _from_manifest(manifest_fp: Path) -> list[Path]:
+    """Reads the fastq filepaths of a manifest csv, `data.csv` (see `utils.load_data_df`) is one."""
+    df = pl.read_csv(manifest_fp)
+    if "filepath" not in df.columns:
+        raise ValueError(f"Manifest `{manifest_fp}` has no `filepath` column.")
+    if "reference" in df.columns:
+        df = df.filter(~pl.col("reference"))
+    return [Path(fp) for fp in df.get_column("filepath").to_list()]
+
+
+def collect_samples(inputs: list[str]) -> list[Sample]:
+    """Resolves directories, glob patterns, manifests and fastq filepaths into a list of samples.
+
+    Directories are searched recursively and reference files are skipped. Samples are named after their fastq
+    file, duplicated names get a numbered suffix so every sample keeps its own result file.
+
+    Args:
+        inputs (list[str]): The directories, glob patterns, manifest csv files or fastq files.
+
+    Returns:
+        list[Sample]: The samples, in the order they were found.
+    """
+    filepaths: list[Path] = []
+    for input in inputs:
+        path = Path(input)
+        if path.is_dir():
+            filepaths.extend(sorted(fp for fp in path.rglob("*") if fp.is_file() and _is_fastq(fp)))
+        elif path.is_file() and path.suffix == ".csv":
+            filepaths.extend(fp for fp in _from_manifest(path) if _is_fastq(fp))
+        elif path.is_file():
+            filepaths.append(path)
+        else:
+            filepaths.extend(sorted(Path(fp) for fp in glob.glob(input, recursive=True) if _is_fastq(Path(fp))))
+
+    samples: list[Sample] = []
+    names: dict[str, int] = {}
+    for filepath in dict.fromkeys(fp.resolve() for fp in filepaths):
+        name = filepath.name.split(".")[0]
+        names[name] = names.get(name, 0) + 1
+        samples.append(Sample(name if names[name] == 1 else f"{name}_{names[name]}", filepath))
+
+    return samples
+
+
+def select_samples(
+    samples: list[Sample],
+    marker: str | None = None,
+    species: str | None = None,
+    min_reads: int = 0,
+    max_reads: int = 0,
+    registry_fp: Path = registry.DEFAULT_REGISTRY_FP,
+) -> list[Sample]:
+    """Keeps the samples of a marker, a species or a number of reads, as recorded in the sample registry.
+
+    The samples are added to the registry first, only the new or modified files are read.
+    """
+    df = registry.update_registry([sample.filepath for sample in samples], registry_fp)
+    selected = set(registry.select_samples(df, marker, species, min_reads, max_reads).get_column("filepath"))
+    return [sample for sample in samples if str(sample.filepath) in selected]
+
+
+async def _run_sample(sample: Sample, output_dir: Path, options: PipelineOptions, telemetry: Telemetry) -> dict:
+    """Runs the pipeline on a single sample and writes its results, never raises."""
+    _start = time()
+    summary: dict = {"sample": sample.name, "filepath": str(sample.filepath)}
+
+    async with aiof.tempfile.TemporaryDirectory(prefix=f"myrio_{sample.name}_") as tmp:
+        result = await run_pipeline(sample.filepath, Path(tmp), options, telemetry=telemetry, sample=sample.name)
+        if options.qc and Path(tmp, "qc").is_dir():
+            shutil.copytree(Path(tmp, "qc"), Path(output_dir, sample.name, "qc"), dirs_exist_ok=True)
+
+    match result:
+        case Ok(raxtax):
+            sample_dir = Path(output_dir, sample.name)
+            os.makedirs(sample_dir, exist_ok=True)
+            raxtax.df.write_csv(Path(sample_dir, "results.csv"))
+            summary["status"] = "ok"
+            if not raxtax.df.is_empty():
+                summary.update(raxtax.df.row(0, named=True))
+        case Err(error):
+            summary["status"] = "failed"
+            summary["error"] = str(error).strip().splitlines()[0] if str(error).strip() else type(error).__name__
+
+    summary["seconds"] = round(time() - _start, 3)
+    return summary
+
+
+async def run_batch(
+    samples: list[Sample],
+    output_dir: Path,
+    options: PipelineOptions,
+    jobs: int = 2,
+    telemetry: Telemetry | None = None,
+) -> pl.DataFrame:
+    """Runs the pipeline over many samples, at most `jobs` of them at once.
+
+    Every sample gets its own temporary directory and its own `<output_dir>/<sample>/results.csv` (and `qc/` with
+    `options.qc`), the best raxtax match of every sample is gathered in `<output_dir>/summary.csv`. The stage metrics
+    of every sample are recorded by `telemetry` when provided.
+
+    Returns:
+        pl.DataFrame: The summary, one row per sample in the order of `samples`.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    telemetry = telemetry or Telemetry()
+    semaphore = asyncio.Semaphore(max(jobs, 1))
+    # The consensus workers of the concurrent samples share the cores
+    options = dataclasses.replace(options, threads=max(options.threads // max(jobs, 1), 1))
+
+    async def bounded(sample: Sample) -> dict:
+        async with semaphore:
+            summary = await _run_sample(sample, output_dir, options, telemetry)
+        color = "green" if summary["status"] == "ok" else "red"
+        cprint(f"{summary['status']:>6}", fg=color, bold=True, end=f"  {sample.name} → {summary['seconds']:.3f} s\n")
+        return summary
+
+    summaries = await asyncio.gather(*[bounded(sample) for sample in samples])
+
+    df = pl.DataFrame(summaries, infer_schema_length=None)
+    df.write_csv(Path(output_dir, "summary.csv"))
+    return df
@@ -0,0 +1,220 @@
+import asyncio as aio
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+from functools import cache
+from importlib import metadata
+from pathlib import Path
+from typing import Any
+
+import utils
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("MYRIO_CACHE_DIR", str(Path(Path.home(), ".cache", "myrio"))))
+DEFAULT_CACHE_SIZE = int(os.environ.get("MYRIO_CACHE_SIZE", str(20 * 1024**3)))  # bytes
+
+_META_FILE = "meta.json"
+_HASH_INDEX_FILE = "hashes.json"
+
+_tool_versions: dict[str, str] = {}
+
+
+async def tool_version(tool: str) -> str:
+    """Returns the version of an external tool (`<tool> --version`, `-version` for BLAST+) or python package, memoized
+    per process.
+    """
+    if tool in _tool_versions:
+        return _tool_versions[tool]
+
+    try:
+        version = metadata.version(tool)
+    except metadata.PackageNotFoundError:
+        version = "unknown"
+        for flag in ("--version", "-version"):
+            try:
+                proc = await aio.create_subprocess_exec(
+                    tool, flag, stdout=aio.subprocess.PIPE, stderr=aio.subprocess.STDOUT
+                )
+                stdout, _ = await proc.communicate()
+            except FileNotFoundError:
+                version = "missing"
+                break
+            lines = stdout.decode(encoding="utf-8", errors="ignore").strip().splitlines()
+            if proc.returncode == 0 and lines:
+                version = lines[0]
+                break
+
+    _tool_versions[tool] = version
+    return version
+
+
+@cache
+def source_digest() -> str:
+    """A digest of the pipeline sources (the modules next to this one), so that a code change invalidates the cache.
+
+    The package version alone isn't bumped on every change of a stage.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for source_fp in sorted(Path(__file__).parent.glob("*.py")):
+        digest.update(source_fp.name.encode())
+        digest.update(source_fp.read_bytes())
+    return digest.hexdigest()
+
+
+def _dir_size(path: Path) -> int:
+    return sum(Path(root, file).stat().st_size for root, _, files in path.walk() for file in files)
+
+
+def _link_or_copy(src: Path, dst: Path):
+    os.makedirs(dst.parent, exist_ok=True)
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class StageCache:
+    """An on-disk cache of pipeline stage artifacts, keyed by a hash of the stage inputs, parameters and tools.
+
+    Every entry is a directory holding the artifacts (relative to the stage working directory) and a `meta.json`.
+    Entries are hard-linked in and out when possible, and the least recently used ones are evicted once the cache
+    grows over `max_bytes`.
+    """
+
+    def __init__(self, root: Path = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_CACHE_SIZE, enabled: bool = True):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._hashes: dict[str, list] | None = None
+        self._size: int | None = None  # bytes in the cache, as far as this process knows
+        self._lock = threading.Lock()
+
+    def _hash_index(self) -> dict[str, list]:
+        if self._hashes is None:
+            try:
+                with open(Path(self.root, _HASH_INDEX_FILE), "r") as file:
+                    self._hashes = json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                self._hashes = {}
+        return self._hashes
+
+    def file_hash(self, filepath: Path) -> str:
+        """Hashes the content of a file, reusing the previous hash while its size and mtime are unchanged."""
+        filepath = Path(filepath).resolve()
+        stat = filepath.stat()
+        with self._lock:
+            match self._hash_index().get(str(filepath)):
+                case [size, mtime, digest] if size == stat.st_size and mtime == stat.st_mtime_ns:
+                    return digest
+
+        digest = utils.file_digest(filepath)
+        with self._lock:
+            index = self._hash_index()
+            index[str(filepath)] = [stat.st_size, stat.st_mtime_ns, digest]
+            os.makedirs(self.root, exist_ok=True)
+            tmp_fp = Path(self.root, f".{_HASH_INDEX_FILE}.{uuid.uuid4().hex}")
+            with open(tmp_fp, "w") as file:
+                json.dump(index, file)
+            os.replace(tmp_fp, Path(self.root, _HASH_INDEX_FILE))
+        return digest
+
+    async def key(self, stage: str, inputs: list[Path | str], params: dict[str, Any], tools: list[str]) -> str:
+        """Computes the cache key of a stage run.
+
+        Args:
+            stage (str): The stage name.
+            inputs (list[Path | str]): The files the stage reads, their content is hashed. Intermediate files are
+                better identified by the key of the stage that produced them (a `str`), which avoids hashing them.
+            params (dict[str, Any]): The (json serializable) parameters of the stage.
+            tools (list[str]): The external tools or python packages the stage relies on.
+
+        Returns:
+            str: The key, empty if the cache is disabled.
+        """
+        if not self.enabled:
+            return ""
+
+        digests = await aio.to_thread(lambda: [fp if isinstance(fp, str) else self.file_hash(fp) for fp in inputs])
+        versions = {tool: await tool_version(tool) for tool in ["myrio", *tools]}
+        payload = json.dumps(
+            {"inputs": digests, "params": params, "tools": versions, "code": source_digest()},
+            sort_keys=True,
+            default=str,
+        )
+        return f"{stage}-{hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()}"
+
+    def contains(self, key: str) -> bool:
+        """Whether a stage run is cached, without restoring it."""
+        return self.enabled and bool(key) and Path(self.root, key, _META_FILE).is_file()
+
+    def restore(self, key: str, work_dir: Path) -> dict[str, Any] | None:
+        """Links the artifacts of a cached stage run into `work_dir`.
+
+        Returns:
+            The metadata stored with the artifacts, or None on a cache miss.
+        """
+        entry = Path(self.root, key)
+        if not self.contains(key):
+            return None
+
+        with open(Path(entry, _META_FILE), "r") as file:
+            meta = json.load(file)
+        for relative in meta["artifacts"]:
+            _link_or_copy(Path(entry, relative), Path(work_dir, relative))
+
+        os.utime(entry)  # marks the entry as recently used
+        return meta["meta"]
+
+    def store(self, key: str, work_dir: Path, artifacts: list[Path], meta: dict[str, Any] | None = None):
+        """Stores the artifacts (relative to `work_dir`) of a stage run, then evicts old entries if needed."""
+        if not self.enabled or not key:
+            return
+
+        tmp_entry = Path(self.root, f".{key}.{uuid.uuid4().hex}")
+        relatives = [str(Path(artifact).relative_to(work_dir)) for artifact in artifacts]
+        os.makedirs(tmp_entry, exist_ok=True)  # a stage may have no artifact at all, e.g. no cluster found
+        for relative in relatives:
+            _link_or_copy(Path(work_dir, relative), Path(tmp_entry, relative))
+        with open(Path(tmp_entry, _META_FILE), "w") as file:
+            json.dump({"artifacts": relatives, "meta": meta or {}}, file)
+
+        with self._lock:
+            if self._size is None:  # the cache is only walked once per process, then on eviction
+                self._size = self._cached_size()
+        entry = Path(self.root, key)
+        size = _dir_size(tmp_entry)
+        shutil.rmtree(entry, ignore_errors=True)
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # Another run stored the same key in the meantime, its artifacts are just as good
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        with self._lock:
+            self._size = (self._size or 0) + size
+            over = self._size > self.max_bytes
+        if over:
+            self.evict()
+
+    def _cached_size(self) -> int:
+        return sum(_dir_size(entry) for entry in self._entries())
+
+    def _entries(self) -> list[Path]:
+        return [entry for entry in self.root.iterdir() if entry.is_dir() and not entry.name.startswith(".")]
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in `max_bytes`."""
+        entries = self._entries()
+        sizes = {entry: _dir_size(entry) for entry in entries}
+        total = sum(sizes.values())
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
+        with self._lock:
+            self._size = total
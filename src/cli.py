@@ -1,19 +1,24 @@
 import asyncio
-from concurrent.futures import ProcessPoolExecutor
+import os
+import shutil
 from pathlib import Path
 from time import time
+from typing import TYPE_CHECKING, Literal
 
 import aiofiles as aiof
-from clypi import Command, Positional, Spinner, boxed, cprint
+from clypi import Command, Positional, Spinner, arg, boxed, cprint
 from clypi._components.spinners import _PerLineIO
-from safe_result import Err, Ok, ok, safe_async
+from safe_result import Err, Ok, safe_async
 from typing_extensions import override
 
-from consensus import spoa_consensus
-from preprocessing import preprocessing
-from raxtax import Raxtax
-from selection import run_isONclust3
-from utils import check_filepath
+from paths import DEFAULT_MANIFEST_FP, DEFAULT_REGISTRY_FP
+
+# The pipeline modules (and numpy, polars, spoa, ...) are only imported by the commands running them, so that
+# `--help` and the input checks answer right away. `test_cli.py` keeps an eye on the import time.
+if TYPE_CHECKING:
+    from pipeline import PipelineOptions
+    from telemetry import Telemetry
+    from watch import WatchRound
 
 
 # Monkey-wrench a fix for clypi
@@ -26,159 +31,516 @@ def safe_flush(self):
 _PerLineIO.flush = safe_flush
 
 
-class Cli(Command):
-    filepath: Positional[str]
+def _spinner(title: str) -> Spinner:
+    return Spinner(title, capture=False)
+
+
+def _pipeline_options(cmd: "Cli | Batch | Watch | Serve") -> "PipelineOptions":
+    """The pipeline options shared by the single sample, batch, watch and serve commands."""
+    from cache import StageCache
+    from pipeline import PipelineOptions
+
+    return PipelineOptions(
+        Path(cmd.db),
+        cmd.threads,
+        qc=cmd.qc,
+        read_budget=cmd.read_budget,
+        saturation_step=cmd.saturation_step,
+        max_clusters=cmd.max_clusters,
+        min_cluster_support=cmd.min_support,
+        max_consensus_reads=cmd.max_consensus_reads,
+        blast_db=Path(cmd.blast_db) if cmd.blast_db else None,
+        blast_min_identity=cmd.blast_min_identity,
+        model_fp=Path(cmd.model) if cmd.model else None,
+        route_markers=not cmd.no_route,
+        primers_fp=Path(cmd.primers) if cmd.primers else None,
+        cache=StageCache(enabled=not cmd.no_cache),
+    )
+
+
+def _print_timings(telemetry: "Telemetry"):
+    import polars as pl
+
+    cprint("\n------  Stage Timings  ------\n", bold=True)
+    with pl.Config(tbl_rows=-1, tbl_cols=-1, tbl_width_chars=160, fmt_str_lengths=64, tbl_hide_dataframe_shape=True):
+        print(telemetry.summary())
+
+
+class Batch(Command):
+    """Runs the pipeline over many samples concurrently"""
+
+    inputs: Positional[list[str]] = arg(help="Directories, glob patterns, manifest csv files or fastq files")
+    jobs: int = arg(default=2, short="j", help="Maximum number of samples processed concurrently")
+    output: str = arg(default="output/batch", short="o", help="Directory for the per-sample results and summary")
+    marker: str = arg(default="", help="Only runs the samples of this marker (matK, rbcL, psbA-trnH or ITS)")
+    species: str = arg(default="", help="Only runs the samples whose name contains this species")
+    min_reads: int = arg(default=0, help="Only runs the samples with at least this many reads, 0 disables it")
+    max_reads: int = arg(default=0, help="Only runs the samples with at most this many reads, 0 disables it")
+    db: str = arg(inherited=True)
+    threads: int = arg(inherited=True)
+    no_cache: bool = arg(inherited=True)
+    no_route: bool = arg(inherited=True)
+    primers: str = arg(inherited=True)
+    read_budget: int = arg(inherited=True)
+    saturation_step: int = arg(inherited=True)
+    max_clusters: int = arg(inherited=True)
+    min_support: float = arg(inherited=True)
+    max_consensus_reads: int = arg(inherited=True)
+    blast_db: str = arg(inherited=True)
+    blast_min_identity: float = arg(inherited=True)
+    model: str = arg(inherited=True)
+    qc: bool = arg(inherited=True)
+    metrics: str = arg(inherited=True)
+    timings: bool = arg(inherited=True)
 
     @override
     async def run(self):
-        match await self._run():
-            case Ok(value):
-                pass
-            case Err(value):
-                cprint("Error", fg="red", bold=True, end=f": {value}\n")
+        from batch import collect_samples, run_batch, select_samples
+        from telemetry import Telemetry
 
-    @safe_async
-    async def _run(self) -> None:
+        samples = collect_samples(self.inputs)
+        if samples and (self.marker or self.species or self.min_reads or self.max_reads):
+            samples = select_samples(samples, self.marker, self.species, self.min_reads, self.max_reads)
+        if not samples:
+            cprint("Error", fg="red", bold=True, end=": No fastq file found in the provided inputs.\n")
+            return
+
+        cprint(f"\n------  Running {len(samples)} samples, {self.jobs} at a time  ------\n", bold=True)
+        options = _pipeline_options(self)
+        telemetry = Telemetry(Path(self.metrics) if self.metrics else None)
+        summary = await run_batch(samples, Path(self.output), options, jobs=self.jobs, telemetry=telemetry)
+
+        cprint(f"\n------  Batch Summary → saved to {Path(self.output, 'summary.csv')}  ------\n", bold=True)
+        columns = ["sample", "status", "species", "species_score", "seconds"]
+        print(summary.select([column for column in columns if column in summary.columns]))
+        if self.timings:
+            _print_timings(telemetry)
+
+
+class Watch(Command):
+    """Classifies the reads of a sequencing run as MinKNOW writes them, until the top species is stable"""
+
+    directory: Positional[str] = arg(help="The MinKNOW output directory, or one of its barcode directories")
+    output: str = arg(default="output/watch", short="o", help="Directory for the latest results and the rounds")
+    poll: float = arg(default=10.0, help="Seconds between two looks at the directory")
+    settle: float = arg(default=5.0, help="Seconds a fastq file must be left untouched before being read")
+    min_new_reads: int = arg(default=1000, help="New reads needed to classify again")
+    stable_rounds: int = arg(default=3, help="Rounds the top species must stay the same to be stable")
+    tolerance: float = arg(default=0.02, help="Variation of the top species_score allowed over these rounds")
+    until_stable: bool = arg(default=False, help="Stops watching as soon as the top species is stable")
+    db: str = arg(inherited=True)
+    threads: int = arg(inherited=True)
+    no_cache: bool = arg(inherited=True)
+    no_route: bool = arg(inherited=True)
+    primers: str = arg(inherited=True)
+    read_budget: int = arg(inherited=True)
+    saturation_step: int = arg(inherited=True)
+    max_clusters: int = arg(inherited=True)
+    min_support: float = arg(inherited=True)
+    max_consensus_reads: int = arg(inherited=True)
+    blast_db: str = arg(inherited=True)
+    blast_min_identity: float = arg(inherited=True)
+    model: str = arg(inherited=True)
+    qc: bool = arg(inherited=True)
+    metrics: str = arg(inherited=True)
+    timings: bool = arg(inherited=True)
+
+    @override
+    async def run(self):
+        if not Path(self.directory).is_dir():
+            cprint("Error", fg="red", bold=True, end=f": `{self.directory}` is not a directory.\n")
+            return
+
+        from telemetry import Telemetry
+        from watch import WatchRound, watch
+
+        cprint(f"\n------  Watching {self.directory}, stop with Ctrl+C  ------\n", bold=True)
+        stable = False
+
+        def report(watch_round: "WatchRound"):
+            nonlocal stable
+            match watch_round:
+                case WatchRound(status="failed"):
+                    cprint("failed", fg="red", bold=True, end="")
+                case WatchRound(stable=True):
+                    cprint("stable", fg="green", bold=True, end="")
+                case _:
+                    cprint("    ok", fg="yellow", bold=True, end="")
+            print(
+                f"  round {watch_round.round}: {watch_round.reads} filtered reads from {watch_round.files} files → "
+                f"{watch_round.species} ({watch_round.species_score}), {watch_round.seconds:.3f} s"
+            )
+            if watch_round.stable and not stable:
+                cprint(f"\nThe top species is stable, the run can be stopped: {watch_round.species}\n", bold=True)
+            stable = watch_round.stable
+
+        options = _pipeline_options(self)
+        telemetry = Telemetry(Path(self.metrics) if self.metrics else None)
+        async with aiof.tempfile.TemporaryDirectory(prefix="myrio_watch_") as tmp:
+            await watch(
+                Path(self.directory),
+                Path(tmp),
+                Path(self.output),
+                options,
+                poll_s=self.poll,
+                settle_s=self.settle,
+                min_new_reads=self.min_new_reads,
+                stable_rounds=self.stable_rounds,
+                tolerance=self.tolerance,
+                until_stable=self.until_stable,
+                on_round=report,
+                telemetry=telemetry,
+            )
+
+        cprint(f"\n------  Latest results → saved to {Path(self.output, 'results.csv')}  ------\n", bold=True)
+        if self.timings:
+            _print_timings(telemetry)
+
+
+class Serve(Command):
+    """Serves pipeline runs over a local HTTP API, keeping the databases and worker pool warm between samples
+
+    Submit a fastq path with `curl -N -d '{"filepath": "reads.fastq"}' -H 'Content-Type: application/json'
+    http://127.0.0.1:8765/run`, or upload it with `--data-binary @reads.fastq`. Stage progress and the results
+    stream back as JSON lines.
+    """
+
+    host: str = arg(default="127.0.0.1", help="Address to listen on, keep it local: the API has no authentication")
+    port: int = arg(default=8765, short="p", help="Port to listen on")
+    socket: str = arg(default="", help="Listens on this Unix socket instead of a TCP port")
+    jobs: int = arg(default=1, short="j", help="Maximum number of samples processed concurrently")
+    db: str = arg(inherited=True)
+    threads: int = arg(inherited=True)
+    no_cache: bool = arg(inherited=True)
+    no_route: bool = arg(inherited=True)
+    primers: str = arg(inherited=True)
+    read_budget: int = arg(inherited=True)
+    saturation_step: int = arg(inherited=True)
+    max_clusters: int = arg(inherited=True)
+    min_support: float = arg(inherited=True)
+    max_consensus_reads: int = arg(inherited=True)
+    blast_db: str = arg(inherited=True)
+    blast_min_identity: float = arg(inherited=True)
+    model: str = arg(inherited=True)
+    qc: bool = arg(inherited=True)
+
+    @override
+    async def run(self):
         _start = time()
-        async with Spinner("Initializing", capture=False) as spin:
-            await asyncio.sleep(1.0)
-            match check_filepath(self.filepath):
-                case True:
+        cprint("\nWarming up the databases and workers…", bold=True)
+        from server import serve
+
+        def ready(address: str):
+            cprint(
+                f"\n------  Serving on {address} after {time() - _start:.3f} s, stop with Ctrl+C  ------\n", bold=True
+            )
+
+        await serve(
+            _pipeline_options(self),
+            self.host,
+            self.port,
+            Path(self.socket) if self.socket else None,
+            self.jobs,
+            on_ready=ready,
+        )
+
+
+class Samples(Command):
+    """Indexes the sequencing files into the sample registry and lists them"""
+
+    inputs: Positional[list[str]] = arg(default_factory=lambda: ["data"], help="Directories of fastq and fasta files")
+    registry: str = arg(default=str(DEFAULT_REGISTRY_FP), help="The sample registry parquet filepath")
+    manifest: str = arg(
+        default=str(DEFAULT_MANIFEST_FP), help="Csv fixing the names and markers of some files, if it exists"
+    )
+    marker: str = arg(default="", help="Only lists the samples of this marker (matK, rbcL, psbA-trnH or ITS)")
+    species: str = arg(default="", help="Only lists the samples whose name contains this species")
+    min_reads: int = arg(default=0, help="Only lists the samples with at least this many reads, 0 disables it")
+    max_reads: int = arg(default=0, help="Only lists the samples with at most this many reads, 0 disables it")
+    references: bool = arg(default=False, help="Lists the reference sequences instead of the samples")
+
+    @override
+    async def run(self):
+        import polars as pl
+
+        import registry
+
+        _start = time()
+        filepaths = [fp for input in self.inputs for fp in registry.scan_directory(Path(input))]
+        async with Spinner(f"Indexing {len(filepaths)} files", capture=False) as spin:
+            df = await asyncio.to_thread(
+                registry.update_registry, filepaths, Path(self.registry), Path(self.manifest) if self.manifest else None
+            )
+            await spin.done(f"Indexing {len(filepaths)} files → {time() - _start:.3f} s")
+
+        df = registry.select_samples(df, self.marker, self.species, self.min_reads, self.max_reads, self.references)
+        cwd = str(Path.cwd()) + os.sep
+        with pl.Config(
+            tbl_rows=-1, tbl_cols=-1, tbl_width_chars=200, fmt_str_lengths=100, tbl_hide_dataframe_shape=True
+        ):
+            print(
+                df.select(
+                    "name",
+                    *registry.MARKER_PATTERNS,
+                    "reads",
+                    "n50",
+                    pl.col("mean_quality").round(1),
+                    pl.col("filepath").str.strip_prefix(cwd),
+                )
+            )
+
+
+class Build(Command):
+    """Builds the per-marker reference fasta databases from a BOLD data package tsv"""
+
+    tsv: Positional[str] = arg(help="The BOLD tsv filepath")
+    output: str = arg(default="./database", short="o", help="Directory for the reference fastas")
+    prefix: str = arg(default="Magnoliopsida", help="Prefix of the fasta names, usually the taxon")
+    dereplicate: bool = arg(default=False, help="Removes the exact duplicates (same lineage and sequence)")
+    near_identity: float = arg(
+        default=0.0, help="Also collapses the sequences of a species at least this identical (e.g. 0.99), 0 disables"
+    )
+    compile: bool = arg(default=False, help="Compiles the fastas into raxtax's binary format afterwards")
+
+    @override
+    async def run(self):
+        from database import build_databases
+
+        _start = time()
+        async with Spinner(f"Building databases from {self.tsv}", capture=False) as spin:
+            match await asyncio.to_thread(
+                build_databases,
+                Path(self.tsv),
+                Path(self.output),
+                self.prefix,
+                dereplicate=self.dereplicate,
+                near_identity=self.near_identity or None,
+            ):
+                case Ok(counts):
                     _diff = time() - _start
-                    await spin.done(f"Initializing → {_diff:.3f} s")
-                case False:
+                    await spin.done(f"Building databases from {self.tsv} → {_diff:.3f} s")
+                case Err(error):
                     await spin.fail()
-                    raise RuntimeError("Filepath does not point to an existing file.")
+                    cprint("Error", fg="red", bold=True, end=f": {error}\n")
+                    return
 
-        async with aiof.tempfile.TemporaryDirectory(prefix="myrio_") as tmp:
-            tmp = Path(tmp)
-            _start = time()
-            async with Spinner("Pre-processing reads", capture=False) as spin:
-                input_fp = Path(self.filepath)
-                filtered_reads_fp = Path(tmp, "reads.fastq")
-                result = await preprocessing(input_fp, filtered_reads_fp)
-                if not ok(result):
-                    await spin.fail()
-                    result.unwrap()
-                _diff = time() - _start
-                await spin.done(f"Pre-processing reads → {_diff:.3f} s")
+        for fasta_fp, stats in counts.items():
+            removed = f", removed {stats.duplicates} duplicates and {stats.near_duplicates} near-duplicates"
+            print(f"  {fasta_fp}: {stats.records} records{removed if self.dereplicate or self.near_identity else ''}")
+        if self.compile:
+            await Compile(databases=[str(fasta_fp) for fasta_fp in counts]).run()
 
-            _start = time()
-            cluster_fps: list[Path] = []
-            async with Spinner("Clustering reads", capture=False) as spin:
-                input_fp = Path(tmp, "reads.fastq")
-                result = await run_isONclust3(input_fp, tmp)
-                match result:
-                    case Ok(fps):
-                        cluster_fps.extend(fps)
-                        _diff = time() - _start
-                        await spin.done(msg=f"Clustering reads → {_diff:.3f} s, got {len(fps)} clusters")
-                    case Err(error):
-                        await spin.fail()
-                        raise error
 
+class Compile(Command):
+    """Compiles reference fasta databases into raxtax's binary format"""
+
+    databases: Positional[list[str]] = arg(help="The reference fasta filepaths")
+
+    @override
+    async def run(self):
+        from database import compile_database
+
+        for database in self.databases:
             _start = time()
-            async with Spinner("Generating consensus", capture=False) as spin:
-                output_fp = Path(tmp, "consensus.fasta")
-                executor = ProcessPoolExecutor(
-                    max_workers=1
-                )  # This allows us to run spoa_consensus fully outside the main Python process, so our spinner doesn't freeze.
-                loop = asyncio.get_running_loop()
-                result = await loop.run_in_executor(executor, spoa_consensus, cluster_fps)
-                match result:
-                    case Ok(sequences):
-                        string = "\n".join([f">{id}\n{seq}" for (id, seq) in sequences])
-                        async with aiof.open(output_fp, "w") as file:
-                            _ = await file.write(string)
+            async with Spinner(f"Compiling {database}", capture=False) as spin:
+                match await compile_database(Path(database)):
+                    case Ok(manifest):
                         _diff = time() - _start
-                        await spin.done(f"Generating consensus → {_diff:.3f} s")
+                        await spin.done(f"Compiling {database} → {_diff:.3f} s, {manifest.records} records")
                     case Err(error):
                         await spin.fail()
-                        raise error
+                        cprint("Error", fg="red", bold=True, end=f": {error}\n")
+
+
+class Info(Command):
+    """Shows whether reference databases are compiled and up to date"""
+
+    databases: Positional[list[str]] = arg(help="The reference fasta filepaths")
+
+    @override
+    async def run(self):
+        from database import database_info
+
+        for database in self.databases:
+            print(database_info(Path(database)))
+
+
+class Db(Command):
+    """Manages the raxtax reference databases"""
 
-            """ TODO
-            async with Spinner("Assessing quality", capture=False) as spin:
-                await asyncio.sleep(1.0)
-                await spin.done()
-            """
+    subcommand: Build | Compile | Info
 
+
+class Train(Command):
+    """Trains the XGBoost k-mer classifier (see --model) out of core, from parquet shards of k-mer features
+
+    Reference fastas given as inputs are first written as shards to --shards, the shards are then streamed from
+    disk so the features never have to fit in memory.
+    """
+
+    inputs: Positional[list[str]] = arg(help="Parquet shards, directories of shards or reference fasta filepaths")
+    output: str = arg(default="models/species.ubj", short="o", help="The model filepath, checkpointed while training")
+    shards: str = arg(default="database/shards", help="Directory for the shards of the fasta inputs")
+    rank: Literal["species", "genus"] = arg(default="species", help="The rank to predict")
+    rounds: int = arg(default=100, help="Number of boosting rounds")
+    max_depth: int = arg(default=6, help="Maximum depth of the trees")
+    learning_rate: float = arg(default=0.3, help="The learning rate (eta)")
+    batch_rows: int = arg(default=100_000, help="Rows streamed from the shards at once")
+    checkpoint_every: int = arg(default=10, help="Saves the model every this many rounds, 0 only at the end")
+    resume: bool = arg(default=False, help="Continues training the --output model up to --rounds")
+    threads: int = arg(default=os.cpu_count() or 1, short="t", help="Number of threads used for training")
+
+    @override
+    async def run(self):
+        from model import FASTA_SUFFIXES, shard_filepaths, train_model, write_kmer_shards
+
+        fasta_fps = [Path(input) for input in self.inputs if input.endswith(FASTA_SUFFIXES)]
+        shard_fps = shard_filepaths(Path(input) for input in self.inputs if not input.endswith(FASTA_SUFFIXES))
+        for fasta_fp in fasta_fps:
             _start = time()
-            async with Spinner("Running raxtax", capture=False) as spin:
-                input_fp = Path(tmp, "consensus.fasta")
-                result = await Raxtax.build(input_fp, Path("./database/Magnoliopsida_raxdb.fasta"), tmp)
-                match result:
-                    case Ok(val):
-                        raxtax = val
-                        _diff = time() - _start
-                        await spin.done(f"Running raxtax → {_diff:.3f} s")
-                    case Err(error):
-                        await spin.fail()
-                        raise error
+            async with Spinner(f"Featurizing {fasta_fp}", capture=False) as spin:
+                fps = await asyncio.to_thread(write_kmer_shards, fasta_fp, Path(self.shards))
+                await spin.done(f"Featurizing {fasta_fp} → {time() - _start:.3f} s, {len(fps)} shards")
+            shard_fps.extend(fps)
+
+        def report(boosted: int, rows_per_s: float):
+            print(f"  round {boosted}/{self.rounds}: {rows_per_s:,.0f} rows/s")
+
+        cprint(f"\n------  Training on {len(shard_fps)} shards  ------\n", bold=True)
+        result = await asyncio.to_thread(
+            train_model,
+            shard_fps,
+            Path(self.output),
+            self.rank,
+            rounds=self.rounds,
+            max_depth=self.max_depth,
+            learning_rate=self.learning_rate,
+            threads=self.threads,
+            batch_rows=self.batch_rows,
+            checkpoint_every=self.checkpoint_every,
+            resume=self.resume,
+            on_round=report,
+        )
+        match result:
+            case Ok(stats):
+                print(
+                    f"\n  {stats.rows} rows, {stats.classes} classes, {stats.rounds} rounds: sketched in "
+                    f"{stats.sketch_s:.3f} s, trained in {stats.train_s:.3f} s ({stats.rows_per_s:,.0f} rows/s)"
+                )
+                cprint(f"\n------  Model → saved to {self.output}  ------\n", bold=True)
+            case Err(error):
+                cprint("Error", fg="red", bold=True, end=f": {error}\n")
+
+
+class Cli(Command):
+    subcommand: Batch | Watch | Serve | Samples | Db | Train | None = None
+    filepath: Positional[str] = arg(default="", help="The raw reads fastq filepath")
+    db: str = arg(default="./database/Magnoliopsida_raxdb.fasta", help="The raxtax reference database fasta")
+    threads: int = arg(default=os.cpu_count() or 1, short="t", help="Number of worker processes used for consensus")
+    no_cache: bool = arg(default=False, help="Run every stage from scratch instead of reusing cached artifacts")
+    no_route: bool = arg(
+        default=False, help="Classify everything against --db instead of the per-marker databases next to it"
+    )
+    primers: str = arg(default="", help="Primers csv used for routing, defaults to the expedition's primer_info.csv")
+    read_budget: int = arg(
+        default=0, help="Clusters at most this many reads, sampled with a preference for high quality, 0 keeps all"
+    )
+    saturation_step: int = arg(
+        default=0, help="With --read-budget, adds reads this many at a time and only while new clusters appear"
+    )
+    max_clusters: int = arg(
+        default=0, help="Only generates a consensus for this many of the largest clusters, 0 for all"
+    )
+    min_support: float = arg(
+        default=0.0, help="Only generates a consensus for the clusters holding this share of the reads (e.g. 0.05)"
+    )
+    max_consensus_reads: int = arg(
+        default=0, help="Builds each consensus from at most this many reads, the best of the cluster, 0 uses them all"
+    )
+    blast_db: str = arg(
+        default="", help="Drops the consensus sequences without a BLASTN hit in this plant database (fasta or prefix)"
+    )
+    blast_min_identity: float = arg(default=0.0, help="Minimum identity (in %) of the --blast-db hits")
+    model: str = arg(
+        default="", help="Classifies the consensus sequences with this XGBoost k-mer model instead of raxtax"
+    )
+    qc: bool = arg(
+        default=False, help="Writes the read length and quality statistics before and after filtering to output/qc"
+    )
+    nanoplot: bool = arg(default=False, help="Also plots the raw and filtered reads with NanoPlot to output/nanoplot")
+    metrics: str = arg(default="", help="Appends the performance metrics of every stage to this JSON-lines file")
+    timings: bool = arg(default=False, help="Prints a table of the performance metrics of every stage")
+
+    @override
+    async def run(self):
+        if not self.filepath:
+            self.print_help()
+
+        match await self._run():
+            case Ok(value):
+                pass
+            case Err(value):
+                cprint("Error", fg="red", bold=True, end=f": {value}\n")
+
+    @safe_async
+    async def _run(self) -> None:
+        _start = time()
+        async with Spinner("Initializing", capture=False) as spin:
+            if not Path(self.filepath).is_file():
+                await spin.fail()
+                raise RuntimeError("Filepath does not point to an existing file.")
+            from pipeline import run_pipeline
+            from preprocessing import run_nanoplot
+            from raxtax import Raxtax
+            from telemetry import Telemetry
+
+            _diff = time() - _start
+            await spin.done(f"Initializing → {_diff:.3f} s")
+
+        async with aiof.tempfile.TemporaryDirectory(prefix="myrio_") as tmp:
+            options = _pipeline_options(self)
+            telemetry = Telemetry(Path(self.metrics) if self.metrics else None)
+            raxtax = (
+                await run_pipeline(Path(self.filepath), Path(tmp), options, stage=_spinner, telemetry=telemetry)
+            ).unwrap()
 
             cprint("\n------  Best Raxtax Result  ------\n", bold=True)
 
             raxtax.prettify()
-            best_raxtax_match = raxtax.df.row(0)
-            print(
-                boxed(
-                    f"{best_raxtax_match[1]}",
-                    width=70,
-                    align="center",
-                    title=f"Phylum: {best_raxtax_match[2]}",
-                    color="magenta",
+            best_raxtax_match = raxtax.df.row(0, named=True)
+            colors = ["magenta", "red", "yellow", "green", "bright_blue", "bright_cyan"]
+            for i, (rank, color) in enumerate(zip(Raxtax.get_ranks(), colors, strict=True)):
+                # A model only predicts its rank and the ones above it
+                if best_raxtax_match[rank] is None:
+                    continue
+                print(
+                    boxed(
+                        f"{best_raxtax_match[rank]}",
+                        width=70 - 5 * i,
+                        align="center",
+                        title=f"{rank.capitalize()}: {best_raxtax_match[f'{rank}_score']}",
+                        color=color,
+                    )
                 )
-            )
-            print(
-                boxed(
-                    f"{best_raxtax_match[3]}",
-                    width=65,
-                    align="center",
-                    title=f"Class: {best_raxtax_match[4]}",
-                    color="red",
-                )
-            )
-            print(
-                boxed(
-                    f"{best_raxtax_match[5]}",
-                    width=60,
-                    align="center",
-                    title=f"Order: {best_raxtax_match[6]}",
-                    color="yellow",
-                )
-            )
-            print(
-                boxed(
-                    f"{best_raxtax_match[7]}",
-                    width=55,
-                    align="center",
-                    title=f"Family: {best_raxtax_match[8]}",
-                    color="green",
-                )
-            )
-            print(
-                boxed(
-                    f"{best_raxtax_match[9]}",
-                    width=50,
-                    align="center",
-                    title=f"Genus: {best_raxtax_match[10]}",
-                    color="bright_blue",
-                )
-            )
-            print(
-                boxed(
-                    f"{best_raxtax_match[11]}",
-                    width=45,
-                    align="center",
-                    title=f"Species: {best_raxtax_match[12]}",
-                    color="bright_cyan",
-                )
-            )
 
             cprint("\n------  Raxtax Results → saved to output/results.csv  ------\n", bold=True)
 
             print(raxtax.df.select(raxtax.df.columns[-8:]))
+            os.makedirs("output", exist_ok=True)
             raxtax.df.write_csv("output/results.csv")
 
+            if options.qc:
+                shutil.copytree(Path(tmp, "qc"), Path("output", "qc"), dirs_exist_ok=True)
+            if self.nanoplot:
+                async with Spinner("Plotting reads with NanoPlot", capture=False) as spin:
+                    _start = time()
+                    for reads_fp, name in ((Path(self.filepath), "raw"), (Path(tmp, "reads.fastq"), "filtered")):
+                        (await run_nanoplot(reads_fp, Path("output", "nanoplot", name))).unwrap()
+                    await spin.done(f"Plotting reads with NanoPlot → {time() - _start:.3f} s")
+
+            if self.timings:
+                _print_timings(telemetry)
+
 
 def main():
     cmd = Cli.parse()
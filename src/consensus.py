@@ -1,28 +1,159 @@
+import asyncio
+import heapq
 import os
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed
 from pathlib import Path
 
-import pysam
+import numpy as np
 import spoa
 from safe_result import safe
 
+import fastx
 
-@safe
-def spoa_consensus(cluster_fps: list[Path], second_pass: bool = False) -> list[tuple[str, str]]:
+
+def _read_lengths(cluster_fp: Path) -> np.ndarray:
+    """The length of every read of a cluster fastq."""
+    return np.concatenate([batch.lengths() for batch in fastx.read_batches(cluster_fp, "fastq")] or [np.empty(0, int)])
+
+
+def _best_reads(cluster_fp: Path, max_reads: int, median: float) -> Iterator[str]:
+    """Streams a cluster and keeps its `max_reads` best reads, in their original order.
+
+    Reads are ranked by their mean quality, scaled down by how far their length is from the `median` length of the
+    cluster (a read twice as long or short as the median scores 0). Only a heap of `max_reads` reads is kept.
+    """
+    median = max(median, 1.0)
+    heap: list[tuple[float, int, bytes]] = []
+    n_reads = 0
+    for batch in fastx.read_batches(cluster_fp, "fastq"):
+        qualities = batch.mean_qualities()
+        scores = qualities * np.maximum(1 - np.abs(batch.lengths() - median) / median, 0)
+        for i, (sequence, score) in enumerate(zip(batch.sequences, scores.tolist(), strict=True)):
+            # Ties keep the earliest reads
+            item = (score, -(n_reads + i), sequence)
+            if len(heap) < max_reads:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        n_reads += len(batch)
+
+    return (sequence.decode() for _, _, sequence in sorted(heap, key=lambda item: -item[1]))
+
+
+def _cluster_consensus(cluster_fp: Path, second_pass: bool = False, max_reads: int = 0) -> tuple[str, str]:
+    """Runs SPOA over the reads of a single cluster.
+
+    Args:
+        cluster_fp (Path): The cluster fastq filepath.
+        second_pass (bool, optional): Runs a second SPOA pass seeded with the first consensus. Defaults to False.
+        max_reads (int, optional): Only the best reads of larger clusters are used (see `_best_reads`), `0` uses
+            them all. Defaults to 0.
+
+    Returns:
+        The `(cluster name, consensus sequence)` pair.
+    """
     os.environ["OMP_NUM_THREADS"] = "1"
-    consensus_sequences = []
-    for cluster_fp in cluster_fps:  # Todo: multithread this
-        with pysam.FastxFile(str(cluster_fp)) as f:
-            sequences = [read.sequence for read in list(f)]
+    lengths = _read_lengths(cluster_fp) if max_reads > 0 else None
+    if lengths is not None and len(lengths) > max_reads:
+        sequences = list(_best_reads(cluster_fp, max_reads, float(np.median(lengths))))
+    else:
+        batches = fastx.read_batches(cluster_fp, "fastq")
+        sequences = [sequence.decode() for batch in batches for sequence in batch.sequences]
+
+    # Relative to the reads actually used
+    min_cov = int(round(len(sequences) * 0.15))
 
-        min_cov = int(round(len(sequences) * 0.15))
+    # run spoa will all sequence first
+    cons, _ = spoa.poa(sequences, min_coverage=min_cov, genmsa=False)
 
-        # run spoa will all sequence first
-        cons, _ = spoa.poa(sequences, min_coverage=min_cov, genmsa=False)
+    # second SPOA pass, using the previous result as first read
+    if second_pass:
+        cons, _ = spoa.poa([cons, *sequences], min_coverage=min_cov, genmsa=False)
 
-        # second SPOA pass, using the previous result as first read
-        if second_pass:
-            cons, _ = spoa.poa([cons, *sequences], min_coverage=min_cov, genmsa=False)
+    return (cluster_fp.name, cons)
 
-        consensus_sequences.append((cluster_fp.name, cons))
+
+@safe
+def spoa_consensus(
+    cluster_fps: list[Path],
+    second_pass: bool = False,
+    max_workers: int = 0,
+    max_reads: int = 0,
+    executor: Executor | None = None,
+) -> list[tuple[str, str]]:
+    """Generates one consensus sequence per cluster with SPOA.
+
+    Args:
+        cluster_fps (list[Path]): The cluster fastq filepaths.
+        second_pass (bool, optional): Runs a second SPOA pass seeded with the first consensus. Defaults to False.
+        max_workers (int, optional): Number of worker processes to spread the clusters on, `0` runs everything in
+            the calling process. Defaults to 0.
+        max_reads (int, optional): Reads used at most per cluster, the best ones, `0` uses them all. Defaults to 0.
+        executor (Executor | None, optional): A running worker pool to use instead of starting one, it is left
+            running. Defaults to None.
+
+    Returns:
+        The `(cluster name, consensus sequence)` pairs, in the same order as `cluster_fps`.
+    """
+    if max_workers <= 0 and executor is None:
+        return [_cluster_consensus(cluster_fp, second_pass, max_reads) for cluster_fp in cluster_fps]
+
+    # Largest clusters are submitted first, so a big cluster doesn't end up running alone at the very end.
+    # The file size is a cheap enough proxy for the number of reads.
+    order = sorted(range(len(cluster_fps)), key=lambda i: cluster_fps[i].stat().st_size, reverse=True)
+
+    consensus_sequences: list[tuple[str, str]] = [("", "")] * len(cluster_fps)
+    pool = executor or ProcessPoolExecutor(max_workers=min(max_workers, max(len(cluster_fps), 1)))
+    try:
+        futures = {pool.submit(_cluster_consensus, cluster_fps[i], second_pass, max_reads): i for i in order}
+        for future in as_completed(futures):
+            consensus_sequences[futures[future]] = future.result()
+    finally:
+        if executor is None:
+            pool.shutdown()
 
     return consensus_sequences
+
+
+async def iter_consensus(
+    cluster_fps: list[Path],
+    second_pass: bool = False,
+    max_workers: int = 1,
+    max_reads: int = 0,
+    executor: Executor | None = None,
+) -> AsyncIterator[tuple[str, str]]:
+    """Generates one consensus sequence per cluster with SPOA, yielding each one as soon as it is ready.
+
+    The clusters run in worker processes like with `spoa_consensus`, the event loop stays free meanwhile.
+
+    Args:
+        cluster_fps (list[Path]): The cluster fastq filepaths.
+        second_pass (bool, optional): Runs a second SPOA pass seeded with the first consensus. Defaults to False.
+        max_workers (int, optional): Number of worker processes to spread the clusters on. Defaults to 1.
+        max_reads (int, optional): Reads used at most per cluster, the best ones, `0` uses them all. Defaults to 0.
+        executor (Executor | None, optional): A running worker pool to use instead of starting one, it is left
+            running. Defaults to None.
+
+    Yields:
+        The `(cluster name, consensus sequence)` pairs, in completion order.
+    """
+    if not cluster_fps:
+        return
+
+    loop = asyncio.get_running_loop()
+    order = sorted(cluster_fps, key=lambda fp: fp.stat().st_size, reverse=True)
+    pool = executor or ProcessPoolExecutor(max_workers=min(max(max_workers, 1), len(cluster_fps)))
+    futures = [
+        loop.run_in_executor(pool, _cluster_consensus, cluster_fp, second_pass, max_reads) for cluster_fp in order
+    ]
+    try:
+        for future in asyncio.as_completed(futures):
+            yield await future
+    finally:
+        if executor is None:
+            # Doesn't block the event loop, the workers are already idle unless we stopped early
+            pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,392 @@
+import contextlib
+import dataclasses
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+from array import array
+from collections import Counter
+from datetime import UTC, datetime
+from pathlib import Path
+
+import aiofiles as aiof
+import numpy as np
+import polars as pl
+from safe_result import safe, safe_async
+
+import utils
+from cache import tool_version
+
+_MARKER_RE = re.compile(rb"MARKER_CODE=([^;|\s]+)")
+_TAX_RE = re.compile(r";tax=([^;]*);")
+
+# The BOLD marker codes gathered in every per-marker database
+MARKER_GROUPS: dict[str, list[str]] = {
+    "rbcL": ["rbcL", "rbcL-like"],
+    "matK": ["matK", "matK-like"],
+    "trnH-psbA": ["trnH-psbA"],
+    "ITS": ["ITS", "ITS1", "ITS2"],
+}
+
+_BOLD_RANKS = {
+    "phylum": "phylum_name",
+    "class": "class_name",
+    "order": "order_name",
+    "family": "family_name",
+    "genus": "genus_name",
+    "species": "species_name",
+}
+
+
+@dataclasses.dataclass
+class Manifest:
+    """Describes a compiled raxtax database and the reference fasta it was compiled from."""
+
+    source: str
+    source_size: int
+    source_mtime_ns: int
+    source_hash: str
+    binary: str
+    records: int
+    markers: dict[str, int]
+    raxtax_version: str
+    created: str
+
+    @staticmethod
+    def filepath(fasta_fp: Path) -> Path:
+        return fasta_fp.with_suffix(".manifest.json")
+
+    @staticmethod
+    def load(fasta_fp: Path) -> "Manifest | None":
+        try:
+            with open(Manifest.filepath(fasta_fp), "r") as file:
+                return Manifest(**json.load(file))
+        except (FileNotFoundError, json.JSONDecodeError, TypeError):
+            return None
+
+    def save(self, fasta_fp: Path):
+        with open(Manifest.filepath(fasta_fp), "w") as file:
+            json.dump(dataclasses.asdict(self), file, indent=2)
+
+
+def _count_records(fasta_fp: Path) -> tuple[int, dict[str, int]]:
+    """Counts the records of a reference fasta and the records of every marker (`MARKER_CODE=` in the header)."""
+    records = 0
+    markers: Counter[str] = Counter()
+    with open(fasta_fp, "rb") as file:
+        for line in file:
+            if line.startswith(b">"):
+                records += 1
+                match = _MARKER_RE.search(line)
+                markers[match[1].decode() if match else "unknown"] += 1
+    return records, dict(markers)
+
+
+@safe_async
+async def compile_database(fasta_fp: Path) -> Manifest:
+    """Compiles a reference fasta into raxtax's binary database, stored next to it with a manifest.
+
+    The binary is written to `<fasta stem>.bin` and described by `<fasta stem>.manifest.json`, which
+    `resolve_database` uses to pick the binary up automatically while it is up to date.
+
+    Args:
+        fasta_fp (Path): The reference fasta filepath.
+
+    Returns:
+        A result containing the manifest of the compiled database if successful.
+    """
+    fasta_fp = Path(fasta_fp)
+    binary_fp = fasta_fp.with_suffix(".bin")
+    stat = fasta_fp.stat()
+
+    async with aiof.tempfile.TemporaryDirectory(prefix="myrio_db_") as tmp:
+        # fmt: off
+        command = [
+            "raxtax",
+            "--database-path", str(fasta_fp),
+            "--make-db",
+            "--prefix", str(tmp),
+            "--quiet",
+            "--redo",
+        ]
+        # fmt: on
+        (await utils.exec_command(command)).unwrap()
+
+        # Depending on its version raxtax writes the binary in the prefix directory or next to the fasta
+        candidates = [*Path(tmp).glob("*.bin"), binary_fp]
+        produced = next((fp for fp in candidates if fp.is_file()), None)
+        if produced is None:
+            raise RuntimeError(f"Raxtax did not produce a binary database for `{fasta_fp}`.")
+        if produced != binary_fp:
+            shutil.move(produced, binary_fp)
+
+    records, markers = _count_records(fasta_fp)
+    manifest = Manifest(
+        source=fasta_fp.name,
+        source_size=stat.st_size,
+        source_mtime_ns=stat.st_mtime_ns,
+        source_hash=utils.file_digest(fasta_fp),
+        binary=binary_fp.name,
+        records=records,
+        markers=markers,
+        raxtax_version=await tool_version("raxtax"),
+        created=datetime.now(UTC).isoformat(timespec="seconds"),
+    )
+    manifest.save(fasta_fp)
+    return manifest
+
+
+def resolve_database(db_fp: Path) -> Path:
+    """Returns the compiled binary of a reference fasta if it is up to date, the fasta itself otherwise.
+
+    The fasta is only re-hashed when its size or mtime changed since it was compiled.
+    """
+    db_fp = Path(db_fp)
+    manifest = Manifest.load(db_fp)
+    if manifest is None or not db_fp.is_file():
+        return db_fp
+
+    binary_fp = Path(db_fp.parent, manifest.binary)
+    if not binary_fp.is_file():
+        return db_fp
+
+    stat = db_fp.stat()
+    if stat.st_size == manifest.source_size and stat.st_mtime_ns == manifest.source_mtime_ns:
+        return binary_fp
+
+    if stat.st_size == manifest.source_size and utils.file_digest(db_fp) == manifest.source_hash:
+        # Only touched, remember the new mtime so we don't hash it again
+        manifest.source_mtime_ns = stat.st_mtime_ns
+        manifest.save(db_fp)
+        return binary_fp
+
+    return db_fp
+
+
+def database_info(db_fp: Path) -> str:
+    """A short human readable description of a reference database and its compiled binary."""
+    manifest = Manifest.load(Path(db_fp))
+    if manifest is None:
+        return f"{db_fp}: not compiled"
+
+    status = "up to date" if resolve_database(Path(db_fp)) != Path(db_fp) else "outdated"
+    markers = ", ".join(f"{marker}: {count}" for marker, count in sorted(manifest.markers.items()))
+    return (
+        f"{db_fp}: compiled ({status}) → {manifest.binary}\n"
+        f"  {manifest.records} records ({markers}), raxtax {manifest.raxtax_version}, {manifest.created}"
+    )
+
+
+def _fasta_records(lf: pl.LazyFrame, marker_groups: dict[str, list[str]]) -> pl.LazyFrame:
+    """Turns BOLD rows into raxtax fasta records, with a `group` column naming the database of each record.
+
+    >BOLD_PID=CAATB198-11|MARKER_CODE=rbcL;tax=phylum:Tracheophyta,class:Magnoliopsida,...,species:Bauhinia_cheilantha;
+
+    The `key` column hashes the lineage and the normalized sequence (uppercase, without the `N` padding left by
+    the alignment gaps), records sharing it are exact duplicates.
+    """
+    groups = {code: group for group, codes in marker_groups.items() for code in codes}
+    ranks = [
+        pl.when(pl.col(column).is_null())
+        .then(pl.lit(""))
+        .otherwise(pl.lit(f"{rank}:") + pl.col(column).str.replace_all(" ", "_", literal=True))
+        for rank, column in _BOLD_RANKS.items()
+    ]
+    tax = pl.concat_str(ranks, separator=",")
+    sequence = (
+        pl.col("nucleotides")
+        .str.strip_chars()
+        .str.replace_all("-", "N", literal=True)
+        .str.replace_all("I", "N", literal=True)
+    )
+    return lf.filter(pl.col("markercode").is_in(list(groups)) & pl.col("nucleotides").is_not_null()).select(
+        pl.col("markercode").replace_strict(groups).alias("group"),
+        pl.concat_str(
+            pl.lit(">BOLD_PID="),
+            pl.col("processid").fill_null(""),
+            pl.lit("|MARKER_CODE="),
+            pl.col("markercode"),
+            pl.lit(";tax="),
+            tax,
+            pl.lit(";\n"),
+            sequence,
+            pl.lit("\n"),
+        ).alias("record"),
+        pl.concat_str(tax, sequence.str.to_uppercase().str.strip_chars("N"), separator=";").hash().alias("key"),
+    )
+
+
+@dataclasses.dataclass
+class DatabaseStats:
+    """What went into a reference fasta built by `build_databases`."""
+
+    records: int = 0
+    duplicates: int = 0  # exact duplicates (same lineage and normalized sequence) removed
+    near_duplicates: int = 0  # near-duplicates of another sequence of the same lineage removed
+
+
+def _unseen(keys: np.ndarray, seen: np.ndarray) -> np.ndarray:
+    """Masks the keys that are in neither `seen` (sorted) nor earlier in `keys`."""
+    _, first = np.unique(keys, return_index=True)
+    mask = np.zeros(len(keys), dtype=bool)
+    mask[first] = True
+    if len(seen):
+        positions = np.minimum(np.searchsorted(seen, keys), len(seen) - 1)
+        mask &= seen[positions] != keys
+    return mask
+
+
+@safe
+def build_databases(
+    tsv_fp: Path,
+    output_dir: Path,
+    prefix: str = "Magnoliopsida",
+    marker_groups: dict[str, list[str]] = MARKER_GROUPS,
+    combined: bool = True,
+    dereplicate: bool = False,
+    near_identity: float | None = None,
+    batch_size: int = 100_000,
+) -> dict[Path, DatabaseStats]:
+    """Builds the raxtax reference fastas of every marker group from a BOLD data package tsv, in a single pass.
+
+    The tsv is read in batches of rows (parsed in parallel by polars) and every batch is appended to the fastas
+    right away, so the memory used doesn't depend on the size of the tsv (besides 8 bytes per record to
+    dereplicate).
+
+    Args:
+        tsv_fp (Path): The BOLD tsv filepath.
+        output_dir (Path): Directory for the fastas, `<prefix>_<marker group>_raxdb.fasta`.
+        prefix (str, optional): The prefix of the fasta names, usually the taxon. Defaults to "Magnoliopsida".
+        marker_groups (dict[str, list[str]], optional): The BOLD marker codes of every database. Defaults to
+            `MARKER_GROUPS`.
+        combined (bool, optional): Also writes every record to `<prefix>_raxdb.fasta`. Defaults to True.
+        dereplicate (bool, optional): Only keeps the first of the records sharing both their lineage and their
+            normalized sequence. Defaults to False.
+        near_identity (float | None, optional): Also collapses the sequences of a lineage that are at least this
+            identical to a longer one, see `collapse_near_duplicates`. Defaults to None.
+        batch_size (int, optional): Approximate number of rows per batch. Defaults to 100_000.
+
+    Returns:
+        What went into every fasta.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    filepaths = {group: Path(output_dir, f"{prefix}_{group}_raxdb.fasta") for group in marker_groups}
+    combined_fp = Path(output_dir, f"{prefix}_raxdb.fasta")
+    stats = {fp: DatabaseStats() for fp in [*filepaths.values(), *([combined_fp] if combined else [])]}
+    seen = {group: np.empty(0, dtype=np.uint64) for group in marker_groups}
+
+    columns = ["processid", *_BOLD_RANKS.values(), "markercode", "nucleotides"]
+    reader = pl.read_csv_batched(
+        tsv_fp, separator="\t", quote_char=None, infer_schema_length=0, columns=columns, batch_size=batch_size
+    )
+
+    with contextlib.ExitStack() as stack:
+        files = {fp: stack.enter_context(open(fp, "w")) for fp in stats}
+        while batches := reader.next_batches(max(os.cpu_count() or 1, 1)):
+            records = _fasta_records(pl.concat(batches).lazy(), marker_groups).collect()
+            for (group,), part in records.partition_by("group", as_dict=True, maintain_order=True).items():
+                duplicates = 0
+                if dereplicate:
+                    keys = part.get_column("key").to_numpy()
+                    unseen = _unseen(keys, seen[group])
+                    seen[group] = np.union1d(seen[group], keys[unseen])
+                    part, duplicates = part.filter(unseen), part.height - int(unseen.sum())
+
+                chunk = part.get_column("record").str.join("").item()
+                for fp in [filepaths[group], *([combined_fp] if combined else [])]:
+                    files[fp].write(chunk)
+                    stats[fp].records += part.height
+                    stats[fp].duplicates += duplicates
+
+    if near_identity is not None:
+        for fp, fp_stats in stats.items():
+            removed = collapse_near_duplicates(fp, near_identity).unwrap()
+            fp_stats.records -= removed
+            fp_stats.near_duplicates += removed
+
+    return stats
+
+
+def _identity(a: np.ndarray, b: np.ndarray, k: int) -> float:
+    """Estimates the identity of two sequences from their k-mer sets, like Mash does from the Jaccard index."""
+    shared = len(np.intersect1d(a, b, assume_unique=True))
+    if shared == 0:
+        return 0.0
+    jaccard = shared / (len(a) + len(b) - shared)
+    return 1.0 + math.log(2 * jaccard / (1 + jaccard)) / k
+
+
+def _lineage_records(fasta_fp: Path) -> tuple[int, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Indexes the records with a species of a one line per sequence fasta, without keeping their sequences.
+
+    Returns:
+        The number of records, then for every record with a species: its index, the byte offset and the length of
+        its sequence, and a hash of its lineage.
+    """
+    n_records, offset = 0, 0
+    indices, offsets, lengths, lineages = array("q"), array("q"), array("q"), array("q")
+    with open(fasta_fp, "rb") as file:
+        while header := file.readline():
+            sequence = file.readline()
+            match = _TAX_RE.search(header.decode(errors="replace"))
+            if match is not None and match[1].rsplit(",", 1)[-1].startswith("species:"):
+                indices.append(n_records)
+                offsets.append(offset + len(header))
+                lengths.append(len(sequence.rstrip(b"\r\n")))
+                lineages.append(hash(match[1]))
+            offset += len(header) + len(sequence)
+            n_records += 1
+    return n_records, *(np.frombuffer(values, dtype=np.int64) for values in (indices, offsets, lengths, lineages))
+
+
+@safe
+def collapse_near_duplicates(fasta_fp: Path, identity: float = 0.99, k: int = 15) -> int:
+    """Collapses the near-duplicate sequences of every lineage of a reference fasta, in place.
+
+    Within a lineage, sequences are visited from the longest to the shortest and dropped when they are at least
+    `identity` identical to a sequence already kept. Records without a species are never collapsed. The fasta
+    must have one line per sequence, like the ones written by `build_databases`. Only the sequences of one lineage
+    are in memory at once (besides 32 bytes per record), and sequences whose sizes are too different to reach
+    `identity` are never compared.
+
+    Returns:
+        The number of records removed.
+    """
+    n_records, indices, offsets, lengths, lineages = _lineage_records(fasta_fp)
+    if len(indices) < 2:
+        return 0
+
+    # The Jaccard index reaching `identity` (see `_identity`), it is at most the ratio of the k-mer set sizes
+    similarity = math.exp((identity - 1) * k)
+    min_jaccard = similarity / (2 - similarity) - 1e-9
+
+    removed = np.zeros(n_records, dtype=bool)
+    order = np.argsort(lineages, kind="stable")
+    with open(fasta_fp, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for group in np.split(order, np.flatnonzero(np.diff(lineages[order])) + 1):
+            if len(group) < 2:
+                continue
+            kept: list[np.ndarray] = []
+            for i in group[np.argsort(-lengths[group], kind="stable")]:
+                kmers = np.unique(utils.kmer_codes(mapped[offsets[i] : offsets[i] + lengths[i]], k))
+                if any(
+                    min(len(kmers), len(other)) >= min_jaccard * max(len(kmers), len(other))
+                    and _identity(kmers, other, k) >= identity
+                    for other in kept
+                ):
+                    removed[indices[i]] = True
+                else:
+                    kept.append(kmers)
+
+    if removed.any():
+        tmp_fp = Path(fasta_fp).with_suffix(".tmp")
+        with open(fasta_fp, "rb") as file, open(tmp_fp, "wb") as output:
+            for i in range(n_records):
+                record = file.readline() + file.readline()
+                if not removed[i]:
+                    output.write(record)
+        os.replace(tmp_fp, fasta_fp)
+    return int(removed.sum())
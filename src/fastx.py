@@ -0,0 +1,198 @@
+import dataclasses
+import gzip
+import mmap
+from collections.abc import Iterator
+from contextlib import contextmanager
+from os import PathLike
+from pathlib import Path
+from typing import Any, BinaryIO, Literal
+
+import numpy as np
+
+Format = Literal["fastq", "fasta"]
+
+_CHUNK_SIZE = 1 << 24
+_GZIP_MAGIC = b"\x1f\x8b"
+
+# Error probability of every quality byte (phred+33), seqkit averages qualities in the probability space
+_ERROR_PROBABILITIES = np.power(10.0, -(np.arange(256, dtype=np.float64) - 33) / 10)
+
+
+def mean_qualities(qualities: list[bytes]) -> np.ndarray:
+    """The mean quality of every read in one go, from the mean error probability: -10 * log10(mean(10^(-q/10)))."""
+    qual_lengths = np.fromiter(map(len, qualities), dtype=np.int64, count=len(qualities))
+    error = _ERROR_PROBABILITIES[np.frombuffer(b"".join(qualities), dtype=np.uint8)]
+    avg_qual = np.zeros(len(qualities), dtype=np.float64)
+    non_empty = qual_lengths > 0  # seqkit reports a mean quality of 0 for empty reads
+    if non_empty.any():
+        # Only the non-empty reads start a segment, so every segment ends where its read does (even before
+        # trailing empty reads). Unlike differences of prefix sums, this doesn't lose the small error probabilities.
+        starts = (np.cumsum(qual_lengths) - qual_lengths)[non_empty]
+        avg_qual[non_empty] = -10 * np.log10(np.add.reduceat(error, starts) / qual_lengths[non_empty])
+    return avg_qual
+
+
+@dataclasses.dataclass
+class FastxBatch:
+    """A batch of FASTQ or FASTA records, kept as raw bytes.
+
+    `names` are the whole header lines without their `@` or `>`, `qualities` is None for FASTA records.
+    """
+
+    names: list[bytes]
+    sequences: list[bytes]
+    qualities: list[bytes] | None = None
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    def lengths(self) -> np.ndarray:
+        """The length of every sequence."""
+        return np.fromiter(map(len, self.sequences), dtype=np.int64, count=len(self.sequences))
+
+    def mean_qualities(self) -> np.ndarray:
+        """The mean quality of every read, see `mean_qualities`."""
+        if self.qualities is None:
+            raise ValueError("FASTA records have no qualities.")
+        return mean_qualities(self.qualities)
+
+    def to_fastq(self, indices: list[int] | None = None) -> bytes:
+        """The records (or only the ones at `indices`) as FASTQ, ready to be written."""
+        if self.qualities is None:
+            raise ValueError("FASTA records have no qualities to be written as FASTQ.")
+        indices = range(len(self)) if indices is None else indices
+        return b"".join(b"@%s\n%s\n+\n%s\n" % (self.names[i], self.sequences[i], self.qualities[i]) for i in indices)
+
+    def to_fasta(self, indices: list[int] | None = None) -> bytes:
+        """The records (or only the ones at `indices`) as FASTA, one line per sequence."""
+        indices = range(len(self)) if indices is None else indices
+        return b"".join(b">%s\n%s\n" % (self.names[i], self.sequences[i]) for i in indices)
+
+
+@contextmanager
+def _open(filepath: str | PathLike[Any]) -> Iterator[BinaryIO]:
+    """Opens a file for reading, memory-mapped when it is plain and decompressed on the fly when it is gzipped."""
+    with open(filepath, "rb") as file:
+        if file.read(2) == _GZIP_MAGIC:
+            file.seek(0)
+            with gzip.open(file, "rb") as gz_file:
+                yield gz_file  # type: ignore[misc]
+            return
+        file.seek(0)
+        if Path(filepath).stat().st_size == 0:
+            yield file
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, "madvise"):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            yield mapped  # type: ignore[misc]
+
+
+def detect_format(filepath: str | PathLike[Any]) -> Format:
+    """Tells FASTQ and FASTA files (gzipped or not) apart from their first record."""
+    with _open(filepath) as file:
+        head = file.read(1 << 12).lstrip()
+    if not head or head.startswith(b"@"):
+        return "fastq"
+    # FASTA files may start with comments, see `parse_chunk`
+    if head.startswith(b">") or b"\n>" in head:
+        return "fasta"
+    raise ValueError(f"`{filepath}` is neither a FASTQ nor a FASTA file.")
+
+
+def _fastq_cut(block: bytes) -> int:
+    """Where the last whole (4 lines) FASTQ record of a block ends."""
+    newlines = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+    n_lines = len(newlines) - len(newlines) % 4
+    return int(newlines[n_lines - 1]) + 1 if n_lines > 0 else 0
+
+
+def _fasta_cut(block: bytes) -> int:
+    """Where the last whole FASTA record of a block ends, the next one can't be known to be whole yet."""
+    return block.rfind(b"\n>") + 1
+
+
+def iter_chunks(
+    filepath: str | PathLike[Any], format: Format | None = None, chunk_size: int = _CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Reads a FASTQ (4 lines per record) or FASTA file in blocks of roughly `chunk_size` bytes of whole records.
+
+    Args:
+        filepath (str | PathLike): The FASTQ or FASTA filepath, possibly gzipped.
+        format (Format | None, optional): The file format, detected when None. Defaults to None.
+        chunk_size (int, optional): The size of the blocks read at once. Defaults to 16 MiB.
+
+    Yields:
+        Blocks of whole records, each ending with a newline.
+    """
+    cut = _fastq_cut if (format or detect_format(filepath)) == "fastq" else _fasta_cut
+    with _open(filepath) as file:
+        remainder = b""
+        while block := file.read(chunk_size):
+            block = remainder + block
+            end = cut(block)
+            remainder = block[end:]
+            if end > 0:
+                yield block[:end]
+
+        if remainder.strip():
+            yield remainder if remainder.endswith(b"\n") else remainder + b"\n"
+
+
+def parse_chunk(chunk: bytes, format: Format = "fastq") -> FastxBatch:
+    """Parses a block of whole records, see `iter_chunks`."""
+    if b"\r" in chunk:
+        chunk = chunk.replace(b"\r", b"")
+
+    if format == "fastq":
+        lines = chunk.split(b"\n")[:-1]
+        if len(lines) % 4 != 0 or not all(header.startswith(b"@") for header in lines[0::4]):
+            raise ValueError("Malformed FASTQ, expected 4 lines per record.")
+        return FastxBatch([header[1:] for header in lines[0::4]], lines[1::4], lines[3::4])
+
+    # Like Biopython, anything before the first record (comments, blank lines) is skipped
+    start = 0 if chunk.startswith(b">") else chunk.find(b"\n>") + 1
+    if start == 0 and not chunk.startswith(b">"):
+        return FastxBatch([], [])
+    names, sequences = [], []
+    for record in chunk[start + 1 :].split(b"\n>"):
+        name, _, sequence = record.partition(b"\n")
+        names.append(name)
+        sequences.append(sequence.replace(b"\n", b""))
+    return FastxBatch(names, sequences)
+
+
+def read_batches(
+    filepath: str | PathLike[Any], format: Format | None = None, chunk_size: int = _CHUNK_SIZE
+) -> Iterator[FastxBatch]:
+    """Parses a FASTQ (4 lines per record) or FASTA file, possibly gzipped, in batches of records.
+
+    This is the fast path for every stage reading sequences: the file is memory-mapped and records are split in bulk,
+    without creating an object per record.
+
+    Args:
+        filepath (str | PathLike): The FASTQ or FASTA filepath.
+        format (Format | None, optional): The file format, detected when None. Defaults to None.
+        chunk_size (int, optional): Roughly the size in bytes of the records of a batch. Defaults to 16 MiB.
+    """
+    format = format or detect_format(filepath)
+    for chunk in iter_chunks(filepath, format, chunk_size):
+        yield parse_chunk(chunk, format)
+
+
+def count_records(*filepaths: str | PathLike[Any]) -> int:
+    """Counts the records of FASTQ (4 lines per record) or FASTA files without parsing them."""
+    records = 0
+    for filepath in filepaths:
+        format = detect_format(filepath)
+        with _open(filepath) as file:
+            lines, headers, last = 0, 0, b"\n"
+            while block := file.read(1 << 20):
+                lines += block.count(b"\n")
+                headers += block.count(b"\n>") + (last == b"\n" and block.startswith(b">"))
+                last = block[-1:]
+            if format == "fastq":
+                records += (lines + (last not in (b"\n", b""))) // 4
+            else:
+                records += headers
+    return records
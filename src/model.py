@@ -1,73 +1,501 @@
-import re
-from collections import defaultdict
+import dataclasses
+import json
+import os
+import tempfile
+from collections.abc import Callable, Iterable, Iterator
+from functools import cache, lru_cache
 from pathlib import Path
-from typing import Any
+from time import time
+from typing import Literal
 
+import numpy as np
 import polars as pl
 import xgboost as xgb
-from Bio import SeqIO
+from safe_result import safe
+from scipy import sparse as sp
 
+import fastx
+import utils
+from raxtax import Raxtax
 
-def use_model(model_path: Path, input_fasta_fp: Path):
-    model = xgb.Booster()
-    model.load_model(model_path)
+DEFAULT_K = 5
+FASTA_SUFFIXES = (".fasta", ".fa", ".fasta.gz", ".fa.gz")
 
 
-def _fasta_to_parquet(input_fp: Path, output_dir: Path):
-    output_fp = Path(output_dir, input_fp.stem + ".parquet")
-    kmers_df = _build_kmer_dataset_cleaned(input_fp, format="fasta", k=5)
-    kmers_df.write_parquet(output_fp)
+@lru_cache(maxsize=4)
+def _load_booster(model_fp: Path, mtime_ns: int, threads: int) -> xgb.Booster:
+    booster = xgb.Booster(params={"nthread": threads}, model_file=model_fp)
+    return booster
 
 
-def _build_kmer_dataset_cleaned(input_fp: Path, format: str = "fasta", k: int = 5) -> pl.DataFrame:
-    def reverse_complement(seq):
-        complement = str.maketrans("ATCG", "TAGC")
-        return seq.translate(complement)[::-1]
+def load_model(model_fp: Path, threads: int = 0) -> xgb.Booster:
+    """Loads a booster once, later calls get the same one until the model file changes.
 
-    def canonical_kmer(kmer):
-        rev_kmer = reverse_complement(kmer)
-        return min(kmer, rev_kmer)
+    The booster is shared by every caller (e.g. the concurrent runs of the server), so it is never modified after
+    being loaded, the number of threads is set there (`0` uses every core).
+    """
+    model_fp = Path(model_fp).resolve()
+    return _load_booster(model_fp, model_fp.stat().st_mtime_ns, threads or os.cpu_count() or 1)
 
-    def count_kmers(seq, k):
-        counts = defaultdict(int)
-        for i in range(len(seq) - k + 1):
-            kmer = canonical_kmer(seq[i : i + k])
-            counts[kmer] += 1
-        return counts
 
-    def normalize_counts(counts):
-        total = sum(counts.values())
-        return {k: v / total for k, v in counts.items()} if total > 0 else {}
+def model_labels(booster: xgb.Booster) -> tuple[list[str], str, int]:
+    """The class names, the rank they are at and the k-mer size of a model, stored as attributes when training.
 
-    def clean_sequence(seq):
-        # Keep only A, T, C, G (case-insensitive), remove everything else
-        return re.sub(r"[^ATCG]", "", seq.upper())
+    Returns:
+        The name of every class (in class index order), the rank (`genus` unless the model says otherwise) and `k`.
+    """
+    labels = booster.attr("labels")
+    if labels is None:
+        raise ValueError("The model has no `labels` attribute, the names of its classes are unknown.")
+    return json.loads(labels), booster.attr("rank") or "genus", int(booster.attr("k") or DEFAULT_K)
 
-    records: Any = SeqIO.parse(input_fp, format)
-    all_kmers = set()
-    data = []
 
-    # print("Indexing all unique k-mers...")
-    for record in records:
-        seq = clean_sequence(str(record.seq))
-        kmer_counts = count_kmers(seq, k)
-        all_kmers.update(kmer_counts.keys())
+def _parse_lineage(lineage: str | None, rank: str) -> dict[str, str]:
+    # `phylum:Tracheophyta,class:Magnoliopsida,...`, the ranks up to (and without) `rank`
+    ranks = Raxtax.get_ranks()
+    higher = ranks[: ranks.index(rank)] if rank in ranks else []
+    names = dict(part.split(":", 1) for part in (lineage or "").split(",") if ":" in part)
+    return {higher_rank: names[higher_rank] for higher_rank in higher if names.get(higher_rank)}
 
-    all_kmers = sorted(list(all_kmers))
 
-    # print(f"Total unique canonical k-mers (k={k}): {len(all_kmers)}")
-    # print("Building feature matrix...")
+def _higher_ranks(
+    probabilities: np.ndarray, best: np.ndarray, labels: list[str], lineages: dict[str, dict[str, str]], rank: str
+) -> dict[str, pl.Series]:
+    """The ranks above the model one, from the lineage of every class stored when training.
 
-    for record in records:
-        seq = clean_sequence(str(record.seq))
-        # label = record.description.split()[1]  # First word after accession
-        label = record.description.split(" ")[1].split()[0]
+    The score of a higher rank is the probability summed over the classes sharing its name, so that it never falls
+    below the score of the rank under it, like raxtax's.
+    """
+    columns: dict[str, pl.Series] = {}
+    rows = np.arange(len(best))
+    for higher_rank in Raxtax.get_ranks()[: Raxtax.get_ranks().index(rank)]:
+        names = [lineages.get(label, {}).get(higher_rank) for label in labels]
+        if all(name is None for name in names):
+            continue
+        unique = sorted({name for name in names if name is not None})
+        codes = np.array([unique.index(name) if name is not None else -1 for name in names])
+        membership = (codes[:, None] == np.arange(len(unique))[None, :]).astype(probabilities.dtype)
+        scores = (probabilities @ membership)[rows, np.maximum(codes[best], 0)]
+        predicted = [names[i] for i in best.tolist()]
+        columns[higher_rank] = pl.Series(higher_rank, predicted, dtype=pl.String)
+        columns[f"{higher_rank}_score"] = pl.Series(
+            f"{higher_rank}_score", np.where(codes[best] >= 0, scores, np.nan), dtype=pl.Float64
+        ).fill_nan(None)
+    return columns
 
-        kmer_counts = count_kmers(seq, k)
-        norm_counts = normalize_counts(kmer_counts)
 
-        row = {k: norm_counts.get(k, 0) for k in all_kmers}
-        row["species"] = label
-        data.append(row)
+@safe
+def use_model(model_path: Path, input_fasta_fp: Path, threads: int = 0) -> Raxtax:
+    """Classifies the sequences of a fasta with the k-mer model, a fast alternative to raxtax.
 
-    return pl.DataFrame(data)
+    Every sequence is featurized into a single k-mer matrix, classified by one multi-threaded `inplace_predict`
+    call. The results have the shape of the raxtax ones: one row per sequence, the predicted class and its
+    probability at the rank of the model, and the ranks above it from the lineage of that class (see
+    `train_model`). The ranks under the model one (e.g. the species of a genus model) are left empty.
+
+    Args:
+        model_path (Path): The XGBoost model, see `train_model`.
+        input_fasta_fp (Path): The sequences to classify, usually the consensus sequences.
+        threads (int, optional): Number of threads predicting, `0` uses every core. Defaults to 0.
+
+    Returns:
+        A result containing the predictions sorted by decreasing probability if successful.
+    """
+    booster = load_model(model_path, threads)
+    labels, rank, k = model_labels(booster)
+    if rank not in Raxtax.get_ranks():
+        raise ValueError(f"The model predicts the unknown rank `{rank}`, expected one of {Raxtax.get_ranks()}.")
+
+    names, sequences = [], []
+    for batch in fastx.read_batches(input_fasta_fp, "fasta"):
+        names.extend(name.decode().split()[0] if name.strip() else "" for name in batch.names)
+        sequences.extend(batch.sequences)
+    if not sequences:
+        return Raxtax(Raxtax.get_empty_df())
+
+    probabilities = booster.inplace_predict(kmer_matrix(sequences, k=k), validate_features=False)
+    probabilities = probabilities.reshape(len(sequences), -1)
+    if probabilities.shape[1] == 1 and len(labels) == 2:  # binary objectives only give the second class probability
+        probabilities = np.column_stack([1 - probabilities[:, 0], probabilities[:, 0]])
+    best = probabilities.argmax(axis=1)
+
+    lineages = json.loads(booster.attr("lineages") or "{}")
+    df = pl.DataFrame(
+        {
+            "cluster_id": names,
+            **_higher_ranks(probabilities, best, labels, lineages, rank),
+            rank: [labels[i] for i in best.tolist()],
+            f"{rank}_score": probabilities[np.arange(len(best)), best].astype(np.float64),
+        }
+    )
+    # The ranks without a prediction are filled with nulls, in the raxtax column order
+    df = pl.concat([Raxtax.get_empty_df(), df], how="diagonal")
+    return Raxtax(df.sort(f"{rank}_score", descending=True))
+
+
+@cache
+def _canonical_kmer_index(k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Maps every 2-bit encoded k-mer to the column of its canonical k-mer.
+
+    Returns:
+        The `4^k` lookup table from k-mer code to column index, and the sorted canonical k-mer codes (one per column).
+    """
+    codes = np.arange(4**k, dtype=np.int64)
+    reverse_complement = np.zeros_like(codes)
+    for i in range(k):
+        reverse_complement |= (3 - ((codes >> (2 * i)) & 3)) << (2 * (k - 1 - i))
+
+    canonical = np.minimum(codes, reverse_complement)
+    columns = np.unique(canonical)
+    return np.searchsorted(columns, canonical).astype(np.int32), columns
+
+
+def kmer_columns(k: int = 5) -> list[str]:
+    """Returns the canonical k-mers in the column order used by `kmer_matrix`.
+
+    The layout is fixed for a given `k`: `4^k / 2` columns for odd `k` (no k-mer is its own reverse complement).
+    """
+    _, columns = _canonical_kmer_index(k)
+    return ["".join("ACGT"[(code >> (2 * (k - 1 - i))) & 3] for i in range(k)) for code in columns.tolist()]
+
+
+def kmer_matrix(
+    sequences: Iterable[str | bytes], k: int = 5, normalize: bool = True, sparse: bool = False
+) -> np.ndarray | sp.csr_matrix:
+    """Counts the canonical k-mers of every sequence in a single vectorized pass.
+
+    Sequences are 2-bit encoded and anything that isn't A, C, G or T is dropped beforehand, the same way the
+    previous string based implementation cleaned them.
+
+    Args:
+        sequences (Iterable[str | bytes]): The sequences, one row each.
+        k (int, optional): The k-mer size. Defaults to 5.
+        normalize (bool, optional): Divides each row by its total k-mer count. Defaults to True.
+        sparse (bool, optional): Returns a CSR matrix instead of a dense array. Defaults to False.
+
+    Returns:
+        A `(len(sequences), len(kmer_columns(k)))` float32 matrix.
+    """
+    index, columns = _canonical_kmer_index(k)
+    encoded = [seq.encode() if isinstance(seq, str) else seq for seq in sequences]
+    n_rows, n_cols = len(encoded), len(columns)
+
+    codes = utils.NUCLEOTIDE_CODES[np.frombuffer(b"".join(encoded), dtype=np.uint8)]
+    lengths = np.fromiter((len(seq) for seq in encoded), dtype=np.int64, count=n_rows)
+
+    # Drop the invalid nucleotides, then recompute the length of every (cleaned) sequence
+    valid = codes < 4
+    rows = np.repeat(np.arange(n_rows, dtype=np.int64), lengths)[valid]
+    codes = codes[valid].astype(np.int64)
+    lengths = np.bincount(rows, minlength=n_rows)
+
+    # k-mer code starting at every position: k shifted adds over the whole concatenated buffer
+    n_windows = max(len(codes) - k + 1, 0)
+    kmer_codes = np.zeros(n_windows, dtype=np.int64)
+    for i in range(k):
+        kmer_codes = (kmer_codes << 2) | codes[i : i + n_windows]
+
+    # Only keep the windows that don't straddle two sequences
+    starts = np.cumsum(lengths) - lengths
+    rows = rows[:n_windows]
+    in_sequence = (np.arange(n_windows, dtype=np.int64) - starts[rows]) <= (lengths[rows] - k)
+    rows, cols = rows[in_sequence], index[kmer_codes[in_sequence]]
+
+    if sparse:
+        matrix = sp.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=(n_rows, n_cols), dtype=np.float32
+        )
+        matrix.sum_duplicates()
+        if normalize:
+            totals = np.asarray(matrix.sum(axis=1)).ravel()
+            matrix = sp.csr_matrix(
+                sp.diags(np.divide(1.0, totals, out=np.zeros_like(totals), where=totals > 0)) @ matrix
+            )
+        return matrix
+
+    matrix = np.bincount(rows * n_cols + cols, minlength=n_rows * n_cols).reshape(n_rows, n_cols).astype(np.float32)
+    if normalize:
+        totals = matrix.sum(axis=1, keepdims=True)
+        np.divide(matrix, totals, out=matrix, where=totals > 0)
+    return matrix
+
+
+def write_kmer_shards(input_fp: Path, output_dir: Path, shard_rows: int = 100_000, k: int = DEFAULT_K) -> list[Path]:
+    """Writes the k-mer features and labels of a FASTA as parquet shards of about `shard_rows` rows each.
+
+    Only a shard is held in memory at once, the shards are `<output_dir>/<fasta stem>-<index>.parquet`. The records
+    whose header has no species (see `_record_label`) are left out.
+
+    Returns:
+        The shard filepaths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shard_fps: list[Path] = []
+    frames: list[pl.DataFrame] = []
+
+    def flush():
+        shard_fps.append(Path(output_dir, f"{Path(input_fp).stem}-{len(shard_fps):05d}.parquet"))
+        pl.concat(frames).write_parquet(shard_fps[-1])
+        frames.clear()
+
+    for frame in _iter_kmer_frames(input_fp, format="fasta", k=k):
+        frames.append(frame)
+        if sum(frame.height for frame in frames) >= shard_rows:
+            flush()
+    if frames:
+        flush()
+    return shard_fps
+
+
+def _record_label(name: str, rank: str = "species") -> str | None:
+    # raxtax headers hold the whole lineage (`...;tax=...,genus:Ficus,species:Ficus_religiosa;`), BOLD ones the
+    # species name as their second word. None when the header has neither, the record is then left out.
+    if ";tax=" in name:
+        tax = name.split(";tax=")[1].split(";")[0]
+        label = dict(field.partition(":")[::2] for field in tax.split(",")).get(rank)
+    else:
+        words = name.split()
+        label = words[1] if len(words) > 1 else None
+    return label or None
+
+
+def _record_lineage(name: str) -> str | None:
+    # Only raxtax headers have one, the model then predicts the higher ranks too
+    return name.split(";tax=")[1].split(";")[0] if ";tax=" in name else None
+
+
+def _iter_kmer_frames(input_fp: Path, format: fastx.Format = "fasta", k: int = DEFAULT_K) -> Iterator[pl.DataFrame]:
+    columns = kmer_columns(k)
+    for batch in fastx.read_batches(input_fp, format):
+        headers = [name.decode() for name in batch.names]
+        matrix = kmer_matrix(batch.sequences, k=k)
+        yield (
+            pl.from_numpy(matrix, schema=columns)
+            .with_columns(
+                pl.Series("species", [_record_label(header) for header in headers], dtype=pl.String),
+                pl.Series("lineage", [_record_lineage(header) for header in headers], dtype=pl.String),
+            )
+            .drop_nulls("species")
+        )
+
+
+def _build_kmer_dataset_cleaned(input_fp: Path, format: fastx.Format = "fasta", k: int = 5) -> pl.DataFrame:
+    frames = list(_iter_kmer_frames(input_fp, format, k))
+    if not frames:
+        return pl.DataFrame(
+            schema={**{column: pl.Float32 for column in kmer_columns(k)}, "species": pl.String, "lineage": pl.String}
+        )
+    return pl.concat(frames)
+
+
+def _label_expr(rank: str) -> pl.Expr:
+    # The shards are labelled by species (`Genus_species`), the genus is its first word
+    if rank == "genus":
+        return pl.col("species").str.extract(r"^([^_ ]+)").alias("genus")
+    return pl.col("species")
+
+
+class KmerShardIter(xgb.DataIter):
+    """Streams the k-mer parquet shards to XGBoost in batches of at most `batch_rows` rows, see `train_model`.
+
+    XGBoost goes through the batches once to sketch the feature quantiles, then keeps them quantized in its
+    external memory cache (`cache_prefix`), so only a batch of features is ever held in memory.
+    """
+
+    def __init__(self, shard_fps: list[Path], labels: list[str], rank: str, k: int, batch_rows: int, cache_prefix: str):
+        self.columns = kmer_columns(k)
+        self.label_index = {label: i for i, label in enumerate(labels)}
+        self.rank = rank
+        self.batches: list[tuple[Path, int]] = []
+        for shard_fp in shard_fps:
+            n_rows = pl.scan_parquet(shard_fp).select(pl.len()).collect().item()
+            self.batches.extend((shard_fp, offset) for offset in range(0, n_rows, batch_rows))
+        self.batch_rows = batch_rows
+        self._batch = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data: Callable) -> bool:
+        if self._batch == len(self.batches):
+            return False
+        shard_fp, offset = self.batches[self._batch]
+        df = (
+            pl.scan_parquet(shard_fp)
+            .slice(offset, self.batch_rows)
+            .select(*self.columns, _label_expr(self.rank).replace_strict(self.label_index, return_dtype=pl.Int32))
+            .collect()
+        )
+        input_data(data=df.select(self.columns).to_numpy(), label=df.get_column(self.rank).to_numpy())
+        self._batch += 1
+        return True
+
+    def reset(self):
+        self._batch = 0
+
+
+@dataclasses.dataclass
+class TrainingStats:
+    """The size and throughput of a training run, see `train_model`."""
+
+    rows: int = 0
+    classes: int = 0
+    rounds: int = 0
+    sketch_s: float = 0.0  # streaming the shards once into the quantized external memory cache
+    train_s: float = 0.0
+
+    @property
+    def rows_per_s(self) -> float:
+        """Rows processed per second over every boosting round."""
+        return self.rows * self.rounds / self.train_s if self.train_s > 0 else 0.0
+
+
+class _Checkpoint(xgb.callback.TrainingCallback):
+    """Saves the model (with its labels) every `interval` rounds and reports the throughput of every round."""
+
+    def __init__(
+        self,
+        output_fp: Path,
+        attributes: dict[str, str],
+        interval: int,
+        rows: int,
+        on_round: Callable[[int, float], None] | None,
+    ):
+        self.output_fp = output_fp
+        self.attributes = attributes
+        self.interval = interval
+        self.rows = rows
+        self.on_round = on_round
+        self._start = time()
+
+    def before_iteration(self, model: xgb.Booster, epoch: int, evals_log: dict) -> bool:
+        self._start = time()
+        return False
+
+    def after_iteration(self, model: xgb.Booster, epoch: int, evals_log: dict) -> bool:
+        # Counted on the model, the epochs of a resumed training start over from 0
+        boosted = model.num_boosted_rounds()
+        if self.on_round is not None:
+            self.on_round(boosted, self.rows / max(time() - self._start, 1e-9))
+        if self.interval > 0 and boosted % self.interval == 0:
+            self.save(model)
+        return False
+
+    def after_training(self, model: xgb.Booster) -> xgb.Booster:
+        self.save(model)
+        return model
+
+    def save(self, model: xgb.Booster):
+        # Written aside then renamed, an interrupted save never leaves a truncated model behind
+        model.set_attr(**self.attributes)
+        partial_fp = self.output_fp.with_stem(self.output_fp.stem + ".partial")
+        model.save_model(partial_fp)
+        os.replace(partial_fp, self.output_fp)
+
+
+def shard_filepaths(inputs: Iterable[Path]) -> list[Path]:
+    """The parquet shards among `inputs`, directories are searched recursively."""
+    return sorted(
+        shard_fp
+        for input in map(Path, inputs)
+        for shard_fp in (input.rglob("*.parquet") if input.is_dir() else [input])
+        if shard_fp.suffix == ".parquet"
+    )
+
+
+@safe
+def train_model(
+    shard_fps: list[Path],
+    output_fp: Path,
+    rank: Literal["species", "genus"] = "species",
+    k: int = DEFAULT_K,
+    rounds: int = 100,
+    max_depth: int = 6,
+    learning_rate: float = 0.3,
+    threads: int = 0,
+    batch_rows: int = 100_000,
+    checkpoint_every: int = 10,
+    resume: bool = False,
+    cache_dir: Path | None = None,
+    on_round: Callable[[int, float], None] | None = None,
+) -> TrainingStats:
+    """Trains the k-mer classifier used by `use_model` out of core, from the parquet shards of `write_kmer_shards`.
+
+    The shards are streamed by a `KmerShardIter` into an external memory `ExtMemQuantileDMatrix`, so the features
+    never have to fit in memory at once, and the trees are grown with `hist` on every core. The class names, their
+    lineages (from raxtax headers, for the ranks above `rank`), the rank and `k` are stored in the model, which is
+    saved every `checkpoint_every` rounds.
+
+    Args:
+        shard_fps (list[Path]): The parquet shards, see `shard_filepaths`.
+        output_fp (Path): The model filepath, `.ubj` or `.json`.
+        rank (Literal["species", "genus"], optional): The rank to predict. Defaults to "species".
+        k (int, optional): The k-mer size the shards were built with. Defaults to 5.
+        rounds (int, optional): Number of boosting rounds. Defaults to 100.
+        max_depth (int, optional): Maximum depth of the trees. Defaults to 6.
+        learning_rate (float, optional): The learning rate (`eta`). Defaults to 0.3.
+        threads (int, optional): Number of threads, `0` uses every core. Defaults to 0.
+        batch_rows (int, optional): Rows read from the shards at once. Defaults to 100000.
+        checkpoint_every (int, optional): Saves the model every this many rounds, 0 only at the end. Defaults to 10.
+        resume (bool, optional): Continues training the model at `output_fp` up to `rounds`. Defaults to False.
+        cache_dir (Path | None, optional): Directory of the external memory cache, a temporary one if None.
+            Defaults to None.
+        on_round (Callable[[int, float], None] | None, optional): Called after every round with its number and
+            throughput (rows/s). Defaults to None.
+
+    Returns:
+        A result containing the training statistics if successful.
+    """
+    if not shard_fps:
+        raise ValueError("No parquet shard to train on.")
+    columns = pl.scan_parquet(shard_fps[0]).collect_schema().names()
+    features = kmer_columns(k)
+    if columns[: len(features)] != features or "species" not in columns:
+        raise ValueError(f"The shards don't hold the {k}-mer features of `kmer_columns({k})` and a `species` label.")
+
+    # The label columns alone are a cheap columnar read, the classes must be known before the first batch
+    lineage = pl.col("lineage") if "lineage" in columns else pl.lit(None, dtype=pl.String).alias("lineage")
+    classes = (
+        pl.scan_parquet(shard_fps)
+        .select(_label_expr(rank), lineage)
+        .drop_nulls(rank)
+        .sort(rank, "lineage", nulls_last=True)
+        .unique(rank, keep="first", maintain_order=True)
+        .collect()
+    )
+    labels = classes.get_column(rank).to_list()
+    if len(labels) < 2:
+        raise ValueError(f"At least two {rank} labels are needed to train a classifier, got {labels}.")
+    lineages = {label: _parse_lineage(lineage, rank) for label, lineage in classes.iter_rows()}
+
+    output_fp = Path(output_fp)
+    os.makedirs(output_fp.parent, exist_ok=True)
+    initial_model = None
+    if resume and output_fp.is_file():
+        initial_model = xgb.Booster(model_file=output_fp)
+        if model_labels(initial_model) != (labels, rank, k):
+            raise ValueError(f"`{output_fp}` was trained on other labels, it can't be resumed on these shards.")
+    done_rounds = initial_model.num_boosted_rounds() if initial_model is not None else 0
+
+    nthread = threads or os.cpu_count() or 1
+    stats = TrainingStats(classes=len(labels), rounds=max(rounds - done_rounds, 0))
+    with tempfile.TemporaryDirectory(prefix="myrio_xgb_", dir=cache_dir) as tmp:
+        _start = time()
+        iterator = KmerShardIter(shard_fps, labels, rank, k, batch_rows, cache_prefix=str(Path(tmp, "cache")))
+        dtrain = xgb.ExtMemQuantileDMatrix(iterator, nthread=nthread)
+        stats.rows, stats.sketch_s = dtrain.num_row(), time() - _start
+
+        params = {
+            "objective": "multi:softprob",
+            "num_class": len(labels),
+            "tree_method": "hist",
+            "max_depth": max_depth,
+            "eta": learning_rate,
+            "nthread": nthread,
+        }
+        attributes = {"labels": json.dumps(labels), "rank": rank, "k": str(k), "lineages": json.dumps(lineages)}
+        checkpoint = _Checkpoint(output_fp, attributes, checkpoint_every, stats.rows, on_round)
+        _start = time()
+        xgb.train(params, dtrain, stats.rounds, xgb_model=initial_model, callbacks=[checkpoint], verbose_eval=False)
+        stats.train_s = time() - _start
+        del dtrain, iterator  # releases the cache files before their directory is removed
+
+    return stats
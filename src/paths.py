@@ -0,0 +1,6 @@
+from pathlib import Path
+
+# The default locations of the sample data, relative to the working directory. Only `pathlib` is imported here so
+# that `cli` can use them as argument defaults without slowing its start-up down.
+DEFAULT_REGISTRY_FP = Path("data", "registry.parquet")
+DEFAULT_MANIFEST_FP = Path("data.csv")
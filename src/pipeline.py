@@ -0,0 +1,461 @@
+import asyncio
+import dataclasses
+import os
+from collections.abc import Callable
+from concurrent.futures import Executor
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+from pathlib import Path
+from time import time
+from typing import Protocol
+
+import aiofiles as aiof
+from safe_result import Err, Ok, Result, ok, safe_async
+
+import fastx
+import utils
+from cache import StageCache
+from consensus import iter_consensus, spoa_consensus
+from database import resolve_database
+from preprocessing import preprocessing, subsample_reads
+from raxtax import Raxtax
+from routing import MarkerRouter, find_primers, load_primers, marker_databases
+from selection import (
+    blast_db_files,
+    cluster_sizes,
+    decontaminate,
+    run_isONclust3,
+    select_clusters,
+)
+from telemetry import Telemetry, file_size
+
+
+class Stage(Protocol):
+    """Handle on a running pipeline stage, clypi's `Spinner` is one."""
+
+    async def done(self, msg: str | None = None) -> None: ...
+
+    async def fail(self, msg: str | None = None) -> None: ...
+
+
+StageFactory = Callable[[str], AbstractAsyncContextManager[Stage]]
+
+
+class _SilentStage:
+    async def done(self, msg: str | None = None) -> None:
+        pass
+
+    async def fail(self, msg: str | None = None) -> None:
+        pass
+
+
+@asynccontextmanager
+async def silent_stage(title: str):
+    """A `StageFactory` that doesn't display anything, used when many samples run at once."""
+    yield _SilentStage()
+
+
+@dataclasses.dataclass
+class PipelineOptions:
+    db_fp: Path = Path("./database/Magnoliopsida_raxdb.fasta")
+    threads: int = os.cpu_count() or 1
+    min_len: int = 150
+    min_qual: float = 10
+    max_qual: float = 60
+    qc: bool = False  # writes the read statistics before and after filtering to `<work_dir>/qc/`, see `QcReport`
+    read_budget: int = 0  # reads sampled (weighted by quality) for clustering, 0 keeps them all
+    saturation_step: int = 0  # with a budget, stops sampling once this many more reads found no new cluster
+    post_cluster: bool = True
+    min_cluster_reads: int = 3
+    max_clusters: int = 0  # only the largest clusters get a consensus, 0 keeps them all
+    min_cluster_support: float = 0.0  # share of the clustered reads a cluster needs to get a consensus
+    second_pass: bool = False
+    max_consensus_reads: int = 0  # only the best reads of larger clusters go to SPOA, 0 uses them all
+    blast_db: Path | None = None  # drops the consensus sequences without a hit in this (plant) BLAST database
+    blast_evalue: float = 1e-5
+    blast_min_identity: float = 0.0
+    model_fp: Path | None = None  # classifies with this k-mer model (see `model.use_model`) instead of raxtax
+    route_markers: bool = True  # classifies against the per-marker databases next to `db_fp` when there are some
+    primers_fp: Path | None = None  # defaults to the `primer_info.csv` of the sample's expedition
+    pipelined: bool = True  # classifies the consensus sequences while the others are still being generated
+    raxtax_batch_size: int = 16
+    executor: Executor | None = None  # a running worker pool for the consensus, kept warm by the server
+    cache: StageCache = dataclasses.field(default_factory=lambda: StageCache(enabled=False))
+
+
+def _marker_router(input_fp: Path, options: PipelineOptions) -> MarkerRouter | None:
+    databases = marker_databases(options.db_fp) if options.route_markers else {}
+    if not databases:
+        return None
+    primers_fp = options.primers_fp or find_primers(input_fp)
+    return MarkerRouter(databases, load_primers(primers_fp) if primers_fp is not None else None)
+
+
+class _Classifier:
+    """Classifies sequences with raxtax, against the database of their marker when a router is given.
+
+    Every database gets its own queue drained by `Raxtax.build_stream`, so the databases are searched in parallel.
+    The outputs are merged into `<work_dir>/raxtax.tsv`.
+    """
+
+    def __init__(self, db_fp: Path, router: MarkerRouter | None, work_dir: Path):
+        self.db_fp = db_fp
+        self.router = router
+        self.work_dir = work_dir
+        self.started = False
+        self._queues: dict[str, asyncio.Queue[tuple[str, str] | None]] = {}
+        self._tasks: dict[str, asyncio.Task[Result[Raxtax, Exception]]] = {}
+        self._counts: dict[str, int] = {}
+
+    def databases(self) -> list[Path]:
+        """The (resolved) per-marker databases sequences may be routed to."""
+        return [resolve_database(fp) for fp in self.router.databases.values()] if self.router else []
+
+    def put(self, sequence: tuple[str, str], batch_size: int):
+        self.started = True
+        marker = self.router.route(sequence[1]) if self.router is not None else None
+        name = marker.value if marker is not None else "all"
+        if name not in self._queues:
+            db_fp = resolve_database(self.router.databases[marker]) if self.router and marker else self.db_fp
+            output_dir = Path(self.work_dir, f"raxtax_{name}")
+            self._queues[name] = asyncio.Queue()
+            self._tasks[name] = asyncio.create_task(
+                Raxtax.build_stream(self._queues[name], db_fp, output_dir, batch_size=batch_size)
+            )
+        self._queues[name].put_nowait(sequence)
+        self._counts[name] = self._counts.get(name, 0) + 1
+
+    def close(self):
+        for queue in self._queues.values():
+            queue.put_nowait(None)
+
+    def cancel(self):
+        for task in self._tasks.values():
+            task.cancel()
+
+    def summary(self) -> str:
+        return ", ".join(f"{name}: {count}" for name, count in sorted(self._counts.items()))
+
+    @safe_async
+    async def result(self) -> Raxtax:
+        names = list(self._tasks)
+        for result in await asyncio.gather(*self._tasks.values()):
+            result.unwrap()
+        output_fp = Path(self.work_dir, "raxtax.tsv")
+        await Raxtax.merge_tsv([Path(self.work_dir, f"raxtax_{name}", "raxtax.tsv") for name in names], output_fp)
+        return (await Raxtax.from_tsv(output_fp)).unwrap()
+
+
+@safe_async
+async def run_pipeline(
+    input_fp: Path,
+    work_dir: Path,
+    options: PipelineOptions,
+    stage: StageFactory = silent_stage,
+    telemetry: Telemetry | None = None,
+    sample: str | None = None,
+    prefiltered: bool = False,
+) -> Raxtax:
+    """Runs every stage of the pipeline on a single sample.
+
+    Args:
+        input_fp (Path): The raw reads fastq filepath.
+        work_dir (Path): Directory for the intermediate files, usually a temporary directory.
+        options (PipelineOptions): The pipeline options.
+        stage (StageFactory, optional): Creates the handle reporting the progress of each stage. Defaults to
+            `silent_stage`.
+        telemetry (Telemetry | None, optional): Records the performance metrics of every stage. Defaults to None.
+        sample (str | None, optional): The sample name reported in the metrics. Defaults to the input file name.
+        prefiltered (bool, optional): The reads were already filtered (e.g. by `watch`), the pipeline starts at
+            the subsampling or clustering. Defaults to False.
+
+    Returns:
+        A result containing the (sorted) raxtax results if successful.
+    """
+    cache = options.cache
+    telemetry = telemetry or Telemetry()
+    sample = sample or input_fp.name.split(".")[0]
+
+    if prefiltered:
+        filtered_reads_fp, n_filtered_reads = input_fp, fastx.count_records(input_fp)
+        preprocessing_key = await cache.key("preprocessing", [input_fp], {"prefiltered": True}, tools=[])
+    else:
+        _start = time()
+        async with (
+            stage("Pre-processing reads") as spin,
+            telemetry.measure(sample, input_fp, "preprocessing") as metrics,
+        ):
+            filtered_reads_fp = Path(work_dir, "reads.fastq")
+            params = {"min_len": options.min_len, "min_qual": options.min_qual, "max_qual": options.max_qual}
+            preprocessing_key = await cache.key("preprocessing", [input_fp], params, tools=[])
+            qc_key = await cache.key("qc", [preprocessing_key], {}, tools=[]) if options.qc else None
+            cached = counts = cache.restore(preprocessing_key, work_dir)
+            if cached is not None and qc_key is not None and cache.restore(qc_key, work_dir) is None:
+                cached = None  # the QC statistics are collected while filtering, it costs no more than reading them
+            if cached is None:
+                result = await preprocessing(
+                    input_fp, filtered_reads_fp, max_workers=options.threads, qc=options.qc, **params
+                )
+                if not ok(result):
+                    await spin.fail()
+                    result.unwrap()
+                stats = result.unwrap()
+                counts = {"reads_in": stats.n_reads, "reads_out": stats.n_passed}
+                cache.store(preprocessing_key, work_dir, [filtered_reads_fp], meta=counts)
+                if qc_key is not None and stats.qc is not None:
+                    cache.store(qc_key, work_dir, await asyncio.to_thread(stats.qc.write, Path(work_dir, "qc")))
+            metrics.cached = cached is not None
+            metrics.reads_in, metrics.reads_out = counts.get("reads_in"), counts.get("reads_out")
+            n_filtered_reads = metrics.reads_out
+            metrics.bytes_in, metrics.bytes_out = file_size(input_fp), file_size(filtered_reads_fp)
+            _diff = time() - _start
+            await spin.done(f"Pre-processing reads → {_diff:.3f} s{' (cached)' if cached is not None else ''}")
+
+    reads_fp, reads_key, n_reads = filtered_reads_fp, preprocessing_key, n_filtered_reads
+    if options.read_budget > 0:
+        _start = time()
+        async with stage("Subsampling reads") as spin, telemetry.measure(sample, input_fp, "subsampling") as metrics:
+            reads_fp = Path(work_dir, "sampled_reads.fastq")
+            params = {"budget": options.read_budget, "saturation_step": options.saturation_step}
+            if options.saturation_step > 0:
+                params["min_cluster_reads"] = options.min_cluster_reads
+            reads_key = await cache.key("subsampling", [preprocessing_key], params, tools=[])
+            cached = counts = cache.restore(reads_key, work_dir)
+            if cached is None:
+                result = await asyncio.to_thread(
+                    subsample_reads,
+                    filtered_reads_fp,
+                    reads_fp,
+                    options.read_budget,
+                    options.saturation_step,
+                    options.min_cluster_reads,
+                )
+                if not ok(result):
+                    await spin.fail()
+                    result.unwrap()
+                stats = result.unwrap()
+                counts = {"reads_in": stats.n_reads, "reads_out": stats.n_sampled, "clusters": stats.n_clusters}
+                cache.store(reads_key, work_dir, [reads_fp], meta=counts)
+            metrics.cached = cached is not None
+            metrics.reads_in, metrics.reads_out = counts.get("reads_in"), counts.get("reads_out")
+            metrics.clusters = counts.get("clusters")
+            n_reads = metrics.reads_out
+            metrics.bytes_in, metrics.bytes_out = file_size(filtered_reads_fp), file_size(reads_fp)
+            _diff = time() - _start
+            await spin.done(
+                f"Subsampling reads → {_diff:.3f} s, kept {n_reads} of {metrics.reads_in} reads"
+                + (" (cached)" if cached is not None else "")
+            )
+
+    _start = time()
+    cluster_fps: list[Path] = []
+    async with stage("Clustering reads") as spin, telemetry.measure(sample, input_fp, "clustering") as metrics:
+        params = {"post_cluster": options.post_cluster, "n": options.min_cluster_reads}
+        clustering_key = await cache.key("clustering", [reads_key], params, tools=["isONclust3"])
+        cached = cache.restore(clustering_key, work_dir)
+        if cached is not None:
+            cluster_fps.extend(Path(work_dir, fp) for fp in cached["clusters"])
+        else:
+            result = await run_isONclust3(reads_fp, work_dir, options.post_cluster, options.min_cluster_reads)
+            match result:
+                case Ok(fps):
+                    cluster_fps.extend(fps)
+                    clusters = [str(fp.relative_to(work_dir)) for fp in fps]
+                    cache.store(clustering_key, work_dir, fps, meta={"clusters": clusters})
+                case Err(error):
+                    await spin.fail()
+                    raise error
+        metrics.cached = cached is not None
+        sizes = cluster_sizes(cluster_fps)
+        metrics.reads_in, metrics.reads_out = n_reads, sum(size for _, size in sizes)
+        n_clustered_reads = metrics.reads_out
+        metrics.clusters = len(cluster_fps)
+        metrics.bytes_in, metrics.bytes_out = file_size(reads_fp), file_size(*cluster_fps)
+        _diff = time() - _start
+        await spin.done(
+            msg=f"Clustering reads → {_diff:.3f} s, got {len(cluster_fps)} clusters"
+            + (" (cached)" if cached is not None else "")
+        )
+
+    selecting = options.max_clusters > 0 or options.min_cluster_support > 0
+    if selecting:
+        _start = time()
+        async with stage("Selecting clusters") as spin, telemetry.measure(sample, input_fp, "selection") as metrics:
+            # Largest first, the consensus stage gets them in that order
+            selected = select_clusters(sizes, options.max_clusters, options.min_cluster_support)
+            metrics.reads_in, metrics.reads_out = n_clustered_reads, sum(size for _, size in selected)
+            metrics.clusters = len(selected)
+            metrics.bytes_in, metrics.bytes_out = file_size(*cluster_fps), file_size(*(fp for fp, _ in selected))
+            n_clusters, cluster_fps = len(cluster_fps), [cluster_fp for cluster_fp, _ in selected]
+            n_clustered_reads = metrics.reads_out
+            _diff = time() - _start
+            await spin.done(f"Selecting clusters → {_diff:.3f} s, kept {len(cluster_fps)} of {n_clusters} clusters")
+
+    _start = time()
+    consensus_fp = Path(work_dir, "consensus.fasta")
+    db_fp = resolve_database(options.db_fp)  # the compiled binary when it's up to date
+    router = _marker_router(input_fp, options)
+    classifier = _Classifier(db_fp, router, work_dir)
+    async with stage("Generating consensus") as spin, telemetry.measure(sample, input_fp, "consensus") as metrics:
+        params = {"second_pass": options.second_pass}
+        if selecting:
+            params |= {"max_clusters": options.max_clusters, "min_support": options.min_cluster_support}
+        if options.max_consensus_reads > 0:
+            params["max_reads"] = options.max_consensus_reads
+        consensus_key = await cache.key("consensus", [clustering_key], params, tools=["pyspoa"])
+        cached = counts = cache.restore(consensus_key, work_dir)
+        decontamination_key = None
+        if options.blast_db is not None:
+            params = {"evalue": options.blast_evalue, "min_identity": options.blast_min_identity}
+            inputs = [consensus_key, *blast_db_files(options.blast_db)]
+            decontamination_key = await cache.key("decontamination", inputs, params, tools=["blastn"])
+        params = {"primers": {marker.value: pair for marker, pair in router.primers.items()}} if router else {}
+        inputs = [decontamination_key or consensus_key, db_fp, *classifier.databases()]
+        raxtax_key = await cache.key("raxtax", inputs, params, ["raxtax"])
+        # Only the sequences kept by the decontamination can be classified, it needs all of them first
+        pipelined = options.pipelined and decontamination_key is None and options.model_fp is None
+        if cached is None and pipelined and not cache.contains(raxtax_key):
+            # Every consensus goes to raxtax as soon as it is ready, classified in micro-batches in the background
+            sequences: list[tuple[str, str]] = []
+            try:
+                async for sequence in iter_consensus(
+                    cluster_fps,
+                    options.second_pass,
+                    max(options.threads, 1),
+                    options.max_consensus_reads,
+                    executor=options.executor,
+                ):
+                    sequences.append(sequence)
+                    classifier.put(sequence, batch_size=options.raxtax_batch_size)
+            except BaseException:
+                classifier.cancel()
+                await spin.fail()
+                raise
+            classifier.close()
+
+            # Same file as without pipelining, in cluster order
+            order = {cluster_fp.name: i for i, cluster_fp in enumerate(cluster_fps)}
+            sequences.sort(key=lambda sequence: order[sequence[0]])
+            string = "\n".join([f">{id}\n{seq}" for (id, seq) in sequences])
+            async with aiof.open(consensus_fp, "w") as file:
+                _ = await file.write(string)
+            counts = {"sequences": len(sequences)}
+            cache.store(consensus_key, work_dir, [consensus_fp], meta=counts)
+        elif cached is None:
+            # spoa_consensus runs the clusters in its own worker processes, the thread only waits on them.
+            # This keeps SPOA fully outside the main Python process, so our spinner doesn't freeze.
+            result = await asyncio.to_thread(
+                spoa_consensus,
+                cluster_fps,
+                options.second_pass,
+                max_workers=max(options.threads, 1),
+                max_reads=options.max_consensus_reads,
+                executor=options.executor,
+            )
+            match result:
+                case Ok(sequences):
+                    string = "\n".join([f">{id}\n{seq}" for (id, seq) in sequences])
+                    async with aiof.open(consensus_fp, "w") as file:
+                        _ = await file.write(string)
+                    counts = {"sequences": len(sequences)}
+                    cache.store(consensus_key, work_dir, [consensus_fp], meta=counts)
+                case Err(error):
+                    await spin.fail()
+                    raise error
+        metrics.cached = cached is not None
+        metrics.clusters = len(cluster_fps)
+        metrics.reads_in = n_clustered_reads
+        metrics.reads_out = n_sequences = counts.get("sequences")
+        metrics.bytes_in, metrics.bytes_out = file_size(*cluster_fps), file_size(consensus_fp)
+        _diff = time() - _start
+        await spin.done(f"Generating consensus → {_diff:.3f} s{' (cached)' if cached is not None else ''}")
+
+    classify_fp = consensus_fp
+    if decontamination_key is not None:
+        _start = time()
+        async with (
+            stage("Decontaminating") as spin,
+            telemetry.measure(sample, input_fp, "decontamination") as metrics,
+        ):
+            classify_fp, blast_fp = Path(work_dir, "decontaminated.fasta"), Path(work_dir, "blast.tsv")
+            cached = counts = cache.restore(decontamination_key, work_dir)
+            if cached is None:
+                result = await decontaminate(
+                    consensus_fp,
+                    options.blast_db,
+                    classify_fp,
+                    blast_fp,
+                    threads=max(options.threads, 1),
+                    evalue=options.blast_evalue,
+                    min_identity=options.blast_min_identity,
+                )
+                if not ok(result):
+                    await spin.fail()
+                    result.unwrap()
+                counts = {"sequences": result.unwrap().height}
+                cache.store(decontamination_key, work_dir, [classify_fp, blast_fp], meta=counts)
+            metrics.cached = cached is not None
+            metrics.reads_in, metrics.reads_out = n_sequences, counts.get("sequences")
+            metrics.bytes_in, metrics.bytes_out = file_size(consensus_fp), file_size(classify_fp)
+            n_sequences = metrics.reads_out
+            if not n_sequences:
+                await spin.fail()
+                raise RuntimeError("No consensus sequence matched the BLAST database, the sample may be contaminated.")
+            _diff = time() - _start
+            await spin.done(
+                f"Decontaminating → {_diff:.3f} s, kept {n_sequences} of {metrics.reads_in} sequences"
+                + (" (cached)" if cached is not None else "")
+            )
+
+    """ TODO
+    async with stage("Assessing quality") as spin:
+        await asyncio.sleep(1.0)
+        await spin.done()
+    """
+
+    if options.model_fp is not None:
+        # Only imported when used, xgboost is slow to load
+        from model import use_model
+
+        _start = time()
+        async with stage("Classifying with the model") as spin, telemetry.measure(sample, input_fp, "model") as metrics:
+            # A single batched prediction over every sequence, fast enough not to be cached
+            match await asyncio.to_thread(use_model, options.model_fp, classify_fp, options.threads):
+                case Ok(raxtax):
+                    metrics.reads_in, metrics.reads_out = n_sequences, raxtax.df.height
+                    metrics.bytes_in = file_size(classify_fp)
+                    _diff = time() - _start
+                    await spin.done(f"Classifying with the model → {_diff:.3f} s")
+                case Err(error):
+                    await spin.fail()
+                    raise error
+        return raxtax
+
+    _start = time()
+    async with stage("Running raxtax") as spin, telemetry.measure(sample, input_fp, "raxtax") as metrics:
+        cached = cache.restore(raxtax_key, work_dir)
+        if cached is not None:
+            result = await Raxtax.from_tsv(Path(work_dir, "raxtax.tsv"))
+        else:
+            if not classifier.started:
+                # Everything at once, a single raxtax run per database
+                for sequence in utils.read_fasta(classify_fp):
+                    classifier.put(sequence, batch_size=max(n_sequences or 0, 1))
+                classifier.close()
+            # When pipelined, only the batches still running when the consensus finished are left
+            result = await classifier.result()
+        match result:
+            case Ok(val):
+                raxtax = val
+                if cached is None:
+                    cache.store(raxtax_key, work_dir, [Path(work_dir, "raxtax.tsv")])
+                metrics.cached = cached is not None
+                metrics.reads_in, metrics.reads_out = n_sequences, raxtax.df.height
+                metrics.bytes_in, metrics.bytes_out = file_size(classify_fp), file_size(Path(work_dir, "raxtax.tsv"))
+                _diff = time() - _start
+                routed = f", {classifier.summary()}" if router is not None and cached is None else ""
+                await spin.done(f"Running raxtax → {_diff:.3f} s{routed}{' (cached)' if cached is not None else ''}")
+            case Err(error):
+                await spin.fail()
+                raise error
+
+    return raxtax
@@ -1,13 +1,21 @@
 import asyncio as aio
+import dataclasses
+import json
 import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
 from types import NoneType
 
+import numpy as np
 import polars as pl
-from Bio import SeqIO
-from safe_result import Err, Ok, Result, safe_async
+from safe_result import Err, Ok, Result, safe, safe_async
 
+import fastx
 import utils
+from qc import QcReport
+
+_CHUNK_SIZE = 1 << 24
 
 
 def read_check(input_fastq: Path, threshold: int = 10) -> Result[NoneType, ValueError]:
@@ -15,8 +23,8 @@ def read_check(input_fastq: Path, threshold: int = 10) -> Result[NoneType, Value
     Check if the FASTQ file has enough reads.
     """
     n = 0
-    for _ in SeqIO.parse(input_fastq, "fastq"):
-        n += 1
+    for batch in fastx.read_batches(input_fastq, "fastq"):
+        n += len(batch)
         if n >= threshold:
             return Ok(None)
 
@@ -41,9 +49,238 @@ async def run_seqkit(
     return results
 
 
+@dataclasses.dataclass
+class FilterStats:
+    n_reads: int = 0
+    n_passed: int = 0
+    qc: QcReport | None = None  # the read statistics before and after filtering, only when requested
+
+
+def _filter_chunk(
+    chunk: bytes, min_len: int, min_qual: float, max_qual: float, qc: bool = False
+) -> tuple[int, int, bytes, QcReport | None]:
+    """Filters a block of whole FASTQ records, the same way `seqkit seq -m -Q -R` does.
+
+    Returns:
+        The number of records in the block, the number that passed, the passing records, ready to be written, and
+        the read statistics of the block when `qc` is set.
+    """
+    batch = fastx.parse_chunk(chunk, "fastq")
+    lengths = batch.lengths()
+    keep = lengths >= min_len
+
+    avg_qual = batch.mean_qualities() if min_qual > 0 or max_qual > 0 or qc else None
+    if avg_qual is not None and min_qual > 0:
+        keep &= avg_qual >= min_qual
+    if avg_qual is not None and max_qual > 0:
+        keep &= avg_qual < max_qual
+
+    indices = np.flatnonzero(keep)
+    report = None
+    if qc:
+        report = QcReport()
+        report.raw.update(lengths, avg_qual)
+        report.filtered.update(lengths[indices], avg_qual[indices])  # type: ignore[index]
+    return len(batch), len(indices), batch.to_fastq(indices.tolist()), report
+
+
+@safe
+def filter_reads(
+    input_fastq: Path,
+    output_fastq: Path,
+    min_len: int = 150,
+    min_qual: float = 10,
+    max_qual: float = 60,
+    threshold: int = 10,
+    max_workers: int = 1,
+    qc: bool = False,
+) -> FilterStats:
+    """Filters reads on their length and mean quality in a single streaming pass, replacing `run_seqkit`.
+
+    The semantics follow `seqkit seq`: reads are kept if `length >= min_len`, `mean quality >= min_qual` and
+    `mean quality < max_qual`, where the mean quality is computed from the mean error probability. A limit
+    `<= 0` is disabled (seqkit uses `-1`).
+
+    Args:
+        input_fastq (Path): The raw reads, 4 lines per record.
+        output_fastq (Path): Where the filtered reads are written.
+        min_len (int, optional): Minimum read length. Defaults to 150.
+        min_qual (float, optional): Minimum mean quality. Defaults to 10.
+        max_qual (float, optional): Maximum mean quality (exclusive). Defaults to 60.
+        threshold (int, optional): Minimum number of reads the input must contain, same as `read_check`.
+            Defaults to 10.
+        max_workers (int, optional): Number of worker processes filtering the chunks. Defaults to 1.
+        qc (bool, optional): Also collects the length and quality distributions of the reads before and after
+            filtering (see `qc.QcReport`), from the records already in memory. Defaults to False.
+
+    Returns:
+        A result containing the number of input and passing reads, and their statistics with `qc`, if successful.
+    """
+    stats = FilterStats(qc=QcReport() if qc else None)
+    chunks = fastx.iter_chunks(input_fastq, "fastq")
+
+    with open(output_fastq, "wb") as output:
+
+        def write(n_reads: int, n_passed: int, passed: bytes, report: QcReport | None):
+            stats.n_reads += n_reads
+            stats.n_passed += n_passed
+            if stats.qc is not None and report is not None:
+                stats.qc.merge(report)
+            output.write(passed)
+
+        if max_workers <= 1 or input_fastq.stat().st_size <= _CHUNK_SIZE:
+            for chunk in chunks:
+                write(*_filter_chunk(chunk, min_len, min_qual, max_qual, qc))
+        else:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                # A bounded window of chunks in flight keeps the memory flat, results are written in input order
+                pending: deque[Future[tuple[int, int, bytes, QcReport | None]]] = deque()
+                for chunk in chunks:
+                    pending.append(executor.submit(_filter_chunk, chunk, min_len, min_qual, max_qual, qc))
+                    while len(pending) >= 2 * max_workers or (pending and pending[0].done()):
+                        write(*pending.popleft().result())
+                while pending:
+                    write(*pending.popleft().result())
+
+    if stats.n_reads < threshold:
+        os.remove(output_fastq)
+        raise ValueError(f"FASTQ file contains `{stats.n_reads}` reads, expected `>{threshold}` reads.")
+
+    return stats
+
+
+@dataclasses.dataclass
+class SubsampleStats:
+    n_reads: int = 0
+    n_sampled: int = 0
+    n_clusters: int | None = None  # estimated while sampling, only when stopping at saturation
+
+
+# Multipliers of the hash functions of the MinHash sketches, odd so that they are bijective on 64 bits
+_SKETCH_SEEDS = np.random.default_rng(0).integers(1, 1 << 62, size=32, dtype=np.uint64) | np.uint64(1)
+
+
+def _sketch(sequence: bytes, k: int) -> np.ndarray | None:
+    """MinHash sketch of the canonical k-mers of a read, the share of equal values estimates the Jaccard index."""
+    kmers = utils.canonical_kmer_codes(sequence.decode("ascii"), k).astype(np.uint64)
+    if len(kmers) == 0:
+        return None
+    hashes = kmers[:, None] * _SKETCH_SEEDS[None, :]
+    hashes ^= hashes >> np.uint64(29)
+    return hashes.min(axis=0)
+
+
+def _saturation_point(
+    sequences: list[bytes], step: int, min_cluster_reads: int, k: int, min_similarity: float
+) -> tuple[int, int]:
+    """Greedily clusters reads until a whole `step` of them doesn't complete a new cluster of `min_cluster_reads`.
+
+    Every read joins the most similar cluster representative (its first read) when their estimated Jaccard index
+    is at least `min_similarity`, it becomes a new representative otherwise. This is a rough stand-in for
+    isONclust3, only meant to tell when more reads stop revealing new clusters.
+
+    Returns:
+        The number of reads to keep and the number of clusters found in them.
+    """
+    representatives = np.empty((len(sequences), len(_SKETCH_SEEDS)), dtype=np.uint64)
+    sizes = np.zeros(len(sequences), dtype=np.int64)
+    n_representatives, n_clusters, last_new = 0, 0, -1
+    for i, sequence in enumerate(sequences):
+        sketch = _sketch(sequence, k)
+        if sketch is not None:
+            similarities = (representatives[:n_representatives] == sketch).mean(axis=1)
+            j = int(similarities.argmax()) if n_representatives > 0 else -1
+            if j < 0 or similarities[j] < min_similarity:
+                j, n_representatives = n_representatives, n_representatives + 1
+                representatives[j] = sketch
+            sizes[j] += 1
+            if sizes[j] == min_cluster_reads:
+                n_clusters, last_new = n_clusters + 1, i
+        if (i + 1) % step == 0 and last_new < i + 1 - step:
+            return i + 1, n_clusters
+    return len(sequences), n_clusters
+
+
+@safe
+def subsample_reads(
+    input_fastq: Path,
+    output_fastq: Path,
+    budget: int,
+    saturation_step: int = 0,
+    min_cluster_reads: int = 3,
+    k: int = 8,
+    min_similarity: float = 0.2,
+    seed: int = 0,
+) -> SubsampleStats:
+    """Keeps at most `budget` reads for clustering, drawn with a probability proportional to their mean quality.
+
+    This is a weighted reservoir sampling (Efraimidis & Spirakis): every read gets the key `u^(1/w)`, `u` uniform
+    and `w` its mean quality, and the `budget` largest keys are kept. The input is streamed in chunks, only the
+    reservoir stays in memory. The sampled reads are written in their input order.
+
+    Since any prefix of the reservoir ranked by key is itself a weighted sample, `saturation_step` can shrink it:
+    the ranked reads are added `saturation_step` at a time, and only as long as the last ones still revealed new
+    clusters (see `_saturation_point`).
+
+    Args:
+        input_fastq (Path): The filtered reads, 4 lines per record.
+        output_fastq (Path): Where the sampled reads are written.
+        budget (int): Maximum number of reads kept.
+        saturation_step (int, optional): Reads added at once while new clusters appear, 0 keeps the whole budget.
+            Defaults to 0.
+        min_cluster_reads (int, optional): Reads a cluster needs to count as new, usually the `--n` of isONclust3.
+            Defaults to 3.
+        k (int, optional): The k-mer size of the similarity between reads. Defaults to 8.
+        min_similarity (float, optional): Estimated Jaccard index for two reads to be clustered together. Defaults
+            to 0.2.
+        seed (int, optional): Seed of the sampling, so that it is reproducible. Defaults to 0.
+
+    Returns:
+        A result containing the number of input and sampled reads if successful.
+    """
+    if budget < 1:
+        raise ValueError(f"The read budget must be positive, got `{budget}`.")
+
+    rng = np.random.default_rng(seed)
+    stats = SubsampleStats()
+    keys = np.empty(0, dtype=np.float64)
+    indices = np.empty(0, dtype=np.int64)
+    records: list[bytes] = []
+    for batch in fastx.read_batches(input_fastq, "fastq"):
+        n_records = len(batch)
+        # log(u^(1/w)) ranks the same as u^(1/w) without underflowing, reads of quality 0 keep a tiny chance
+        weights = np.maximum(batch.mean_qualities(), 1e-3)
+        chunk_keys = np.log1p(-rng.random(n_records)) / weights
+        candidates = np.arange(n_records)
+        if len(keys) >= budget:
+            candidates = np.flatnonzero(chunk_keys > keys.min())
+
+        keys = np.concatenate([keys, chunk_keys[candidates]])
+        indices = np.concatenate([indices, candidates + stats.n_reads])
+        records.extend(batch.to_fastq([i]) for i in candidates.tolist())
+        if len(keys) > budget:
+            keep = np.argpartition(-keys, budget - 1)[:budget]
+            keys, indices, records = keys[keep], indices[keep], [records[i] for i in keep]
+        stats.n_reads += n_records
+
+    ranked = np.argsort(-keys, kind="stable")
+    if saturation_step > 0:
+        sequences = [records[i].split(b"\n", 2)[1] for i in ranked]
+        n_kept, stats.n_clusters = _saturation_point(sequences, saturation_step, min_cluster_reads, k, min_similarity)
+        ranked = ranked[:n_kept]
+
+    selected = ranked[np.argsort(indices[ranked], kind="stable")]
+    with open(output_fastq, "wb") as output:
+        output.writelines(records[i] for i in selected)
+    stats.n_sampled = len(selected)
+    return stats
+
+
 async def run_nanoplot(input_fastq: Path, output_dir: Path) -> Result[NoneType, Exception]:
     """Runs NanoPlot to generate quality and length distribution graphs from a FASTQ file.
 
+    NanoPlot is slow to start and to plot, the `qc` statistics (see `filter_reads`) cover routine runs.
+
     Parameters:
         input_fastq (Path): Path to the FASTQ file.
         output_dir (Path): Directory where NanoPlot outputs will be saved.
@@ -67,9 +304,20 @@ async def run_nanoplot(input_fastq: Path, output_dir: Path) -> Result[NoneType,
 
 
 @safe_async
-async def preprocessing(input_fastq: Path, output_fastq: Path) -> None:
-    read_check(input_fastq).unwrap()
-    (await run_seqkit(input_fastq, output_fastq)).unwrap()
+async def preprocessing(
+    input_fastq: Path,
+    output_fastq: Path,
+    min_len: int = 150,
+    min_qual: float = 10,
+    max_qual: float = 60,
+    max_workers: int = 1,
+    qc: bool = False,
+) -> FilterStats:
+    """Checks the number of reads and filters them, in a single pass over `input_fastq`."""
+    result = await aio.to_thread(
+        filter_reads, input_fastq, output_fastq, min_len, min_qual, max_qual, max_workers=max_workers, qc=qc
+    )
+    return result.unwrap()
 
 
 async def main():
@@ -78,9 +326,9 @@ async def main():
     marker = utils.Markers.ITS
 
     output_base = Path(f"output/{species}/")
-    output_nanoplot = Path(output_base, "nanoplot/")
-    os.makedirs(output_nanoplot, exist_ok=True)
+    os.makedirs(output_base, exist_ok=True)
     output_filtered_reads = Path(output_base, "filtered_reads.fastq")
+    full_plots = False  # NanoPlot's plots, the QC summary is enough for routine runs
 
     fastq = (
         data_df.filter((pl.col("name") == species) & (pl.col(marker.value) == True) & (pl.col("reference") == False))  # noqa: E712
@@ -90,10 +338,15 @@ async def main():
 
     fastq = Path(fastq)
 
-    # visualization and preprocessing
-    (await run_nanoplot(fastq, output_dir=output_nanoplot)).unwrap()
-    await preprocessing(fastq, output_filtered_reads)
-    (await run_nanoplot(output_filtered_reads, output_dir=output_nanoplot)).unwrap()
+    # preprocessing and QC statistics, in the same pass
+    stats = (await preprocessing(fastq, output_filtered_reads, qc=True)).unwrap()
+    stats.qc.write(Path(output_base, "qc"))
+    print(json.dumps({"raw": stats.qc.raw.summary(), "filtered": stats.qc.filtered.summary()}, indent=2))
+
+    if full_plots:
+        output_nanoplot = Path(output_base, "nanoplot/")
+        (await run_nanoplot(fastq, output_dir=output_nanoplot)).unwrap()
+        (await run_nanoplot(output_filtered_reads, output_dir=output_nanoplot)).unwrap()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,180 @@
+import dataclasses
+import json
+from os import PathLike
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import polars as pl
+
+import fastx
+
+QC_JSON = "qc.json"
+QC_PARQUET = "qc.parquet"
+
+_QUALITY_BINS = 94  # mean qualities are binned by whole phred scores, phred+33 can't go past 93
+_LENGTH_BIN = 100  # width of the length histogram bins of the JSON summary, the parquet keeps exact lengths
+
+
+@dataclasses.dataclass
+class ReadStats:
+    """Streaming accumulator of the read length and mean quality distributions of a set of reads.
+
+    The lengths are counted exactly (one counter per length, grown on demand) so that the N50 and median are exact,
+    the mean qualities are counted by whole phred score. Accumulators of different chunks can be merged.
+    """
+
+    reads: int = 0
+    bases: int = 0
+    quality_sum: float = 0.0
+    length_counts: np.ndarray = dataclasses.field(default_factory=lambda: np.zeros(0, dtype=np.int64))
+    quality_counts: np.ndarray | None = None  # None as long as only FASTA records were added
+
+    def update(self, lengths: np.ndarray, mean_qualities: np.ndarray | None = None):
+        """Adds a batch of reads, see `FastxBatch.lengths` and `FastxBatch.mean_qualities`."""
+        if len(lengths) == 0:
+            return
+        self.reads += len(lengths)
+        self.bases += int(lengths.sum())
+        counts = np.bincount(lengths)
+        if len(counts) > len(self.length_counts):
+            self.length_counts = np.pad(self.length_counts, (0, len(counts) - len(self.length_counts)))
+        self.length_counts[: len(counts)] += counts
+        if mean_qualities is not None:
+            self.quality_sum += float(mean_qualities.sum())
+            bins = np.clip(mean_qualities.astype(np.int64), 0, _QUALITY_BINS - 1)
+            self.quality_counts = np.bincount(bins, minlength=_QUALITY_BINS) + (
+                self.quality_counts if self.quality_counts is not None else 0
+            )
+
+    def update_batch(self, batch: fastx.FastxBatch, indices: np.ndarray | None = None):
+        """Adds the records of a batch (or only the ones at `indices`)."""
+        lengths = batch.lengths()
+        qualities = batch.mean_qualities() if batch.qualities is not None else None
+        if indices is not None:
+            lengths = lengths[indices]
+            qualities = qualities[indices] if qualities is not None else None
+        self.update(lengths, qualities)
+
+    def merge(self, other: "ReadStats") -> "ReadStats":
+        """Adds the reads of another accumulator to this one, in place."""
+        self.reads += other.reads
+        self.bases += other.bases
+        self.quality_sum += other.quality_sum
+        size = max(len(self.length_counts), len(other.length_counts))
+        self.length_counts = np.pad(self.length_counts, (0, size - len(self.length_counts)))
+        self.length_counts[: len(other.length_counts)] += other.length_counts
+        if other.quality_counts is not None:
+            self.quality_counts = other.quality_counts + (self.quality_counts if self.quality_counts is not None else 0)
+        return self
+
+    def n50(self) -> int:
+        """The length of the read reaching half of the bases, summing from the longest reads."""
+        if self.bases == 0:
+            return 0
+        lengths = np.arange(len(self.length_counts))[::-1]
+        cumulative_bases = np.cumsum(self.length_counts[::-1] * lengths)
+        return int(lengths[np.searchsorted(cumulative_bases, self.bases / 2)])
+
+    def median_length(self) -> float:
+        """The median read length, the mean of the two middle ones for an even number of reads."""
+        if self.reads == 0:
+            return 0.0
+        cumulative_reads = np.cumsum(self.length_counts)
+        lower = np.searchsorted(cumulative_reads, (self.reads - 1) // 2 + 1)
+        upper = np.searchsorted(cumulative_reads, self.reads // 2 + 1)
+        return (int(lower) + int(upper)) / 2
+
+    def mean_quality(self) -> float | None:
+        """The mean of the per-read mean qualities (seqkit's AvgQual), None for FASTA records."""
+        if self.quality_counts is None or self.reads == 0:
+            return None
+        return self.quality_sum / self.reads
+
+    def summary(self) -> dict[str, Any]:
+        """The yield and distribution statistics, JSON serializable."""
+        mean_quality = self.mean_quality()
+        return {
+            "reads": self.reads,
+            "bases": self.bases,
+            "n50": self.n50(),
+            "mean_length": round(self.bases / self.reads, 3) if self.reads else 0.0,
+            "median_length": self.median_length(),
+            "max_length": int(np.flatnonzero(self.length_counts)[-1]) if self.reads else 0,
+            "mean_quality": round(mean_quality, 3) if mean_quality is not None else None,
+        }
+
+    def histograms(self) -> pl.DataFrame:
+        """The non-empty bins of the length (exact) and mean quality (whole phred scores) histograms."""
+        quality_counts = self.quality_counts if self.quality_counts is not None else np.zeros(0, dtype=np.int64)
+        lengths, qualities = np.flatnonzero(self.length_counts), np.flatnonzero(quality_counts)
+        return pl.DataFrame(
+            {
+                "metric": ["length"] * len(lengths) + ["quality"] * len(qualities),
+                "value": np.concatenate([lengths, qualities]),
+                "count": np.concatenate([self.length_counts[lengths], quality_counts[qualities]]),
+            },
+            schema={"metric": pl.String, "value": pl.Int64, "count": pl.Int64},
+        )
+
+    def binned_lengths(self, width: int = _LENGTH_BIN) -> dict[str, int]:
+        """The length histogram by bins of `width` bases, keyed by their lower bound."""
+        counts = np.add.reduceat(self.length_counts, np.arange(0, len(self.length_counts), width))
+        return {str(i * width): int(count) for i, count in enumerate(counts) if count > 0}
+
+    def binned_qualities(self) -> dict[str, int]:
+        """The mean quality histogram by whole phred scores, empty for FASTA records."""
+        counts = self.quality_counts if self.quality_counts is not None else np.zeros(0, dtype=np.int64)
+        return {str(q): int(count) for q, count in enumerate(counts) if count > 0}
+
+
+def read_stats(filepath: str | PathLike[Any], format: fastx.Format | None = None) -> ReadStats:
+    """The read statistics of a FASTQ or FASTA file (possibly gzipped), in a single streaming pass."""
+    stats = ReadStats()
+    for batch in fastx.read_batches(filepath, format):
+        stats.update_batch(batch)
+    return stats
+
+
+@dataclasses.dataclass
+class QcReport:
+    """The read statistics before and after filtering, see `filter_reads`."""
+
+    raw: ReadStats = dataclasses.field(default_factory=ReadStats)
+    filtered: ReadStats = dataclasses.field(default_factory=ReadStats)
+
+    def merge(self, other: "QcReport") -> "QcReport":
+        self.raw.merge(other.raw)
+        self.filtered.merge(other.filtered)
+        return self
+
+    def summary(self) -> dict[str, Any]:
+        """The compact summary written to `qc.json`: the statistics and binned histograms of both sets of reads."""
+        summary: dict[str, Any] = {}
+        for name, stats in (("raw", self.raw), ("filtered", self.filtered)):
+            summary[name] = {
+                **stats.summary(),
+                "length_histogram": stats.binned_lengths(),
+                "quality_histogram": stats.binned_qualities(),
+            }
+        summary["kept_reads"] = round(self.filtered.reads / self.raw.reads, 6) if self.raw.reads else 0.0
+        summary["kept_bases"] = round(self.filtered.bases / self.raw.bases, 6) if self.raw.bases else 0.0
+        return summary
+
+    def write(self, output_dir: Path) -> list[Path]:
+        """Writes `qc.json` (the summary) and `qc.parquet` (the exact histograms, one row per non-empty bin).
+
+        Returns:
+            The written filepaths.
+        """
+        output_dir.mkdir(parents=True, exist_ok=True)
+        json_fp, parquet_fp = Path(output_dir, QC_JSON), Path(output_dir, QC_PARQUET)
+        with open(json_fp, "w") as file:
+            json.dump(self.summary(), file, indent=2)
+        pl.concat(
+            [
+                stats.histograms().select(pl.lit(name).alias("reads"), pl.all())
+                for name, stats in (("raw", self.raw), ("filtered", self.filtered))
+            ]
+        ).write_parquet(parquet_fp)
+        return [json_fp, parquet_fp]
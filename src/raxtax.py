@@ -1,8 +1,8 @@
+import asyncio
 import dataclasses
 from pathlib import Path
 
 import aiofiles as aiof
-import numpy as np
 import polars as pl
 from safe_result import safe_async
 
@@ -46,7 +46,6 @@ class Raxtax:
             A result containing the RaxtaxResult if successfull.
         """
 
-        raxtax_output = None
         # fmt: off
         command = [
             "raxtax",
@@ -63,42 +62,141 @@ class Raxtax:
         output_fp = Path(output_dir, "raxtax.tsv")
         if not output_fp.exists():
             raise RuntimeError(f"Raxtax seems to have failed, `{output_fp}` does not exist")
-        async with aiof.open(output_fp, "r") as output_file:
-            raxtax_output = await output_file.readlines()
+        return (await Raxtax.from_tsv(output_fp)).unwrap()
 
-        # this is pretty hacky, unsafe even, this requires sequences in the fasta database to look something like the following.
-        # >BOLD_PID=CAATB198-11|MARKER_CODE=rbcL;tax=phylum:Tracheophyta,class:Magnoliopsida,order:Fabales,family:Fabaceae,genus:Bauhinia,species:Bauhinia_cheilantha;
-        # NNNNNNNNNNNNCAAAC...
+    @staticmethod
+    @safe_async
+    async def build_stream(
+        queue: asyncio.Queue[tuple[str, str] | None], db_fp: Path, output_dir: Path, batch_size: int = 16
+    ) -> "Raxtax":
+        """Builds the Raxtax class by classifying query sequences in micro-batches as they come in.
+
+        Every batch gathers the sequences waiting in the queue (at most `batch_size`) and runs raxtax on them, so
+        the batches grow on their own while the producer is faster than raxtax. The outputs of the batches are
+        merged into `<output_dir>/raxtax.tsv`, just like `build` would have written it.
+
+        Args:
+            queue (asyncio.Queue[tuple[str, str] | None]): The `(id, sequence)` pairs to classify, terminated by None.
+            db_fp (Path): The reference fasta/bin filepath.
+            output_dir (Path): Directory for the raxtax outputs.
+            batch_size (int, optional): Maximum number of sequences per raxtax run. Defaults to 16.
+
+        Returns:
+            A result containing the RaxtaxResult if successfull.
+        """
+        tsv_fps: list[Path] = []
+        finished = False
+        while not finished:
+            batch: list[tuple[str, str]] = []
+            while not finished and (not batch or (len(batch) < batch_size and not queue.empty())):
+                item = await queue.get()
+                if item is None:
+                    finished = True
+                else:
+                    batch.append(item)
+            if not batch:
+                break
+
+            batch_dir = Path(output_dir, "raxtax_batches", str(len(tsv_fps)))
+            batch_dir.mkdir(parents=True, exist_ok=True)
+            query_fp = Path(batch_dir, "query.fasta")
+            async with aiof.open(query_fp, "w") as file:
+                await file.write("\n".join(f">{id}\n{seq}" for id, seq in batch))
+            (await Raxtax.build(query_fp, db_fp, batch_dir)).unwrap()
+            tsv_fps.append(Path(batch_dir, "raxtax.tsv"))
 
-        parsed_raxtax_output = []
-        for line in raxtax_output:
-            line = line.split("\t")[0:-1]
+        output_fp = Path(output_dir, "raxtax.tsv")
+        await Raxtax.merge_tsv(tsv_fps, output_fp)
+        return (await Raxtax.from_tsv(output_fp)).unwrap()
+
+    @staticmethod
+    async def merge_tsv(tsv_fps: list[Path], output_fp: Path):
+        """Concatenates raxtax `.tsv` outputs into `output_fp`."""
+        async with aiof.open(output_fp, "wb") as output:
+            for tsv_fp in tsv_fps:
+                async with aiof.open(tsv_fp, "rb") as file:
+                    data = await file.read()
+                await output.write(data if not data or data.endswith(b"\n") else data + b"\n")
+
+    @staticmethod
+    def get_ranks() -> list[str]:
+        return ["phylum", "class", "order", "family", "genus", "species"]
 
-            line[1] = line[1][7:]  # removes "phylum:" prefix
-            line[3] = line[3][6:]  # class
-            line[5] = line[5][6:]  # order
-            line[7] = line[7][7:]  # family
-            line[9] = line[9][6:]  # genus
-            line[11] = line[11][8:]  # species
+    @staticmethod
+    def get_empty_df() -> pl.DataFrame:
+        return pl.DataFrame(
+            schema={column: pl.Float64 if column.endswith("score") else pl.String for column in Raxtax.get_row_schema()}
+        )
+
+    @staticmethod
+    def scan_tsv(output_fp: Path) -> pl.LazyFrame:
+        """Lazily parses a raxtax `.tsv` output, only the selected columns are materialized on collect.
 
-            parsed_raxtax_output.append(np.array(line))
+        The rank columns are expected to be prefixed by their rank name (e.g. `phylum:Tracheophyta`), which is the
+        case when the sequences of the fasta database have headers looking like the following.
+        >BOLD_PID=CAATB198-11|MARKER_CODE=rbcL;tax=phylum:Tracheophyta,class:Magnoliopsida,order:Fabales,family:Fabaceae,genus:Bauhinia,species:Bauhinia_cheilantha;
 
-        df = (
-            pl.DataFrame(parsed_raxtax_output, schema=Raxtax.get_row_schema(), orient="row")
+        Args:
+            output_fp (Path): The `raxtax.tsv` filepath.
+
+        Raises:
+            ValueError: If the columns of the first row don't match the expected schema.
+
+        Returns:
+            pl.LazyFrame: The parsed output, following `get_row_schema`.
+        """
+        schema = Raxtax.get_row_schema()
+        options = {"separator": "\t", "has_header": False, "quote_char": None, "infer_schema": False}
+        try:
+            first_row = pl.read_csv(output_fp, n_rows=1, **options)
+        except pl.exceptions.NoDataError:
+            return Raxtax.get_empty_df().lazy()
+
+        if first_row.width < len(schema):
+            raise ValueError(f"Expected at least {len(schema)} columns in `{output_fp}`, got {first_row.width}.")
+        for i, rank in enumerate(Raxtax.get_ranks()):
+            value = first_row.item(0, 1 + 2 * i)
+            if value is None or not value.startswith(f"{rank}:"):
+                raise ValueError(
+                    f"Expected column {1 + 2 * i} of `{output_fp}` to start with `{rank}:`, got `{value}`."
+                )
+
+        return (
+            pl.scan_csv(output_fp, **options)
+            .select([pl.col(f"column_{i + 1}").alias(column) for i, column in enumerate(schema)])
             .with_columns(
-                pl.col("phylum_score").cast(pl.Float64),
-                pl.col("class_score").cast(pl.Float64),
-                pl.col("order_score").cast(pl.Float64),
-                pl.col("family_score").cast(pl.Float64),
-                pl.col("genus_score").cast(pl.Float64),
-                pl.col("species_score").cast(pl.Float64),
-                pl.col("local_confidence_score").cast(pl.Float64),
-                pl.col("global_confidence_score").cast(pl.Float64),
+                *[pl.col(rank).str.strip_prefix(f"{rank}:") for rank in Raxtax.get_ranks()],
+                *[pl.col(column).cast(pl.Float64) for column in schema if column.endswith("score")],
             )
-            .sort(by="species_score", descending=True)
         )
+
+    @staticmethod
+    @safe_async
+    async def from_tsv(output_fp: Path) -> "Raxtax":
+        """Builds the Raxtax class from an existing raxtax `.tsv` output.
+
+        Args:
+            output_fp (Path): The `raxtax.tsv` filepath.
+
+        Returns:
+            A result containing the RaxtaxResult if successfull.
+        """
+        df = await Raxtax.scan_tsv(output_fp).sort(by="species_score", descending=True).collect_async()
         return Raxtax(df)
 
+    def top_match(self) -> tuple[str | None, float | None]:
+        """The name and score of the best match at the lowest rank it has, None if there is no result.
+
+        That is the species for raxtax, and the rank of the model for a `model.use_model` classification.
+        """
+        if self.df.is_empty():
+            return None, None
+        row = self.df.row(0, named=True)
+        for rank in reversed(Raxtax.get_ranks()):
+            if row[rank] is not None:
+                return row[rank], row[f"{rank}_score"]
+        return None, None
+
     def prettify(self):
         self.df = self.df.with_columns(
             pl.col("phylum").str.replace_all("_", " ").str.to_titlecase(),
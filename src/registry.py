@@ -0,0 +1,179 @@
+import os
+import re
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any
+
+import polars as pl
+
+import fastx
+import qc
+from paths import DEFAULT_REGISTRY_FP
+
+SEQUENCE_SUFFIXES = (".fastq", ".fq", ".fasta", ".fa", ".fastq.gz", ".fq.gz", ".fasta.gz", ".fa.gz")
+
+# The marker columns, named after `utils.Markers`, and how they appear in the sample filepaths
+MARKER_PATTERNS = {
+    "matK": re.compile(r"matk", re.IGNORECASE),
+    "rbcL": re.compile(r"rbcl", re.IGNORECASE),
+    "psbA-trnH": re.compile(r"psba-trnh|trnh-psba", re.IGNORECASE),
+    "ITS": re.compile(r"(?<![a-z])its", re.IGNORECASE),
+}
+_NAME_RE = re.compile(r"[A-Za-z]+_[A-Za-z]+")
+
+REGISTRY_SCHEMA = {
+    "name": pl.String,
+    "reference": pl.Boolean,
+    **{marker: pl.Boolean for marker in MARKER_PATTERNS},
+    "filepath": pl.String,
+    "format": pl.String,
+    "size": pl.Int64,
+    "mtime_ns": pl.Int64,
+    "reads": pl.Int64,
+    "bases": pl.Int64,
+    "n50": pl.Int64,
+    "mean_quality": pl.Float64,  # mean of the per-read mean qualities (seqkit's AvgQual), null for fasta files
+}
+
+
+def file_stats(filepath: Path) -> dict[str, Any]:
+    """Computes the read statistics of a FASTQ or FASTA file (possibly gzipped) in a single streaming pass."""
+    format = fastx.detect_format(filepath)
+    stats = qc.read_stats(filepath, format)
+    return {
+        "format": format,
+        "reads": stats.reads,
+        "bases": stats.bases,
+        "n50": stats.n50(),
+        "mean_quality": stats.mean_quality(),
+    }
+
+
+def _describe(filepath: Path) -> dict[str, Any]:
+    """What the filepath tells about a sample: its species, whether it is a reference and its markers."""
+    name_match = _NAME_RE.search(filepath.name)
+    return {
+        "name": name_match[0] if name_match is not None else "Unknown",
+        "reference": "reference" in filepath.name,
+        **{marker: pattern.search(str(filepath)) is not None for marker, pattern in MARKER_PATTERNS.items()},
+    }
+
+
+def _entry(filepath: Path, stat: os.stat_result) -> dict[str, Any]:
+    return {**_describe(filepath), "filepath": str(filepath), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _with_stats(entry: dict[str, Any]) -> dict[str, Any]:
+    return {**entry, **file_stats(Path(entry["filepath"]))}
+
+
+def scan_directory(data_dir: Path) -> list[Path]:
+    """Every FASTQ and FASTA file under `data_dir`."""
+    return sorted(fp for fp in Path(data_dir).rglob("*") if fp.is_file() and fp.name.endswith(SEQUENCE_SUFFIXES))
+
+
+def load_registry(registry_fp: Path = DEFAULT_REGISTRY_FP) -> pl.DataFrame:
+    """The registry as last written, empty when there is none yet."""
+    if not Path(registry_fp).is_file():
+        return pl.DataFrame(schema=REGISTRY_SCHEMA)
+    return pl.read_parquet(registry_fp)
+
+
+def update_registry(
+    filepaths: Iterable[Path],
+    registry_fp: Path = DEFAULT_REGISTRY_FP,
+    manifest_fp: Path | None = None,
+    max_workers: int = os.cpu_count() or 1,
+) -> pl.DataFrame:
+    """Adds files to the sample registry, a parquet index of the samples and of their read statistics.
+
+    The statistics of a file are only computed when it is new or its size or modification time changed, otherwise
+    the registered ones are kept. Files that no longer exist are dropped from the registry.
+
+    Args:
+        filepaths (Iterable[Path]): The FASTQ and FASTA files to register, see `scan_directory`.
+        registry_fp (Path, optional): The registry parquet filepath. Defaults to `data/registry.parquet`.
+        manifest_fp (Path | None, optional): A csv with the `name`, `reference` and marker columns of some files,
+            they take precedence over what the filepaths tell. `data.csv` is one. Defaults to None.
+        max_workers (int, optional): Number of worker processes computing the statistics. Defaults to the number
+            of cores.
+
+    Returns:
+        The whole registry, one row per file sorted by filepath.
+    """
+    registry = load_registry(registry_fp)
+    known = {row["filepath"]: row for row in registry.iter_rows(named=True) if Path(row["filepath"]).is_file()}
+
+    entries, stale = {}, []
+    for filepath in filepaths:
+        filepath = Path(filepath).resolve()
+        stat = filepath.stat()
+        entry = _entry(filepath, stat)
+        row = known.get(str(filepath))
+        if row is not None and row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns:
+            entries[str(filepath)] = {**row, **entry}
+        else:
+            stale.append(entry)
+
+    if len(stale) > 1 and max_workers > 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(stale))) as executor:
+            entries.update((entry["filepath"], entry) for entry in executor.map(_with_stats, stale))
+    else:
+        entries.update((entry["filepath"], _with_stats(entry)) for entry in stale)
+
+    rows = list({**known, **entries}.values())
+    df = pl.DataFrame(rows, schema=REGISTRY_SCHEMA, orient="row").sort("filepath")
+    if manifest_fp is not None and Path(manifest_fp).is_file():
+        df = _apply_manifest(df, Path(manifest_fp))
+
+    if not df.equals(registry):
+        Path(registry_fp).parent.mkdir(parents=True, exist_ok=True)
+        tmp_fp = Path(registry_fp).with_suffix(f".{os.getpid()}.tmp")
+        df.write_parquet(tmp_fp)
+        os.replace(tmp_fp, registry_fp)
+    return df
+
+
+def _apply_manifest(df: pl.DataFrame, manifest_fp: Path) -> pl.DataFrame:
+    manifest = pl.read_csv(manifest_fp).rename({"matk": "matK"}, strict=False)
+    columns = [column for column in ["name", "reference", *MARKER_PATTERNS] if column in manifest.columns]
+    filepaths = pl.Series("filepath", [str(Path(fp).resolve()) for fp in manifest["filepath"]], dtype=pl.String)
+    manifest = manifest.select(*columns).with_columns(filepaths).unique("filepath", keep="last")
+    return df.update(manifest, on="filepath", how="left")
+
+
+def select_samples(
+    registry: pl.DataFrame,
+    marker: str | None = None,
+    species: str | None = None,
+    min_reads: int = 0,
+    max_reads: int = 0,
+    references: bool = False,
+) -> pl.DataFrame:
+    """Selects the registered samples by marker, species (case-insensitive, partial matches) or number of reads.
+
+    Args:
+        registry (pl.DataFrame): The registry, see `update_registry`.
+        marker (str | None, optional): The marker the samples were amplified for, e.g. `ITS`. Defaults to None.
+        species (str | None, optional): Part of the sample names. Defaults to None.
+        min_reads (int, optional): Minimum number of reads, `0` disables it. Defaults to 0.
+        max_reads (int, optional): Maximum number of reads, `0` disables it. Defaults to 0.
+        references (bool, optional): Selects the reference sequences instead of the samples. Defaults to False.
+
+    Returns:
+        The selected rows of the registry.
+    """
+    predicates = [pl.col("reference") == references]
+    if marker:
+        column = next((column for column in MARKER_PATTERNS if column.lower() == marker.lower()), None)
+        if column is None:
+            raise ValueError(f"Unknown marker `{marker}`, expected one of {', '.join(MARKER_PATTERNS)}.")
+        predicates.append(pl.col(column))
+    if species:
+        predicates.append(pl.col("name").str.to_lowercase().str.contains(species.lower(), literal=True))
+    if min_reads > 0:
+        predicates.append(pl.col("reads") >= min_reads)
+    if max_reads > 0:
+        predicates.append(pl.col("reads") <= max_reads)
+    return registry.filter(predicates)
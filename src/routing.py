@@ -0,0 +1,144 @@
+import functools
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+
+import utils
+from utils import Markers
+
+# IUPAC nucleotide codes as 4-bit masks (A=1, C=2, G=4, T=8)
+_IUPAC_MASKS = np.zeros(256, dtype=np.uint8)
+for _letters, _mask in {
+    "A": 1, "C": 2, "G": 4, "T": 8, "U": 8, "R": 5, "Y": 10, "S": 6, "W": 9, "K": 12, "M": 3,
+    "B": 14, "D": 13, "H": 11, "V": 7, "N": 15,
+}.items():  # fmt: skip
+    _IUPAC_MASKS[ord(_letters)] = _IUPAC_MASKS[ord(_letters.lower())] = _mask
+
+
+def marker_from_name(name: str) -> Markers | None:
+    """Matches a marker name as written in the primer files or the databases (`matk`, `trnH-psbA`, ...)."""
+    parts = frozenset(name.strip().lower().split("-"))
+    return next((marker for marker in Markers.all() if frozenset(marker.value.lower().split("-")) == parts), None)
+
+
+def load_primers(primers_fp: Path) -> dict[Markers, tuple[str, str]]:
+    """Reads the forward and reverse primers of every marker from an expedition `primer_info.csv`."""
+    df = pl.read_csv(primers_fp, infer_schema=False)
+    primers: dict[Markers, tuple[str, str]] = {}
+    for name, fwd, rev in df.select(df.columns[1], "fwd", "rev").iter_rows():
+        marker = marker_from_name(name or "")
+        if marker is not None and fwd and rev:
+            primers[marker] = (fwd.replace(" ", ""), rev.replace(" ", ""))
+    return primers
+
+
+def find_primers(input_fp: Path) -> Path | None:
+    """Looks for the `primer_info.csv` of the expedition a sample belongs to, next to it or in its parents."""
+    for directory in list(Path(input_fp).resolve().parents)[:2]:
+        if Path(directory, "primer_info.csv").is_file():
+            return Path(directory, "primer_info.csv")
+    return None
+
+
+def marker_databases(db_fp: Path) -> dict[Markers, Path]:
+    """Finds the per-marker databases next to a monolithic one (`X_raxdb.fasta` → `X_<marker>_raxdb.fasta`)."""
+    db_fp = Path(db_fp)
+    if "_raxdb" not in db_fp.name:
+        return {}
+
+    databases: dict[Markers, Path] = {}
+    for fasta_fp in db_fp.parent.glob(db_fp.name.replace("_raxdb", "_*_raxdb")):
+        name = fasta_fp.name.removeprefix(db_fp.name.split("_raxdb")[0] + "_").split("_raxdb")[0]
+        marker = marker_from_name(name)
+        if marker is not None:
+            databases[marker] = fasta_fp
+    return databases
+
+
+@functools.cache
+def kmer_profile(fasta_fp: Path, k: int = 8, records: int = 2000) -> np.ndarray:
+    """Which canonical k-mers appear in the first records of a database, kept for the later routers."""
+    profile = np.zeros(4**k, dtype=bool)
+    for _, sequence in islice(utils.read_fasta(fasta_fp), records):
+        profile[utils.canonical_kmer_codes(sequence, k)] = True
+    return profile
+
+
+def _mismatches(sequence: np.ndarray, primer: str) -> int:
+    """The fewest mismatches of an IUPAC primer over every position of a (4-bit masked) sequence."""
+    pattern = _IUPAC_MASKS[np.frombuffer(primer.encode(), dtype=np.uint8)]
+    if len(sequence) < len(pattern):
+        return len(pattern)
+    windows = np.lib.stride_tricks.sliding_window_view(sequence, len(pattern))
+    return int(((windows & pattern) == 0).sum(axis=1).min())
+
+
+class MarkerRouter:
+    """Assigns consensus sequences to the marker they were amplified from, to classify them against its database.
+
+    Sequences are matched against the amplification primers first (either strand, allowing a few mismatches for
+    the sequencing errors left in the consensus). When no primer matches, the share of their canonical k-mers
+    found in a sample of each marker database decides.
+
+    Args:
+        databases (dict[Markers, Path]): The reference fasta of every marker that can be routed to.
+        primers (dict[Markers, tuple[str, str]] | None, optional): The forward and reverse primers of the markers.
+            Defaults to None.
+        max_mismatches (int, optional): Mismatches allowed for a primer to match. Defaults to 3.
+        k (int, optional): The k-mer size of the similarity check. Defaults to 8.
+        min_similarity (float, optional): Share of k-mers a marker database must contain. Defaults to 0.5.
+        profile_records (int, optional): Records of each database sampled for the similarity check. Defaults to
+            2000.
+    """
+
+    def __init__(
+        self,
+        databases: dict[Markers, Path],
+        primers: dict[Markers, tuple[str, str]] | None = None,
+        max_mismatches: int = 3,
+        k: int = 8,
+        min_similarity: float = 0.5,
+        profile_records: int = 2000,
+    ):
+        self.databases = databases
+        # Both primers on both strands
+        self.primers = {
+            marker: [fwd, rev, utils.reverse_complement(fwd), utils.reverse_complement(rev)]
+            for marker, (fwd, rev) in (primers or {}).items()
+            if marker in databases
+        }
+        self.max_mismatches = max_mismatches
+        self.k = k
+        self.min_similarity = min_similarity
+        self.profile_records = profile_records
+        self._profiles: dict[Markers, np.ndarray] | None = None
+
+    def _kmer_profiles(self) -> dict[Markers, np.ndarray]:
+        """Which canonical k-mers appear in the first records of every database, built on first use."""
+        if self._profiles is None:
+            self._profiles = {
+                marker: kmer_profile(Path(fasta_fp), self.k, self.profile_records)
+                for marker, fasta_fp in self.databases.items()
+            }
+        return self._profiles
+
+    def route(self, sequence: str) -> Markers | None:
+        """The marker of a sequence, None when it can't be told apart."""
+        if self.primers:
+            masked = _IUPAC_MASKS[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+            mismatches = {
+                marker: min(_mismatches(masked, primer) for primer in primers)
+                for marker, primers in self.primers.items()
+            }
+            marker = min(mismatches, key=mismatches.__getitem__)
+            if mismatches[marker] <= self.max_mismatches:
+                return marker
+
+        kmers = utils.canonical_kmer_codes(sequence, self.k)
+        if len(kmers) == 0 or not self.databases:
+            return None
+        similarities = {marker: float(profile[kmers].mean()) for marker, profile in self._kmer_profiles().items()}
+        marker = max(similarities, key=similarities.__getitem__)
+        return marker if similarities[marker] >= self.min_similarity else None
@@ -3,9 +3,13 @@ import os
 from pathlib import Path
 from types import NoneType
 
+import aiofiles as aiof
+import polars as pl
 from safe_result import Result, safe_async
 
+import fastx
 import utils
+from consensus import spoa_consensus
 
 
 @safe_async
@@ -50,9 +54,56 @@ async def run_isONclust3(
     return filepaths
 
 
+def cluster_sizes(cluster_fps: list[Path]) -> list[tuple[Path, int]]:
+    """The number of reads of every cluster, counted from the lines of its fastq without parsing the reads."""
+    return [(cluster_fp, fastx.count_records(cluster_fp)) for cluster_fp in cluster_fps]
+
+
+def select_clusters(
+    sizes: list[tuple[Path, int]], max_clusters: int = 0, min_support: float = 0.0
+) -> list[tuple[Path, int]]:
+    """Ranks the clusters from the largest to the smallest and drops the ones too small to matter.
+
+    Args:
+        sizes (list[tuple[Path, int]]): The clusters and their number of reads, see `cluster_sizes`.
+        max_clusters (int, optional): Number of the largest clusters kept, `0` keeps them all. Defaults to 0.
+        min_support (float, optional): Share of the clustered reads a cluster must hold to be kept. Defaults to 0.
+
+    Returns:
+        The kept clusters and their number of reads, largest first.
+    """
+    total = sum(size for _, size in sizes)
+    ranked = sorted(sizes, key=lambda cluster: (-cluster[1], cluster[0].name))
+    selected = [(cluster_fp, size) for cluster_fp, size in ranked if size > 0 and size >= min_support * total]
+    return selected[:max_clusters] if max_clusters > 0 else selected
+
+
+# Columns of BLAST's tabular output (`-outfmt 6`)
+BLAST_COLUMNS = {
+    "qseqid": pl.String,
+    "sseqid": pl.String,
+    "pident": pl.Float64,
+    "length": pl.Int64,
+    "mismatch": pl.Int64,
+    "gapopen": pl.Int64,
+    "qstart": pl.Int64,
+    "qend": pl.Int64,
+    "sstart": pl.Int64,
+    "send": pl.Int64,
+    "evalue": pl.Float64,
+    "bitscore": pl.Float64,
+}
+
+
 # Cleaning for contaminations (selecting only clusters corresponding to angiosperms)
 async def run_blastn(
-    query_file: Path, db_path: Path, output_file: Path, evalue: float = 1e-5, outfmt: int = 6
+    query_file: Path,
+    db_path: Path,
+    output_file: Path,
+    evalue: float = 1e-5,
+    outfmt: int = 6,
+    threads: int = 1,
+    max_target_seqs: int = 5,
 ) -> Result[NoneType, Exception]:
     """
     Runs BLASTN on a given query file against a specified database.
@@ -63,6 +114,8 @@ async def run_blastn(
         output_file (str): Path to save the BLAST output.
         evalue (float): E-value threshold for saving hits (default: 1e-5).
         outfmt (int): BLAST output format (default: 6 = tabular).
+        threads (int): Number of threads BLASTN searches with (default: 1).
+        max_target_seqs (int): Maximum number of hits kept per query (default: 5).
     """
     # fmt: off
     command = [
@@ -72,6 +125,8 @@ async def run_blastn(
         "-out", str(output_file),
         "-evalue", str(evalue),
         "-outfmt", str(outfmt),
+        "-num_threads", str(threads),
+        "-max_target_seqs", str(max_target_seqs),
     ]
     # fmt: on
 
@@ -79,6 +134,94 @@ async def run_blastn(
     return results
 
 
+def blast_db_files(db_path: Path) -> list[Path]:
+    """The files making up a BLAST database, or the fasta itself when given one."""
+    db_path = Path(db_path)
+    if db_path.is_file():
+        return [db_path]
+    return sorted(fp for fp in db_path.parent.glob(f"{db_path.name}.*") if fp.is_file())
+
+
+def _is_blast_db(db_path: Path) -> bool:
+    return any(Path(f"{db_path}{suffix}").is_file() for suffix in (".nal", ".nin"))
+
+
+@safe_async
+async def make_blast_db(fasta_fp: Path) -> Path:
+    """Indexes a fasta into a nucleotide BLAST database next to it, unless it already is.
+
+    Returns:
+        A result containing the database path to give to `blastn` (the fasta path itself) if successful.
+    """
+    fasta_fp = Path(fasta_fp)
+    index_fp = Path(f"{fasta_fp}.nin")
+    if index_fp.is_file() and index_fp.stat().st_mtime >= fasta_fp.stat().st_mtime:
+        return fasta_fp
+
+    # fmt: off
+    command = [
+        "makeblastdb",
+        "-in", str(fasta_fp),
+        "-dbtype", "nucl",
+        "-out", str(fasta_fp),
+    ]
+    # fmt: on
+    (await utils.exec_command(command)).unwrap()
+    return fasta_fp
+
+
+def read_blast_tsv(blast_fp: Path) -> pl.DataFrame:
+    """Parses BLAST's tabular output (`-outfmt 6`) into a frame, one row per hit."""
+    if Path(blast_fp).stat().st_size == 0:
+        return pl.DataFrame(schema=BLAST_COLUMNS)
+    return pl.read_csv(
+        blast_fp, separator="\t", has_header=False, new_columns=list(BLAST_COLUMNS), schema_overrides=BLAST_COLUMNS
+    )
+
+
+@safe_async
+async def decontaminate(
+    query_fp: Path,
+    db_path: Path,
+    output_fp: Path,
+    blast_fp: Path,
+    threads: int = 1,
+    evalue: float = 1e-5,
+    min_identity: float = 0.0,
+) -> pl.DataFrame:
+    """Drops the sequences that don't come from a plant, in a single `blastn` run against a plant database.
+
+    A sequence is kept when it has a hit with an e-value below `evalue` and an identity of at least `min_identity`.
+    The database is loaded once for every sequence, instead of once per cluster.
+
+    Args:
+        query_fp (Path): The consensus sequences fasta.
+        db_path (Path): The BLAST database, a fasta is indexed on first use (see `make_blast_db`).
+        output_fp (Path): Where the kept sequences are written.
+        blast_fp (Path): Where the raw `blastn` output is written.
+        threads (int, optional): Number of threads BLASTN searches with. Defaults to 1.
+        evalue (float, optional): E-value threshold of the hits. Defaults to 1e-5.
+        min_identity (float, optional): Minimum identity (in %) of the hits. Defaults to 0.
+
+    Returns:
+        A result containing the best hit of every kept sequence if successful.
+    """
+    if Path(db_path).is_file() and not _is_blast_db(db_path):
+        db_path = (await make_blast_db(db_path)).unwrap()
+    (await run_blastn(query_fp, db_path, blast_fp, evalue=evalue, threads=threads)).unwrap()
+
+    best_hits = (
+        read_blast_tsv(blast_fp)
+        .filter(pl.col("pident") >= min_identity)
+        .sort("bitscore", descending=True)
+        .unique("qseqid", keep="first", maintain_order=True)
+    )
+    kept = set(best_hits["qseqid"])
+    async with aiof.open(output_fp, "w") as file:
+        await file.write("".join(f">{id}\n{seq}\n" for id, seq in utils.read_fasta(query_fp) if id in kept))
+    return best_hits
+
+
 async def main():
     species = "Allium_Ursinum"
     marker = utils.Markers.ITS
@@ -93,20 +236,18 @@ async def main():
     cluster_filepaths = (await run_isONclust3(filtered_reads, output_cluster)).unwrap()
     print(cluster_filepaths)
 
-    # Decontamination (Cleaning for contaminations (selecting only clusters corresponding to angiosperms)
-    for file in cluster_filepaths:
-        # Convert .fastaq or .fastq to .fasta
-        fasta_file = file.with_suffix(".fasta")
-        fasta_file = utils.convert_fastq_to_fasta(file, fasta_file)
-
-        # Define output file path
-        output_file = Path(output_dir, f"{fasta_file.stem}_blast.out")
-
-        # Run BLASTN
-        (await run_blastn(fasta_file, Path("database/"), output_file)).unwrap()
-
-    # deleting all non plant clusters (empty files)
-    # delete_empty_files("cluster_output/BLAST", recursive=True)
+    # Decontamination (Cleaning for contaminations), every consensus sequence in a single BLASTN run
+    consensus_file = Path(output_base, "consensus.fasta")
+    sequences = spoa_consensus(cluster_filepaths).unwrap()
+    consensus_file.write_text("".join(f">{id}\n{seq}\n" for id, seq in sequences))
+    best_hits = await decontaminate(
+        consensus_file,
+        Path("database/Magnoliopsida_raxdb.fasta"),
+        Path(output_dir, "decontaminated.fasta"),
+        Path(output_dir, "blast.tsv"),
+        threads=os.cpu_count() or 1,
+    )
+    print(best_hits.unwrap())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,291 @@
+import asyncio
+import dataclasses
+import json
+import re
+import signal
+from collections.abc import Awaitable, Callable
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from pathlib import Path
+from time import time
+from typing import Any
+from urllib.parse import urlsplit
+
+import aiofiles as aiof
+from safe_result import Err, Ok, safe_async
+
+from database import resolve_database
+from pipeline import PipelineOptions, StageFactory, run_pipeline
+from raxtax import Raxtax
+from routing import kmer_profile, marker_databases
+from telemetry import Telemetry
+
+Emit = Callable[[dict[str, Any]], Awaitable[None]]
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 411: "Length Required"}
+_UPLOAD_BLOCK = 1 << 20
+# What a client chosen sample name may bring into a filename, anything else (`/`, `..`, ...) is replaced
+_UNSAFE_NAME_CHARS = re.compile(r"[^\w.-]")
+
+
+class _StreamedStage:
+    def __init__(self, title: str, emit: Emit):
+        self.title = title
+        self.emit = emit
+
+    async def done(self, msg: str | None = None) -> None:
+        await self.emit({"event": "stage", "stage": self.title, "status": "done", "message": msg})
+
+    async def fail(self, msg: str | None = None) -> None:
+        await self.emit({"event": "stage", "stage": self.title, "status": "failed", "message": msg})
+
+
+def streamed_stage(emit: Emit) -> StageFactory:
+    """A `StageFactory` sending the progress of every stage as events."""
+
+    @asynccontextmanager
+    async def stage(title: str):
+        await emit({"event": "stage", "stage": title, "status": "started"})
+        yield _StreamedStage(title, emit)
+
+    return stage
+
+
+class _Response:
+    """A chunked HTTP response of JSON lines, written as the events come."""
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.started = False
+        self.closed = False
+
+    async def start(self, status: int = 200):
+        self.started = True
+        head = (
+            f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: application/x-ndjson\r\n"
+            "Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+        )
+        await self._write(head.encode())
+
+    async def emit(self, event: dict[str, Any]):
+        line = (json.dumps(event) + "\n").encode()
+        await self._write(b"%x\r\n%s\r\n" % (len(line), line))
+
+    async def end(self):
+        await self._write(b"0\r\n\r\n")
+
+    async def _write(self, data: bytes):
+        # A client that went away doesn't stop its run, its stages still end up in the cache
+        if self.closed:
+            return
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except ConnectionError:
+            self.closed = True
+
+
+@safe_async
+async def _run_in_work_dir(
+    input_fp: Path, sample: str, options: PipelineOptions, stage: StageFactory, telemetry: Telemetry
+) -> Raxtax:
+    """Runs the pipeline in a temporary work directory named after the sample, failing to set it up is an error too."""
+    prefix = f"myrio_{_UNSAFE_NAME_CHARS.sub('_', str(sample))}_"
+    async with aiof.tempfile.TemporaryDirectory(prefix=prefix) as tmp:
+        return (await run_pipeline(input_fp, Path(tmp), options, stage, telemetry, sample)).unwrap()
+
+
+def _worker_pool(workers: int) -> ProcessPoolExecutor:
+    # The workers leave Ctrl+C to the server, which stops them itself
+    return ProcessPoolExecutor(
+        max_workers=max(workers, 1), initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN)
+    )
+
+
+class PipelineServer:
+    """Serves pipeline runs over a local HTTP API, on a TCP port or a Unix socket.
+
+    The server is started once, so the interpreter, the imports, the marker router (its database k-mer profiles),
+    the compiled databases and the consensus worker pool stay warm between samples. raxtax itself is a separate
+    program loading its database on every run, the database is read once at start up so it is at least served
+    from the page cache.
+
+    Endpoints:
+        `GET /health`: the server state, as JSON.
+        `POST /run`: runs the pipeline on a sample, either a JSON body `{"filepath": ..., "sample": ...}` pointing
+            to a FASTQ file the server can read, or the (possibly gzipped) FASTQ itself as the body. The response
+            streams JSON lines: a `stage` event when every stage starts and ends, then a single `result` event
+            holding the `Raxtax` table as `rows` (or the `error`).
+
+    Args:
+        options (PipelineOptions): The options of every run, `executor` is set by `serve`.
+        jobs (int, optional): Maximum number of samples processed concurrently, the others wait in line.
+            Defaults to 1.
+    """
+
+    def __init__(self, options: PipelineOptions, jobs: int = 1):
+        self.options = options
+        self.jobs = max(jobs, 1)
+        self.telemetry = Telemetry()
+        self.running = 0
+        self.served = 0
+        self._semaphore = asyncio.Semaphore(self.jobs)
+        self._started = time()
+
+    def warm_up(self):
+        """Builds the k-mer profiles of the marker databases (see `MarkerRouter`) and reads the databases once."""
+        databases = marker_databases(self.options.db_fp) if self.options.route_markers else {}
+        for fasta_fp in databases.values():
+            kmer_profile(fasta_fp)
+        for db_fp in [self.options.db_fp, *databases.values()]:
+            with open(resolve_database(db_fp), "rb") as file:
+                while file.read(_UPLOAD_BLOCK):
+                    pass
+
+    def health(self) -> dict[str, Any]:
+        return {
+            "status": "ok",
+            "db": str(self.options.db_fp),
+            "jobs": self.jobs,
+            "running": self.running,
+            "served": self.served,
+            "uptime_s": round(time() - self._started, 3),
+        }
+
+    async def run(self, input_fp: Path, sample: str, emit: Emit):
+        """Runs the pipeline on a sample and emits its progress, then its results. Never raises."""
+        if self._semaphore.locked():
+            await emit({"event": "queued", "running": self.running})
+        async with self._semaphore:
+            self.running += 1
+            _start = time()
+            options = self.options
+            try:
+                result = await _run_in_work_dir(input_fp, sample, options, streamed_stage(emit), self.telemetry)
+            finally:
+                self.running -= 1
+                self.served += 1
+            if isinstance(result, Err) and isinstance(result.error, BrokenProcessPool):
+                self._replace_pool(options.executor)
+
+        event: dict[str, Any] = {"event": "result", "sample": sample, "seconds": round(time() - _start, 3)}
+        match result:
+            case Ok(raxtax):
+                event |= {"status": "ok", "rows": raxtax.df.to_dicts()}
+            case Err(error):
+                event |= {"status": "failed", "error": str(error).strip() or type(error).__name__}
+        await emit(event)
+
+    def _replace_pool(self, broken: Executor | None):
+        """Starts a new worker pool, a crashed worker (a SPOA segfault, the OOM killer) breaks the whole pool."""
+        # Runs sharing the broken pool fail together, only the first one replaces it
+        if broken is None or self.options.executor is not broken:
+            return
+        self.options = dataclasses.replace(self.options, executor=_worker_pool(self.options.threads))
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serves a single request, the connection is closed afterwards."""
+        response = _Response(writer)
+        try:
+            method, target, _ = (await reader.readline()).decode("latin-1").split(" ", 2)
+            headers = {}
+            while (line := (await reader.readline()).decode("latin-1").strip()) != "":
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            path = urlsplit(target).path
+
+            if path == "/health":
+                await self._reply(response, 200, self.health())
+            elif path != "/run":
+                await self._reply(response, 404, {"error": f"Unknown endpoint `{path}`."})
+            elif method != "POST":
+                await self._reply(response, 405, {"error": "Runs are submitted with POST."})
+            elif "content-length" not in headers:
+                await self._reply(response, 411, {"error": "Content-Length is required."})
+            elif headers.get("content-type", "").startswith("application/json"):
+                body = json.loads(await reader.readexactly(int(headers["content-length"])) or b"{}")
+                if not isinstance(body, dict) or not isinstance(body.get("filepath", ""), str):
+                    raise ValueError('expected a JSON object like {"filepath": ..., "sample": ...}')
+                input_fp = Path(body.get("filepath", ""))
+                if not input_fp.is_file():
+                    await self._reply(response, 400, {"error": f"`{input_fp}` is not a file the server can read."})
+                else:
+                    await response.start()
+                    await self.run(input_fp, body.get("sample") or input_fp.name.split(".")[0], response.emit)
+                    await response.end()
+            else:
+                async with aiof.tempfile.TemporaryDirectory(prefix="myrio_upload_") as tmp:
+                    input_fp = Path(tmp, "upload.fastq")
+                    await _receive(reader, input_fp, int(headers["content-length"]))
+                    await response.start()
+                    await self.run(input_fp, headers.get("x-sample") or f"upload_{self.served + 1}", response.emit)
+                    await response.end()
+        except (ValueError, json.JSONDecodeError, asyncio.IncompleteReadError) as error:
+            if response.started:
+                # The status line is already sent, the error ends the stream instead
+                await response.emit({"event": "error", "error": f"Malformed request: {error}"})
+                await response.end()
+            else:
+                await self._reply(response, 400, {"error": f"Malformed request: {error}"})
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _reply(response: _Response, status: int, body: dict[str, Any]):
+        await response.start(status)
+        await response.emit(body)
+        await response.end()
+
+
+async def _receive(reader: asyncio.StreamReader, output_fp: Path, length: int):
+    """Writes an uploaded body to disk as it comes, it never sits whole in memory."""
+    async with aiof.open(output_fp, "wb") as file:
+        while length > 0:
+            block = await reader.read(min(length, _UPLOAD_BLOCK))
+            if not block:
+                raise asyncio.IncompleteReadError(b"", length)
+            await file.write(block)
+            length -= len(block)
+
+
+async def serve(
+    options: PipelineOptions,
+    host: str = "127.0.0.1",
+    port: int = 8765,
+    socket_fp: Path | None = None,
+    jobs: int = 1,
+    on_ready: Callable[[str], None] | None = None,
+):
+    """Runs a `PipelineServer` until interrupted (SIGINT or SIGTERM), on `host:port` or on the Unix socket `socket_fp`.
+
+    The consensus of every sample runs on a single pool of `options.threads` worker processes, started here and
+    replaced when a worker crashes.
+    """
+    server = PipelineServer(dataclasses.replace(options, executor=_worker_pool(options.threads)), jobs)
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    try:
+        await asyncio.to_thread(server.warm_up)
+        if socket_fp is not None:
+            Path(socket_fp).unlink(missing_ok=True)
+            listener = await asyncio.start_unix_server(server.handle, path=socket_fp)
+            address = f"unix:{socket_fp}"
+        else:
+            listener = await asyncio.start_server(server.handle, host, port)
+            address = f"http://{host}:{port}"
+        if on_ready is not None:
+            on_ready(address)
+        async with listener:
+            await stop.wait()
+    finally:
+        if socket_fp is not None:
+            Path(socket_fp).unlink(missing_ok=True)
+        # A run cancelled midway doesn't hold up the shutdown
+        if server.options.executor is not None:
+            server.options.executor.shutdown(wait=False, cancel_futures=True)
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
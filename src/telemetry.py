@@ -0,0 +1,130 @@
+import dataclasses
+import json
+import resource
+import sys
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from datetime import UTC, datetime
+from pathlib import Path
+from time import perf_counter
+
+import aiofiles as aiof
+import polars as pl
+
+# `ru_maxrss` is in kilobytes on Linux and in bytes on macOS
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+@dataclasses.dataclass
+class StageMetrics:
+    """Performance metrics of a single pipeline stage run, one line of the metrics file.
+
+    CPU times and peak RSS come from `getrusage`, they are process wide: when several samples run at once
+    (`run_batch`) the stages overlapping in time share them. Child processes are only accounted for once they
+    exited, which is the case of every tool and worker pool by the end of its stage.
+    """
+
+    sample: str
+    input: str
+    stage: str
+    started: str = ""
+    status: str = "ok"
+    cached: bool = False
+    wall_s: float = 0.0
+    cpu_s: float = 0.0  # user + system time of the main process
+    children_cpu_s: float = 0.0  # user + system time of the child processes (tools, worker pools)
+    peak_rss_bytes: int = 0  # high-water mark of the main process
+    children_peak_rss_bytes: int = 0  # high-water mark of the largest child process
+    reads_in: int | None = None
+    reads_out: int | None = None
+    clusters: int | None = None
+    bytes_in: int | None = None
+    bytes_out: int | None = None
+
+
+# The polars types of the `StageMetrics` fields, so that a summary without any record still has numeric columns
+_SCHEMA = {
+    "sample": pl.String,
+    "input": pl.String,
+    "stage": pl.String,
+    "started": pl.String,
+    "status": pl.String,
+    "cached": pl.Boolean,
+    "wall_s": pl.Float64,
+    "cpu_s": pl.Float64,
+    "children_cpu_s": pl.Float64,
+    "peak_rss_bytes": pl.Int64,
+    "children_peak_rss_bytes": pl.Int64,
+    "reads_in": pl.Int64,
+    "reads_out": pl.Int64,
+    "clusters": pl.Int64,
+    "bytes_in": pl.Int64,
+    "bytes_out": pl.Int64,
+}
+
+
+def file_size(*filepaths: Path) -> int:
+    """The total size in bytes of the files, missing ones count as empty."""
+    return sum(Path(fp).stat().st_size for fp in filepaths if Path(fp).is_file())
+
+
+def _usage() -> tuple[float, float, int, int]:
+    own, children = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (
+        own.ru_utime + own.ru_stime,
+        children.ru_utime + children.ru_stime,
+        own.ru_maxrss * _RSS_UNIT,
+        children.ru_maxrss * _RSS_UNIT,
+    )
+
+
+class Telemetry:
+    """Collects the `StageMetrics` of pipeline runs and appends them to a JSON-lines file.
+
+    Args:
+        metrics_fp (Path | None, optional): The JSON-lines file the metrics are appended to, they are only kept in
+            memory if None. Defaults to None.
+    """
+
+    def __init__(self, metrics_fp: Path | None = None):
+        self.metrics_fp = Path(metrics_fp) if metrics_fp is not None else None
+        self.records: list[StageMetrics] = []
+
+    @asynccontextmanager
+    async def measure(self, sample: str, input_fp: Path, stage: str) -> AsyncIterator[StageMetrics]:
+        """Measures the enclosed stage, the yielded metrics are for the stage to fill in its counts and sizes."""
+        metrics = StageMetrics(sample, str(input_fp), stage, started=datetime.now(UTC).isoformat(timespec="seconds"))
+        start, (cpu, children_cpu, _, _) = perf_counter(), _usage()
+        try:
+            yield metrics
+        except BaseException:
+            metrics.status = "failed"
+            raise
+        finally:
+            end_cpu, end_children_cpu, peak_rss, children_peak_rss = _usage()
+            metrics.wall_s = round(perf_counter() - start, 6)
+            metrics.cpu_s = round(end_cpu - cpu, 6)
+            metrics.children_cpu_s = round(end_children_cpu - children_cpu, 6)
+            metrics.peak_rss_bytes, metrics.children_peak_rss_bytes = peak_rss, children_peak_rss
+            self.records.append(metrics)
+            if self.metrics_fp is not None:
+                self.metrics_fp.parent.mkdir(parents=True, exist_ok=True)
+                async with aiof.open(self.metrics_fp, "a") as file:
+                    await file.write(json.dumps(dataclasses.asdict(metrics)) + "\n")
+
+    def summary(self) -> pl.DataFrame:
+        """The collected metrics as a table, one row per stage run with the sizes in MiB."""
+        df = pl.DataFrame([dataclasses.asdict(record) for record in self.records], schema=_SCHEMA, orient="row")
+        return df.select(
+            "sample",
+            "stage",
+            "cached",
+            pl.col("wall_s").round(3),
+            (pl.col("cpu_s") + pl.col("children_cpu_s")).round(3).alias("cpu_s"),
+            (pl.max_horizontal("peak_rss_bytes", "children_peak_rss_bytes") / 1024**2).round(1).alias("peak_rss_mib"),
+            "reads_in",
+            "reads_out",
+            "clusters",
+            (pl.col("bytes_in") / 1024**2).round(2).alias("mib_in"),
+            (pl.col("bytes_out") / 1024**2).round(2).alias("mib_out"),
+        )
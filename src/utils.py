@@ -1,14 +1,20 @@
 import asyncio as aio
+import hashlib
 import re
+from collections.abc import Iterator
 from enum import Enum
 from os import R_OK, W_OK, PathLike, access
 from pathlib import Path
 from typing import Any
 
+import numpy as np
 import polars as pl
-from Bio import SeqIO
 from safe_result import safe_async
 
+import fastx
+import registry
+from paths import DEFAULT_MANIFEST_FP, DEFAULT_REGISTRY_FP
+
 
 class Markers(Enum):
     matK = "matK"
@@ -21,10 +27,57 @@ class Markers(Enum):
         return [Markers.matK, Markers.rbcL, Markers.psbA_trnH, Markers.ITS]
 
 
+# 2-bit encoding of the nucleotides, everything that isn't A, C, G or T (case-insensitive) maps to 4
+NUCLEOTIDE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _nucleotide in enumerate(b"ACGT"):
+    NUCLEOTIDE_CODES[_nucleotide] = _code
+    NUCLEOTIDE_CODES[_nucleotide + 32] = _code  # lowercase
+
+_COMPLEMENT = str.maketrans("ACGTURYSWKMBDHVNacgturyswkmbdhvn", "TGCAAYRSWMKVHDBNtgcaayrswmkvhdbn")
+
+
+def _kmer_windows(codes: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """The 2-bit encoded k-mer starting at every position, and whether it doesn't overlap an ambiguous base."""
+    n_windows = len(codes) - k + 1
+    if n_windows <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+
+    invalid = np.concatenate([[0], np.cumsum(codes == 4)])
+    kmers = np.zeros(n_windows, dtype=np.int64)
+    for i in range(k):
+        kmers = (kmers << 2) | (codes[i : i + n_windows] & 3)
+    return kmers, (invalid[k:] - invalid[:n_windows]) == 0
+
+
+def _nucleotide_codes(sequence: str | bytes) -> np.ndarray:
+    sequence = sequence.encode() if isinstance(sequence, str) else sequence
+    return NUCLEOTIDE_CODES[np.frombuffer(sequence, dtype=np.uint8)].astype(np.int64)
+
+
+def kmer_codes(sequence: str | bytes, k: int) -> np.ndarray:
+    """The 2-bit encoded k-mers of a sequence (`k <= 31`), skipping the ones overlapping an ambiguous base."""
+    kmers, valid = _kmer_windows(_nucleotide_codes(sequence), k)
+    return kmers[valid]
+
+
+def reverse_complement(sequence: str) -> str:
+    """The reverse complement of a (IUPAC) nucleotide sequence."""
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+def canonical_kmer_codes(sequence: str | bytes, k: int) -> np.ndarray:
+    """The k-mer codes of `kmer_codes`, each the smaller of itself and its reverse complement (strand independent)."""
+    codes = _nucleotide_codes(sequence)
+    forward, valid = _kmer_windows(codes, k)
+    # The reverse strand comes from the same codes, so that both have the same windows whatever the ambiguous bases
+    reverse, _ = _kmer_windows(np.where(codes == 4, 4, 3 - codes)[::-1], k)
+    return np.minimum(forward, reverse[::-1])[valid]
+
+
 def convert_fastq_to_fasta(
     input_filepath: str | PathLike[Any], output_filepath: str | PathLike[Any], debug: bool = False
 ) -> Path:
-    """Converts a FASTQ file to FASTA format using Biopython.
+    """Converts a FASTQ file (possibly gzipped) to FASTA format, one line per sequence.
 
     Returns:
         The output filepath for convenience.
@@ -32,11 +85,32 @@ def convert_fastq_to_fasta(
     input_filepath = Path(input_filepath)
     output_filepath = Path(output_filepath)
 
-    count = SeqIO.convert(input_filepath, "fastq", output_filepath, "fasta")
+    count = 0
+    with open(output_filepath, "wb") as output:
+        for batch in fastx.read_batches(input_filepath, "fastq"):
+            output.write(batch.to_fasta())
+            count += len(batch)
     print(f"Converted {count} records from {input_filepath} to {output_filepath}") if debug else ()
     return output_filepath
 
 
+def read_fasta(filepath: str | PathLike[Any]) -> Iterator[tuple[str, str]]:
+    """Iterates over the `(title, sequence)` pairs of a fasta file (possibly gzipped)."""
+    for batch in fastx.read_batches(filepath, "fasta"):
+        for name, sequence in zip(batch.names, batch.sequences, strict=True):
+            yield name.decode().rstrip(), sequence.decode()
+
+
+def file_digest(filepath: str | PathLike[Any]) -> str:
+    """Hashes the content of a file (blake2b, 128 bits).
+
+    Returns:
+        str: The hex digest.
+    """
+    with open(filepath, "rb") as file:
+        return hashlib.file_digest(file, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+
+
 def check_filepath(filepath: str | PathLike[Any], readable: bool = False, writeable: bool = False) -> bool:
     """Checks if a file exists and more.
 
@@ -55,11 +129,15 @@ def check_filepath(filepath: str | PathLike[Any], readable: bool = False, writea
     return filepath.is_file() and read_check and write_check
 
 
-def load_data_df() -> pl.DataFrame:
-    """Returns a helper dataframe to manage the data files.
+def load_data_df(registry_fp: Path = DEFAULT_REGISTRY_FP) -> pl.DataFrame:
+    """Returns a helper dataframe to manage the data files, the sample registry (see `registry`).
+
+    The registry is only read, `myrio samples` registers the new files of `data/` and refreshes the statistics of the
+    modified ones; `data.csv` stands in for it until then. The registry also holds the `format`, `size`, `mtime_ns`,
+    `reads`, `bases`, `n50` and `mean_quality` of every file.
 
     ┌─────────────────┬───────────┬───────┬───────┬───────────┬───────┬─────────────────────────────────┐
-    │ name            ┆ reference ┆ matk  ┆ rbcL  ┆ psbA-trnH ┆ ITS   ┆ filepath                        │
+    │ name            ┆ reference ┆ matK  ┆ rbcL  ┆ psbA-trnH ┆ ITS   ┆ filepath                        │
     │ ---             ┆ ---       ┆ ---   ┆ ---   ┆ ---       ┆ ---   ┆ ---                             │
     │ str             ┆ bool      ┆ bool  ┆ bool  ┆ bool      ┆ bool  ┆ str                             │
     ╞═════════════════╪═══════════╪═══════╪═══════╪═══════════╪═══════╪═════════════════════════════════╡
@@ -71,7 +149,9 @@ def load_data_df() -> pl.DataFrame:
     │ Tomato          ┆ false     ┆ false ┆ true  ┆ false     ┆ false ┆ data/tomato/rbcL_Qiagen_tomato… │
     └─────────────────┴───────────┴───────┴───────┴───────────┴───────┴─────────────────────────────────┘
     """
-    return pl.read_csv("data.csv")
+    if Path(registry_fp).is_file():
+        return registry.load_registry(registry_fp)
+    return pl.read_csv(DEFAULT_MANIFEST_FP).rename({"matk": "matK"}, strict=False)
 
 
 @safe_async
@@ -0,0 +1,205 @@
+import asyncio
+import dataclasses
+import os
+import shutil
+from collections.abc import Callable
+from pathlib import Path
+from time import time
+
+import polars as pl
+from safe_result import Err, Ok
+
+from batch import FASTQ_SUFFIXES
+from cache import StageCache
+from pipeline import PipelineOptions, run_pipeline
+from preprocessing import filter_reads
+from qc import QcReport
+from telemetry import Telemetry
+
+
+@dataclasses.dataclass
+class WatchRound:
+    """The outcome of classifying the reads seen so far, one line of `rounds.csv`."""
+
+    round: int
+    files: int
+    reads: int  # passing the filters
+    status: str = "ok"
+    species: str | None = None  # the rank of the model instead when classifying with one, see `Raxtax.top_match`
+    species_score: float | None = None
+    stable: bool = False
+    seconds: float = 0.0
+
+
+class StabilityTracker:
+    """Tells when the best species stopped changing between rounds.
+
+    The top species is stable once it stayed the same for `rounds` consecutive rounds and its `species_score`
+    moved by at most `tolerance` over them. Failed rounds (e.g. too few reads to cluster) reset the streak.
+    """
+
+    def __init__(self, rounds: int = 3, tolerance: float = 0.02):
+        self.rounds = rounds
+        self.tolerance = tolerance
+        self._history: list[tuple[str, float]] = []
+
+    def update(self, species: str | None, score: float | None) -> bool:
+        """Adds the top match of a round, returns whether it is stable."""
+        if species is None or score is None:
+            self._history.clear()
+            return False
+        if self._history and self._history[-1][0] != species:
+            self._history.clear()
+        self._history = [*self._history, (species, score)][-self.rounds :]
+        scores = [score for _, score in self._history]
+        return len(self._history) >= self.rounds and max(scores) - min(scores) <= self.tolerance
+
+
+def _is_passed_fastq(filepath: Path) -> bool:
+    # MinKNOW writes the reads failing its own quality filter to `fastq_fail/`
+    return filepath.name.endswith(FASTQ_SUFFIXES) and "fastq_fail" not in filepath.parts
+
+
+def ready_files(directory: Path, seen: set[Path], settle_s: float = 5.0) -> list[Path]:
+    """The FASTQ files of a run directory not seen yet, once they weren't modified for `settle_s` seconds."""
+    now = time()
+    return sorted(
+        fp
+        for fp in Path(directory).rglob("*")
+        if fp.is_file() and _is_passed_fastq(fp) and fp not in seen and now - fp.stat().st_mtime >= settle_s
+    )
+
+
+def run_finished(directory: Path) -> bool:
+    """Whether MinKNOW wrote the `final_summary_*.txt` of the run, no more reads will come."""
+    return any(Path(directory).rglob("final_summary*.txt"))
+
+
+def append_filtered_reads(
+    filepaths: list[Path], reads_fp: Path, options: PipelineOptions, report: QcReport | None = None
+) -> tuple[int, int]:
+    """Filters FASTQ files (possibly gzipped, see `filter_reads`) and appends their passing reads to `reads_fp`.
+
+    Every file is filtered once, as it arrives, so a round never goes over the reads seen before again.
+
+    Args:
+        filepaths (list[Path]): The new FASTQ files.
+        reads_fp (Path): The filtered reads so far.
+        options (PipelineOptions): The filtering options (`min_len`, `min_qual`, `max_qual`, `threads`).
+        report (QcReport | None, optional): Accumulates the read statistics of the files. Defaults to None.
+
+    Returns:
+        The number of reads read and appended.
+    """
+    n_reads, n_passed = 0, 0
+    new_reads_fp = reads_fp.with_name("new_reads.fastq")
+    with open(reads_fp, "ab") as output:
+        for filepath in filepaths:
+            stats = filter_reads(
+                filepath,
+                new_reads_fp,
+                options.min_len,
+                options.min_qual,
+                options.max_qual,
+                threshold=0,
+                max_workers=options.threads,
+                qc=report is not None,
+            ).unwrap()
+            n_reads, n_passed = n_reads + stats.n_reads, n_passed + stats.n_passed
+            if report is not None and stats.qc is not None:
+                report.merge(stats.qc)
+            with open(new_reads_fp, "rb") as new_reads:
+                shutil.copyfileobj(new_reads, output)
+    new_reads_fp.unlink(missing_ok=True)
+    return n_reads, n_passed
+
+
+async def watch(
+    directory: Path,
+    work_dir: Path,
+    output_dir: Path,
+    options: PipelineOptions,
+    poll_s: float = 10.0,
+    settle_s: float = 5.0,
+    min_new_reads: int = 1000,
+    stable_rounds: int = 3,
+    tolerance: float = 0.02,
+    until_stable: bool = False,
+    on_round: Callable[[WatchRound], None] | None = None,
+    telemetry: Telemetry | None = None,
+) -> list[WatchRound]:
+    """Classifies the reads of a sequencing run as MinKNOW writes them, until the run finishes.
+
+    New FASTQ files are filtered once as they arrive and their passing reads appended to the filtered reads so far.
+    Once at least `min_new_reads` new reads passed, the pipeline runs again on all of them from the subsampling (or
+    the clustering), `options.read_budget` bounds the cost of the later rounds. The intermediate files of a round
+    are never reused, so they aren't cached. The latest results are kept in `<output_dir>/results.csv`, every round
+    in `<output_dir>/rounds.csv` and, with `options.qc`, the read statistics so far in `<output_dir>/qc/`.
+
+    Args:
+        directory (Path): The MinKNOW output directory (or one of its barcode directories).
+        work_dir (Path): Directory for the reads seen so far and the intermediate files.
+        output_dir (Path): Directory for the results.
+        options (PipelineOptions): The pipeline options.
+        poll_s (float, optional): Seconds between two looks at `directory`. Defaults to 10.
+        settle_s (float, optional): Seconds a file must be left untouched before being read. Defaults to 5.
+        min_new_reads (int, optional): New reads passing the filters needed to run another round. Defaults to 1000.
+        stable_rounds (int, optional): Rounds the top species must stay the same to be stable. Defaults to 3.
+        tolerance (float, optional): Variation of its `species_score` allowed over these rounds. Defaults to 0.02.
+        until_stable (bool, optional): Stops as soon as the top species is stable. Defaults to False.
+        on_round (Callable[[WatchRound], None] | None, optional): Called after every round. Defaults to None.
+        telemetry (Telemetry | None, optional): Records the performance metrics of every stage. Defaults to None.
+
+    Returns:
+        Every round, in order.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    reads_fp = Path(work_dir, "filtered_so_far.fastq")
+    reads_fp.unlink(missing_ok=True)
+    report = QcReport() if options.qc else None
+    options = dataclasses.replace(options, cache=StageCache(enabled=False))
+    tracker = StabilityTracker(stable_rounds, tolerance)
+    seen: set[Path] = set()
+    rounds: list[WatchRound] = []
+    n_reads, new_reads = 0, 0
+
+    while True:
+        finished = run_finished(directory)  # checked first, so that the last files are read afterwards
+        files = ready_files(directory, seen, 0.0 if finished else settle_s)
+        seen.update(files)
+        _, added = await asyncio.to_thread(append_filtered_reads, files, reads_fp, options, report)
+        n_reads, new_reads = n_reads + added, new_reads + added
+        if report is not None and files:
+            await asyncio.to_thread(report.write, Path(output_dir, "qc"))
+
+        if new_reads >= min_new_reads or (finished and new_reads > 0):
+            _start = time()
+            watch_round = WatchRound(len(rounds) + 1, len(seen), n_reads)
+            round_dir = Path(work_dir, f"round_{watch_round.round}")
+            os.makedirs(round_dir)
+            result = await run_pipeline(
+                reads_fp, round_dir, options, telemetry=telemetry, sample=directory.name, prefiltered=True
+            )
+            match result:
+                case Ok(raxtax):
+                    raxtax.df.write_csv(Path(output_dir, "results.csv"))
+                    watch_round.species, watch_round.species_score = raxtax.top_match()
+                case Err(_):
+                    watch_round.status = "failed"
+            shutil.rmtree(round_dir, ignore_errors=True)
+
+            watch_round.stable = tracker.update(watch_round.species, watch_round.species_score)
+            watch_round.seconds = round(time() - _start, 3)
+            rounds.append(watch_round)
+            pl.DataFrame([dataclasses.asdict(r) for r in rounds], infer_schema_length=None).write_csv(
+                Path(output_dir, "rounds.csv")
+            )
+            new_reads = 0
+            if on_round is not None:
+                on_round(watch_round)
+            if until_stable and watch_round.stable:
+                return rounds
+
+        if finished:
+            return rounds
+        await asyncio.sleep(poll_s)
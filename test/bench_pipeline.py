@@ -0,0 +1,188 @@
+"""Benchmarks of every pipeline stage and of the whole pipeline, run with `just bench`.
+
+Each benchmark runs on the small, medium and large samples of `conftest.SAMPLES`. External tools that aren't
+installed are replaced by the stand-ins of `test/stubs`, their timings are then only meaningful for the python side
+of the stage. Saved runs (`.benchmarks/`) can be compared between commits with `just bench-compare`.
+"""
+
+import asyncio
+import gzip
+import shutil
+from pathlib import Path
+
+import pytest
+
+import fastx
+import qc
+import registry
+import utils
+from consensus import spoa_consensus
+from model import _build_kmer_dataset_cleaned, train_model, use_model
+from pipeline import PipelineOptions, run_pipeline
+from preprocessing import filter_reads, subsample_reads
+from raxtax import Raxtax
+from selection import decontaminate, run_isONclust3
+
+
+def _fresh_dir(root: Path):
+    """pedantic setup, empties `root` so every round starts from the same state."""
+    shutil.rmtree(root, ignore_errors=True)
+    root.mkdir(parents=True)
+    return (), {}
+
+
+@pytest.mark.benchmark(group="preprocessing")
+@pytest.mark.parametrize("with_qc", [False, True], ids=["filter", "filter+qc"])
+def bench_filter_reads(benchmark, sample_fp, tmp_path, with_qc):
+    benchmark.extra_info["reads"] = fastx.count_records(sample_fp)
+    output_fp = Path(tmp_path, "reads.fastq")
+    stats = benchmark(lambda: filter_reads(sample_fp, output_fp, qc=with_qc).unwrap())
+    assert stats.n_passed > 0
+    if with_qc:
+        assert stats.qc.raw.reads == stats.n_reads and stats.qc.filtered.reads == stats.n_passed
+
+
+@pytest.mark.benchmark(group="preprocessing")
+def bench_read_stats(benchmark, sample_fp):
+    stats = benchmark(qc.read_stats, sample_fp)
+    assert stats.reads == fastx.count_records(sample_fp)
+
+
+@pytest.mark.benchmark(group="preprocessing")
+@pytest.mark.parametrize("saturation_step", [0, 250], ids=["budget", "saturation"])
+def bench_subsample_reads(benchmark, filtered_fp, tmp_path, saturation_step):
+    benchmark.extra_info["reads"] = fastx.count_records(filtered_fp)
+    output_fp = Path(tmp_path, "reads.fastq")
+    stats = benchmark(lambda: subsample_reads(filtered_fp, output_fp, 1000, saturation_step).unwrap())
+    assert 0 < stats.n_sampled <= 1000
+
+
+@pytest.mark.benchmark(group="clustering")
+def bench_run_isONclust3(benchmark, filtered_fp, tmp_path, external_tools):
+    benchmark.extra_info["stub"] = "isONclust3" in external_tools
+    output_dir = Path(tmp_path, "clustering")
+    fps = benchmark.pedantic(
+        lambda: asyncio.run(run_isONclust3(filtered_fp, output_dir)).unwrap(),
+        setup=lambda: _fresh_dir(output_dir),
+        rounds=3,
+    )
+    assert fps
+
+
+@pytest.mark.benchmark(group="consensus")
+def bench_spoa_consensus(benchmark, cluster_fps):
+    benchmark.extra_info["clusters"] = len(cluster_fps)
+    sequences = benchmark.pedantic(lambda: spoa_consensus(cluster_fps).unwrap(), rounds=3)
+    assert len(sequences) == len(cluster_fps)
+
+
+@pytest.mark.benchmark(group="raxtax")
+def bench_raxtax_from_tsv(benchmark, tmp_path):
+    # A large synthetic output, real runs only have a handful of clusters
+    tsv_fp = Path(tmp_path, "raxtax.tsv")
+    with open(tsv_fp, "w") as file:
+        for i in range(50_000):
+            ranks = [f"{rank}:Value{i % 97}\t{1 / (i + 1):.4f}" for rank in Raxtax.get_ranks()]
+            file.write("\t".join([f"{i}_consensus", *ranks, "0.5", "0.5", "ACGT"]) + "\n")
+
+    raxtax = benchmark(lambda: asyncio.run(Raxtax.from_tsv(tsv_fp)).unwrap())
+    assert raxtax.df.height == 50_000
+
+
+@pytest.mark.benchmark(group="raxtax")
+def bench_raxtax_build(benchmark, cluster_fps, reference_db_fp, tmp_path, external_tools):
+    benchmark.extra_info["stub"] = "raxtax" in external_tools
+    sequences = spoa_consensus(cluster_fps).unwrap()
+    consensus_fp = Path(tmp_path, "consensus.fasta")
+    consensus_fp.write_text("\n".join(f">{id}\n{seq}" for id, seq in sequences))
+
+    output_dir = Path(tmp_path, "raxtax")
+    raxtax = benchmark.pedantic(
+        lambda: asyncio.run(Raxtax.build(consensus_fp, reference_db_fp, output_dir)).unwrap(),
+        setup=lambda: _fresh_dir(output_dir),
+        rounds=3,
+    )
+    assert raxtax.df.height == len(sequences)
+
+
+@pytest.mark.benchmark(group="decontamination")
+def bench_decontaminate(benchmark, cluster_fps, reference_db_fp, tmp_path, external_tools):
+    benchmark.extra_info["stub"] = "blastn" in external_tools
+    sequences = spoa_consensus(cluster_fps).unwrap()
+    consensus_fp = Path(tmp_path, "consensus.fasta")
+    consensus_fp.write_text("\n".join(f">{id}\n{seq}" for id, seq in sequences))
+
+    output_fp, blast_fp = Path(tmp_path, "decontaminated.fasta"), Path(tmp_path, "blast.tsv")
+    best_hits = benchmark.pedantic(
+        lambda: asyncio.run(decontaminate(consensus_fp, reference_db_fp, output_fp, blast_fp)).unwrap(), rounds=3
+    )
+    assert best_hits.height <= len(sequences)
+
+
+@pytest.mark.benchmark(group="utils")
+@pytest.mark.parametrize("compressed", [False, True], ids=["plain", "gzip"])
+def bench_read_batches(benchmark, sample_fp, tmp_path, compressed):
+    input_fp = sample_fp
+    if compressed:
+        input_fp = Path(tmp_path, "reads.fastq.gz")
+        with open(sample_fp, "rb") as file, gzip.open(input_fp, "wb") as output:
+            shutil.copyfileobj(file, output)
+
+    n_reads = benchmark(lambda: sum(len(batch) for batch in fastx.read_batches(input_fp)))
+    assert n_reads == fastx.count_records(sample_fp)
+
+
+@pytest.mark.benchmark(group="utils")
+@pytest.mark.parametrize("warm", [False, True], ids=["cold", "warm"])
+def bench_update_registry(benchmark, sample_fp, filtered_fp, tmp_path, warm):
+    registry_fp = Path(tmp_path, "registry.parquet")
+    setup = (lambda: None) if warm else (lambda: registry_fp.unlink(missing_ok=True))
+    if warm:
+        registry.update_registry([sample_fp, filtered_fp], registry_fp)
+    df = benchmark.pedantic(
+        lambda: registry.update_registry([sample_fp, filtered_fp], registry_fp, max_workers=1), setup=setup, rounds=3
+    )
+    assert df.get_column("reads").sum() == fastx.count_records(sample_fp, filtered_fp)
+
+
+@pytest.mark.benchmark(group="utils")
+def bench_convert_fastq_to_fasta(benchmark, filtered_fp, tmp_path):
+    output_fp = benchmark(utils.convert_fastq_to_fasta, filtered_fp, Path(tmp_path, "reads.fasta"))
+    assert output_fp.stat().st_size > 0
+
+
+@pytest.mark.benchmark(group="model")
+def bench_build_kmer_dataset(benchmark, filtered_fp):
+    df = benchmark.pedantic(lambda: _build_kmer_dataset_cleaned(filtered_fp, format="fastq"), rounds=3)
+    assert df.height == fastx.count_records(filtered_fp)
+
+
+@pytest.mark.benchmark(group="model")
+def bench_use_model(benchmark, kmer_model_fp, reference_db_fp):
+    raxtax = benchmark(lambda: use_model(kmer_model_fp, reference_db_fp).unwrap())
+    assert raxtax.df.columns == Raxtax.get_row_schema()
+    assert raxtax.df.height == fastx.count_records(reference_db_fp)
+    assert raxtax.df.get_column("genus").is_not_null().all()
+
+
+@pytest.mark.benchmark(group="model")
+def bench_train_model(benchmark, kmer_shard_fps, reference_db_fp, tmp_path):
+    model_fp = Path(tmp_path, "species.ubj")
+    stats = benchmark.pedantic(lambda: train_model(kmer_shard_fps, model_fp, rounds=10).unwrap(), rounds=3)
+    benchmark.extra_info["rows_per_s"] = round(stats.rows_per_s)
+    assert stats.rows == fastx.count_records(reference_db_fp)
+    assert model_fp.is_file()
+
+
+@pytest.mark.benchmark(group="end-to-end")
+def bench_end_to_end(benchmark, sample_fp, reference_db_fp, tmp_path, external_tools):
+    benchmark.extra_info["reads"] = fastx.count_records(sample_fp)
+    benchmark.extra_info["stubs"] = external_tools
+    work_dir = Path(tmp_path, "work")
+    options = PipelineOptions(db_fp=reference_db_fp)
+    raxtax = benchmark.pedantic(
+        lambda: asyncio.run(run_pipeline(sample_fp, work_dir, options)).unwrap(),
+        setup=lambda: _fresh_dir(work_dir),
+        rounds=3,
+    )
+    assert not raxtax.df.is_empty()
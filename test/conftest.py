@@ -0,0 +1,93 @@
+import asyncio
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+from Bio import SeqIO
+
+from model import train_model, write_kmer_shards
+from preprocessing import filter_reads
+from selection import run_isONclust3
+
+DATA_DIR = Path(__file__).parent.parent / "data"
+STUBS_DIR = Path(__file__).parent / "stubs"
+
+# Real samples of increasing size, the benchmarks run on each of them so results stay comparable between commits
+SAMPLES = {
+    "small": Path(DATA_DIR, "expedition_jardin_botanique", "Heliconia_bihai_trnH-psbA_barcode91"),
+    "medium": Path(DATA_DIR, "fulvia_estelle_max_expedition", "Solanum_Lycopersicum_MN_after_7d_matk_rbcL_barcode5"),
+    "large": Path(DATA_DIR, "expedition_jardin_botanique", "Ficus_religiosa_trnH-psbA_barcode96"),
+}
+
+
+def _fastq(sample_dir: Path) -> Path:
+    return next(fp for fp in sample_dir.iterdir() if fp.suffix == ".fastq")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def external_tools(tmp_path_factory):
+    """Puts the stand-ins of `test/stubs` on the PATH for the external tools that aren't installed."""
+    missing = [tool.name for tool in STUBS_DIR.iterdir() if shutil.which(tool.name) is None]
+    if not missing:
+        yield []
+        return
+
+    bin_dir = tmp_path_factory.mktemp("bin")
+    for tool in missing:
+        os.symlink(Path(STUBS_DIR, tool).resolve(), Path(bin_dir, tool))
+
+    path = os.environ.get("PATH", "")
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{path}"
+    yield missing
+    os.environ["PATH"] = path
+
+
+@pytest.fixture(scope="session", params=list(SAMPLES), ids=list(SAMPLES))
+def sample_fp(request) -> Path:
+    """The raw reads of a sample, parametrized over `SAMPLES`."""
+    return _fastq(SAMPLES[request.param])
+
+
+@pytest.fixture(scope="session")
+def filtered_fp(sample_fp, tmp_path_factory) -> Path:
+    output_fp = Path(tmp_path_factory.mktemp("filtered"), "reads.fastq")
+    filter_reads(sample_fp, output_fp).unwrap()
+    return output_fp
+
+
+@pytest.fixture(scope="session")
+def cluster_fps(filtered_fp, tmp_path_factory, external_tools) -> list[Path]:
+    output_dir = tmp_path_factory.mktemp("clusters")
+    return asyncio.run(run_isONclust3(filtered_fp, output_dir)).unwrap()
+
+
+@pytest.fixture(scope="session")
+def reference_db_fp(tmp_path_factory) -> Path:
+    """A small raxtax database built from the reference sequences shipped with the samples."""
+    db_fp = Path(tmp_path_factory.mktemp("database"), "reference_raxdb.fasta")
+    with open(db_fp, "w") as file:
+        for i, fasta_fp in enumerate(sorted(DATA_DIR.rglob("*_reference_seq.fasta"))):
+            genus, species = fasta_fp.name.removesuffix("_reference_seq.fasta").split("_")[:2]
+            genus = genus.capitalize()
+            for j, record in enumerate(SeqIO.parse(fasta_fp, "fasta")):
+                tax = (
+                    f"phylum:Tracheophyta,class:Magnoliopsida,order:Unknown,family:Unknown,"
+                    f"genus:{genus},species:{genus}_{species}"
+                )
+                file.write(f">REF{i}-{j}|MARKER_CODE=unknown;tax={tax};\n{record.seq}\n")
+    return db_fp
+
+
+@pytest.fixture(scope="session")
+def kmer_shard_fps(reference_db_fp, tmp_path_factory) -> list[Path]:
+    """The k-mer feature shards of the reference sequences, see `model.train_model`."""
+    return write_kmer_shards(reference_db_fp, tmp_path_factory.mktemp("shards"), shard_rows=16)
+
+
+@pytest.fixture(scope="session")
+def kmer_model_fp(kmer_shard_fps, tmp_path_factory) -> Path:
+    """A small XGBoost genus classifier trained on the k-mers of the reference sequences, see `model.use_model`."""
+    model_fp = Path(tmp_path_factory.mktemp("model"), "genus.ubj")
+    train_model(kmer_shard_fps, model_fp, rank="genus", rounds=10, max_depth=3).unwrap()
+    return model_fp
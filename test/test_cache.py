@@ -0,0 +1,57 @@
+import asyncio
+import os
+from pathlib import Path
+
+import cache
+from cache import StageCache
+
+
+def _store(stage_cache: StageCache, work_dir: Path, key: str, size: int):
+    artifact = Path(work_dir, f"{key}.bin")
+    artifact.write_bytes(b"x" * size)
+    stage_cache.store(key, work_dir, [artifact])
+
+
+def test_key_depends_on_the_sources(tmp_path, monkeypatch):
+    stage_cache = StageCache(Path(tmp_path, "cache"))
+    input_fp = Path(tmp_path, "reads.fastq")
+    input_fp.write_text("@r1\nACGT\n+\nIIII\n")
+
+    key = asyncio.run(stage_cache.key("preprocessing", [input_fp], {"min_len": 150}, tools=[]))
+    assert key == asyncio.run(stage_cache.key("preprocessing", [input_fp], {"min_len": 150}, tools=[]))
+    assert key != asyncio.run(stage_cache.key("preprocessing", [input_fp], {"min_len": 100}, tools=[]))
+    monkeypatch.setattr(cache, "source_digest", lambda: "changed")
+    assert key != asyncio.run(stage_cache.key("preprocessing", [input_fp], {"min_len": 150}, tools=[]))
+
+
+def test_store_evicts_least_recently_used(tmp_path, monkeypatch):
+    stage_cache = StageCache(Path(tmp_path, "cache"), max_bytes=2500)
+    work_dir = Path(tmp_path, "work")
+    work_dir.mkdir()
+
+    walks = 0
+    evict = stage_cache.evict
+
+    def counting_evict():
+        nonlocal walks
+        walks += 1
+        evict()
+
+    monkeypatch.setattr(stage_cache, "evict", counting_evict)
+    for i, key in enumerate(["a", "b"]):
+        _store(stage_cache, work_dir, key, 1000)
+        os.utime(Path(stage_cache.root, key), (i, i))
+    assert walks == 0  # still under the limit
+
+    assert stage_cache.restore("a", Path(tmp_path, "restored")) is not None  # `a` is now the most recently used
+    _store(stage_cache, work_dir, "c", 1000)
+    assert walks == 1
+    assert [stage_cache.contains(key) for key in "abc"] == [True, False, True]
+
+
+def test_store_without_artifacts(tmp_path):
+    stage_cache = StageCache(Path(tmp_path, "cache"))
+    stage_cache.store("k", tmp_path, [], meta={"clusters": []})
+
+    assert stage_cache.contains("k")
+    assert stage_cache.restore("k", Path(tmp_path, "restored")) == {"clusters": []}
@@ -0,0 +1,45 @@
+import subprocess
+import sys
+from pathlib import Path
+from time import perf_counter
+
+SRC_DIR = Path(__file__).parent.parent / "src"
+
+# Start-up budget of `import cli`, clypi and asyncio alone take about half of it
+IMPORT_BUDGET_S = 0.5
+HEAVY_MODULES = ["numpy", "polars", "spoa", "pysam", "Bio", "xgboost", "sklearn", "pipeline"]
+
+
+def _python(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run([sys.executable, *args], cwd=SRC_DIR, capture_output=True, text=True, check=True)
+
+
+def _import_time_s() -> float:
+    """The cumulative import time of `cli`, as reported by `-X importtime`."""
+    stderr = _python("-X", "importtime", "-c", "import cli").stderr
+    line = next(line for line in stderr.splitlines() if line.split("|")[-1].strip() == "cli")
+    return int(line.split("|")[1]) / 1e6
+
+
+def test_cli_import_time():
+    # The best of a few runs, so that a busy machine doesn't fail the test
+    assert min(_import_time_s() for _ in range(3)) < IMPORT_BUDGET_S
+
+
+def test_cli_imports_no_heavy_module():
+    code = f"import sys, cli; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    assert _python("-c", code).stdout.strip() == ""
+
+
+def test_cli_missing_file_fails_fast():
+    def run() -> tuple[float, str]:
+        start = perf_counter()
+        result = subprocess.run(
+            [sys.executable, "cli.py", "does_not_exist.fastq"], check=False, cwd=SRC_DIR, capture_output=True, text=True
+        )
+        return perf_counter() - start, result.stdout + result.stderr
+
+    # The check runs before any pipeline module is imported, the whole process stays within the start-up budget
+    runs = [run() for _ in range(3)]
+    assert all("Filepath does not point to an existing file." in output for _, output in runs)
+    assert min(wall_s for wall_s, _ in runs) < IMPORT_BUDGET_S
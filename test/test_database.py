@@ -0,0 +1,120 @@
+import csv
+import math
+import random
+from pathlib import Path
+
+import pytest
+
+from database import MARKER_GROUPS, build_databases, collapse_near_duplicates
+
+RANKS = ["phylum", "class", "order", "family", "genus", "species"]
+COLUMNS = ["processid", *(f"{rank}_name" for rank in RANKS), "markercode", "nucleotides"]
+LINEAGES = [
+    ["Tracheophyta", "Magnoliopsida", "Rosales", "Moraceae", "Ficus", "Ficus religiosa"],
+    ["Tracheophyta", "Magnoliopsida", "Rosales", "Moraceae", "Ficus", "Ficus carica"],
+    ["Tracheophyta", "Magnoliopsida", "Malvales", "Malvaceae", "Tilia", "Tilia cordata"],
+    ["Tracheophyta", "Magnoliopsida", "Malvales", "Malvaceae", "Tilia", ""],  # never collapsed
+]
+
+
+def _mutate(rng: random.Random, sequence: str, n: int) -> str:
+    bases = list(sequence)
+    for i in rng.sample(range(len(bases)), n):
+        bases[i] = rng.choice("ACGT".replace(bases[i], ""))
+    return "".join(bases)
+
+
+@pytest.fixture(scope="module")
+def tsv_fp(tmp_path_factory) -> Path:
+    """A BOLD tsv mixing exact duplicates, near-duplicates and distinct sequences, lineages interleaved."""
+    rng = random.Random(0)
+    bases = {(i, marker): "".join(rng.choices("ACGT", k=300)) for i in range(len(LINEAGES)) for marker in MARKER_GROUPS}
+    rows = []
+    for j in range(200):
+        i, marker = rng.randrange(len(LINEAGES)), rng.choice(["rbcL", "matK", "ITS2"])
+        sequence = bases[i, "ITS" if marker == "ITS2" else marker]
+        match rng.randrange(4):
+            case 0:
+                pass  # an exact duplicate once seen
+            case 1:
+                sequence = _mutate(rng, sequence, 1)[rng.randrange(6) :]  # a near-duplicate, possibly shorter
+            case 2:
+                sequence = _mutate(rng, sequence, 12)  # distinct
+            case 3:
+                sequence = "--" + sequence.lower()[:150] + "-I" + sequence[152:]  # alignment gaps and padding
+        rows.append([f"P{j}", *LINEAGES[i], marker, sequence])
+
+    tsv_fp = Path(tmp_path_factory.mktemp("bold"), "bold.tsv")
+    with open(tsv_fp, "w", newline="") as file:
+        writer = csv.writer(file, delimiter="\t", lineterminator="\n")
+        writer.writerow(COLUMNS)
+        writer.writerows(rows)
+    return tsv_fp
+
+
+def _identity(a: set[str], b: set[str], k: int) -> float:
+    shared = len(a & b)
+    if shared == 0:
+        return 0.0
+    jaccard = shared / len(a | b)
+    return 1.0 + math.log(2 * jaccard / (1 + jaccard)) / k
+
+
+def _reference_fastas(tsv_fp: Path, identity: float, k: int = 15) -> dict[str, str]:
+    """The databases expected from `build_databases`, by a plain (quadratic) Python dereplication."""
+    groups = {code: group for group, codes in MARKER_GROUPS.items() for code in codes}
+    records: dict[str, list[tuple[str, str, str]]] = {group: [] for group in MARKER_GROUPS}
+    seen: set[tuple[str, str, str]] = set()
+    with open(tsv_fp) as file:
+        for row in csv.DictReader(file, delimiter="\t"):
+            tax = ",".join(
+                f"{rank}:{row[f'{rank}_name'].replace(' ', '_')}" if row[f"{rank}_name"] else "" for rank in RANKS
+            )
+            sequence = row["nucleotides"].strip().replace("-", "N").replace("I", "N")
+            group = groups[row["markercode"]]
+            key = (group, tax, sequence.upper().strip("N"))
+            if key not in seen:
+                seen.add(key)
+                header = f">BOLD_PID={row['processid']}|MARKER_CODE={row['markercode']};tax={tax};"
+                records[group].append((header, tax, sequence))
+
+    fastas = {}
+    for group, group_records in records.items():
+        removed = set()
+        for tax in {tax for _, tax, _ in group_records if tax.rsplit(",", 1)[-1].startswith("species:")}:
+            indices = sorted(
+                (i for i, (_, other, _) in enumerate(group_records) if other == tax),
+                key=lambda i: len(group_records[i][2]),
+                reverse=True,
+            )
+            kept: list[set[str]] = []
+            for i in indices:
+                sequence = group_records[i][2].upper()
+                kmers = {sequence[j : j + k] for j in range(len(sequence) - k + 1)}
+                kmers = {kmer for kmer in kmers if set(kmer) <= set("ACGT")}
+                if any(_identity(kmers, other, k) >= identity for other in kept):
+                    removed.add(i)
+                else:
+                    kept.append(kmers)
+        fastas[group] = "".join(
+            f"{header}\n{sequence}\n" for i, (header, _, sequence) in enumerate(group_records) if i not in removed
+        )
+    return fastas
+
+
+def test_build_databases_matches_plain_dereplication(tsv_fp, tmp_path):
+    stats = build_databases(tsv_fp, tmp_path, "Test", dereplicate=True, near_identity=0.99, batch_size=16).unwrap()
+    expected = _reference_fastas(tsv_fp, identity=0.99)
+
+    for group, fasta in expected.items():
+        fasta_fp = Path(tmp_path, f"Test_{group}_raxdb.fasta")
+        assert fasta_fp.read_text() == fasta
+        assert stats[fasta_fp].records == fasta.count(">")
+    assert sum(stats[Path(tmp_path, f"Test_{group}_raxdb.fasta")].near_duplicates for group in expected) > 0
+
+
+def test_collapse_near_duplicates_without_species(tmp_path):
+    fasta_fp = Path(tmp_path, "db.fasta")
+    fasta_fp.write_text(">R1|MARKER_CODE=rbcL;tax=phylum:T,genus:G,;\nACGTACGTACGTACGTACGT\n" * 2)
+    assert collapse_near_duplicates(fasta_fp).unwrap() == 0
+    assert collapse_near_duplicates(Path(tmp_path, "missing.fasta")).is_err()
@@ -0,0 +1,101 @@
+import gzip
+from pathlib import Path
+
+import pytest
+
+import fastx
+
+FASTQ_RECORDS = [
+    (b"read1 runid=a", b"ACGTACGTAC", b"IIIIIIIIII"),
+    (b"read2", b"", b""),  # an empty read
+    (b"read3 runid=b", b"GATTACA", b"+#+#+#+"),  # a quality line starting like a separator
+    (b"read4", b"TTTT", b"@@@@"),  # a quality line starting like a header
+]
+FASTA_RECORDS = [
+    (b"seq1|MARKER_CODE=matK;tax=species:Ficus_carica;", b"ACGTACGTACGTACGT"),
+    (b"seq2", b"GGGCCC"),
+    (b"seq3 description", b"TTTTAAAACCCCGGGG"),
+]
+
+
+def _write(filepath: Path, text: bytes, gzipped: bool, crlf: bool, trailing_newline: bool) -> Path:
+    if crlf:
+        text = text.replace(b"\n", b"\r\n")
+    if not trailing_newline:
+        text = text.rstrip(b"\r\n")
+    filepath.write_bytes(gzip.compress(text) if gzipped else text)
+    return filepath
+
+
+def _fastq() -> bytes:
+    return b"".join(b"@%s\n%s\n+\n%s\n" % record for record in FASTQ_RECORDS)
+
+
+def _fasta() -> bytes:
+    # Sequences wrapped every 5 bases, like most databases at 60 or 80
+    return b"".join(
+        b">%s\n%s\n" % (name, b"\n".join(sequence[i : i + 5] for i in range(0, len(sequence), 5)))
+        for name, sequence in FASTA_RECORDS
+    )
+
+
+@pytest.mark.parametrize("gzipped", [False, True], ids=["plain", "gzip"])
+@pytest.mark.parametrize("crlf", [False, True], ids=["lf", "crlf"])
+@pytest.mark.parametrize("trailing_newline", [True, False], ids=["newline", "no_newline"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])  # records split across chunks, down to single bytes
+def test_read_batches_fastq(tmp_path, gzipped, crlf, trailing_newline, chunk_size):
+    fastq_fp = _write(Path(tmp_path, "reads.fastq"), _fastq(), gzipped, crlf, trailing_newline)
+
+    batches = list(fastx.read_batches(fastq_fp, chunk_size=chunk_size))
+    records = [record for batch in batches for record in zip(batch.names, batch.sequences, batch.qualities or [])]
+    assert records == FASTQ_RECORDS
+    assert all(len(batch) > 0 for batch in batches)
+    assert fastx.count_records(fastq_fp) == len(FASTQ_RECORDS)
+
+
+@pytest.mark.parametrize("gzipped", [False, True], ids=["plain", "gzip"])
+@pytest.mark.parametrize("crlf", [False, True], ids=["lf", "crlf"])
+@pytest.mark.parametrize("trailing_newline", [True, False], ids=["newline", "no_newline"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_read_batches_fasta(tmp_path, gzipped, crlf, trailing_newline, chunk_size):
+    fasta_fp = _write(Path(tmp_path, "references.fasta"), _fasta(), gzipped, crlf, trailing_newline)
+
+    batches = list(fastx.read_batches(fasta_fp, chunk_size=chunk_size))
+    assert [record for batch in batches for record in zip(batch.names, batch.sequences)] == FASTA_RECORDS
+    assert all(batch.qualities is None for batch in batches)
+    assert fastx.count_records(fasta_fp) == len(FASTA_RECORDS)
+
+
+def test_iter_chunks_whole_records(tmp_path):
+    fastq_fp = _write(Path(tmp_path, "reads.fastq"), _fastq(), gzipped=False, crlf=False, trailing_newline=True)
+    chunks = list(fastx.iter_chunks(fastq_fp, chunk_size=20))
+    assert b"".join(chunks) == _fastq()
+    assert all(chunk.endswith(b"\n") and chunk.count(b"\n") % 4 == 0 for chunk in chunks)
+
+
+def test_parse_chunk_malformed_fastq():
+    with pytest.raises(ValueError, match="Malformed FASTQ"):
+        fastx.parse_chunk(b"@read1\nACGT\n+\nIIII\nACGT\n+\nIIII\n@read3\n")
+
+
+@pytest.mark.parametrize(
+    ("text", "format"),
+    [
+        (b"@read1\nACGT\n+\nIIII\n", "fastq"),
+        (b"\n\n@read1\nACGT\n+\nIIII\n", "fastq"),
+        (b">seq1\nACGT\n", "fasta"),
+        (b"; a comment before the first record\n>seq1\nACGT\n", "fasta"),
+        (b"", "fastq"),  # an empty file holds no record of either format
+    ],
+)
+@pytest.mark.parametrize("gzipped", [False, True], ids=["plain", "gzip"])
+def test_detect_format(tmp_path, text, format, gzipped):
+    filepath = _write(Path(tmp_path, "sequences"), text, gzipped, crlf=False, trailing_newline=True)
+    assert fastx.detect_format(filepath) == format
+
+
+def test_detect_format_neither(tmp_path):
+    filepath = Path(tmp_path, "notes.txt")
+    filepath.write_text("name,reference\nFicus_carica,false\n")
+    with pytest.raises(ValueError, match="neither a FASTQ nor a FASTA"):
+        fastx.detect_format(filepath)
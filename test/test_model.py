@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import polars as pl
+import pytest
+import xgboost as xgb
+
+from model import _Checkpoint, _record_label, load_model, model_labels, train_model, use_model, write_kmer_shards
+from raxtax import Raxtax
+
+LINEAGE = "phylum:Tracheophyta,class:Magnoliopsida,order:Rosales,family:{family},genus:{genus},species:{species}"
+SPECIES = {
+    "Ficus_religiosa": ("Moraceae", "Ficus"),
+    "Ficus_carica": ("Moraceae", "Ficus"),
+    "Tilia_cordata": ("Malvaceae", "Tilia"),
+}
+
+
+def _mutate(rng: np.random.Generator, sequence: str, rate: float = 0.02) -> str:
+    bases = np.array(list(sequence))
+    mutated = rng.random(len(bases)) < rate
+    bases[mutated] = rng.choice(list("ACGT"), mutated.sum())
+    return "".join(bases)
+
+
+@pytest.fixture(scope="module")
+def reference_fp(tmp_path_factory) -> Path:
+    """A raxtax database of a few noisy copies of a random sequence per species."""
+    rng = np.random.default_rng(0)
+    fasta_fp = Path(tmp_path_factory.mktemp("references"), "references.fasta")
+    with open(fasta_fp, "w") as file:
+        for i, (species, (family, genus)) in enumerate(SPECIES.items()):
+            sequence = "".join(rng.choice(list("ACGT"), 600))
+            tax = LINEAGE.format(family=family, genus=genus, species=species)
+            file.writelines(f">R{i}-{j}|MARKER_CODE=matK;tax={tax};\n{_mutate(rng, sequence)}\n" for j in range(8))
+    return fasta_fp
+
+
+@pytest.fixture(scope="module")
+def shard_fps(reference_fp, tmp_path_factory) -> list[Path]:
+    return write_kmer_shards(reference_fp, tmp_path_factory.mktemp("shards"), shard_rows=10)
+
+
+def test_use_model_fills_the_lineage(reference_fp, shard_fps, tmp_path):
+    model_fp = Path(tmp_path, "species.ubj")
+    train_model(shard_fps, model_fp, rounds=5, max_depth=3).unwrap()
+
+    df = use_model(model_fp, reference_fp).unwrap().df
+    assert df.columns == Raxtax.get_row_schema()
+    assert df.height == 8 * len(SPECIES)
+    for row in df.iter_rows(named=True):
+        family, genus = SPECIES[row["species"]]
+        assert (row["phylum"], row["family"], row["genus"]) == ("Tracheophyta", family, genus)
+        # A higher rank sums the probabilities of its classes, like raxtax its scores never decrease going up
+        assert row["species_score"] <= row["genus_score"] <= row["family_score"] <= row["phylum_score"] + 1e-6
+
+
+def test_use_model_genus(reference_fp, shard_fps, tmp_path):
+    model_fp = Path(tmp_path, "genus.ubj")
+    train_model(shard_fps, model_fp, rank="genus", rounds=5, max_depth=3).unwrap()
+
+    raxtax = use_model(model_fp, reference_fp).unwrap()
+    assert raxtax.df.get_column("species").is_null().all()
+    assert raxtax.df.get_column("family").is_not_null().all()
+    assert raxtax.top_match()[0] in {"Ficus", "Tilia"}
+
+
+def test_use_model_shares_an_unmodified_booster(reference_fp, shard_fps, tmp_path):
+    model_fp = Path(tmp_path, "species.ubj")
+    train_model(shard_fps, model_fp, rounds=5, max_depth=3).unwrap()
+
+    assert load_model(model_fp, threads=1) is load_model(model_fp, threads=1)
+    expected = use_model(model_fp, reference_fp, threads=1).unwrap().df
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(lambda threads: use_model(model_fp, reference_fp, threads), [1, 2, 1, 2]))
+    for result in results:
+        assert result.unwrap().df.equals(expected)
+
+
+@pytest.mark.parametrize(
+    ("header", "label"),
+    [
+        (
+            f"R1|MARKER_CODE=matK;tax={LINEAGE.format(family='Moraceae', genus='Ficus', species='Ficus_carica')};",
+            "Ficus_carica",
+        ),
+        ("R1|MARKER_CODE=matK;tax=phylum:Tracheophyta,genus:Ficus,;", None),  # no species
+        ("R1|MARKER_CODE=matK;tax=phylum:Tracheophyta,species:;", None),
+        ("BOLD1 Ficus_carica matK", "Ficus_carica"),
+        ("BOLD1", None),  # no second word
+        ("", None),
+    ],
+)
+def test_record_label(header, label):
+    assert _record_label(header) == label
+
+
+def test_write_kmer_shards_drops_unlabelled_records(reference_fp, tmp_path):
+    fasta_fp = Path(tmp_path, "references.fasta")
+    fasta_fp.write_text(
+        reference_fp.read_text()
+        + ">R9|MARKER_CODE=matK;tax=phylum:Tracheophyta,genus:Ficus,;\nACGTACGT\n>BOLD9\nACGT\n"
+    )
+    shard_fps = write_kmer_shards(fasta_fp, Path(tmp_path, "shards"), shard_rows=10)
+    species = pl.read_parquet(shard_fps).get_column("species")
+    assert species.len() == 8 * len(SPECIES) and species.is_not_null().all()
+
+
+def test_train_model_checkpoints_and_resumes(shard_fps, tmp_path):
+    model_fp = Path(tmp_path, "species.ubj")
+    checkpoints: list[tuple[int, int]] = []
+
+    def on_round(boosted: int, rows_per_s: float):
+        # The model file as saved by the last checkpoint before this round
+        saved = xgb.Booster(model_file=model_fp).num_boosted_rounds() if model_fp.is_file() else 0
+        checkpoints.append((boosted, saved))
+
+    stats = train_model(shard_fps, model_fp, rounds=3, max_depth=2, checkpoint_every=2, on_round=on_round).unwrap()
+    assert stats.rounds == 3 and stats.rows == 8 * len(SPECIES)
+    assert checkpoints == [(1, 0), (2, 0), (3, 2)]
+    assert xgb.Booster(model_file=model_fp).num_boosted_rounds() == 3
+
+    # Resumed up to 5 rounds, the rounds are numbered on from the saved model
+    checkpoints.clear()
+    stats = train_model(
+        shard_fps, model_fp, rounds=5, max_depth=2, checkpoint_every=2, resume=True, on_round=on_round
+    ).unwrap()
+    assert stats.rounds == 2
+    assert checkpoints == [(4, 3), (5, 4)]
+    booster = xgb.Booster(model_file=model_fp)
+    assert booster.num_boosted_rounds() == 5
+    assert model_labels(booster) == (sorted(SPECIES), "species", 5)
+    assert list(tmp_path.iterdir()) == [model_fp]  # no partial checkpoint left behind
+
+    # Shards of other labels can't resume it, the model is left untouched
+    ficus_fp = Path(tmp_path, "ficus.parquet")
+    pl.read_parquet(shard_fps).filter(pl.col("species") != "Tilia_cordata").write_parquet(ficus_fp)
+    assert train_model([ficus_fp], model_fp, rounds=6, resume=True).is_err()
+    assert train_model(shard_fps, model_fp, rank="genus", rounds=6, resume=True).is_err()
+    assert xgb.Booster(model_file=model_fp).num_boosted_rounds() == 5
+
+
+def test_checkpoint_save(tmp_path):
+    model_fp = Path(tmp_path, "model.ubj")
+    booster = xgb.train({"objective": "reg:squarederror"}, xgb.DMatrix(np.eye(4), label=np.arange(4)), 2)
+    _Checkpoint(model_fp, {"labels": "[]", "rank": "genus"}, interval=0, rows=4, on_round=None).save(booster)
+
+    saved = xgb.Booster(model_file=model_fp)
+    assert (saved.attr("labels"), saved.attr("rank"), saved.num_boosted_rounds()) == ("[]", "genus", 2)
+    assert list(tmp_path.iterdir()) == [model_fp]
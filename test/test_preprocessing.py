@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import fastx
+from preprocessing import filter_reads
+
+
+def _record(name: str, quality: str) -> str:
+    return f"@{name}\n{'A' * len(quality)}\n+\n{quality}\n"
+
+
+# Mean qualities by hand, in the error probability space like seqkit: -10 * log10(mean(10^(-q/10)))
+READS = {
+    "q40": "I" * 200,  # 40
+    "short": "I" * 100,  # 40, too short
+    "mixed": "I" * 100 + "!" * 100,  # -10 * log10((100 * 1e-4 + 100 * 1) / 200) = 3.01, not 20
+    "q20": "5" * 200,  # 20
+    "q93": "~" * 200,  # 93, over the maximum
+    "empty": "",  # 0
+    "last": "5" * 150,  # 20
+}
+
+
+def test_mean_qualities():
+    qualities = [quality.encode() for quality in READS.values()]
+    expected = [40, 40, -10 * np.log10((100 * 1e-4 + 100) / 200), 20, 93, 0, 20]
+    np.testing.assert_allclose(fastx.mean_qualities(qualities), expected)
+
+
+def test_mean_qualities_trailing_empty_read():
+    batch = fastx.parse_chunk(b"@r1\nACGT\n+\nIIII\n@r2\nAC\n+\nII\n@r3\n\n+\n\n")
+    np.testing.assert_allclose(batch.mean_qualities(), [40, 40, 0])
+
+
+@pytest.mark.parametrize(
+    ("min_len", "min_qual", "max_qual", "expected"),
+    [
+        (150, 10, 60, ["q40", "q20", "last"]),  # seqkit seq -m 150 -Q 10 -R 60
+        (150, 30, 60, ["q40"]),
+        (0, 0, 0, list(READS)),  # every limit disabled, the empty read is kept too
+        (0, 10, 0, ["q40", "short", "q20", "q93", "last"]),  # the empty read has a mean quality of 0
+        (0, 0, 30, ["mixed", "q20", "empty", "last"]),
+        (0, 0, 40, ["mixed", "q20", "empty", "last"]),  # the maximum is exclusive
+    ],
+)
+def test_filter_reads(tmp_path, min_len, min_qual, max_qual, expected):
+    input_fp, output_fp = Path(tmp_path, "reads.fastq"), Path(tmp_path, "filtered.fastq")
+    input_fp.write_text("".join(_record(name, quality) for name, quality in READS.items()))
+
+    stats = filter_reads(input_fp, output_fp, min_len, min_qual, max_qual, threshold=0).unwrap()
+    assert (stats.n_reads, stats.n_passed) == (len(READS), len(expected))
+    assert [name.decode() for batch in fastx.read_batches(output_fp) for name in batch.names] == expected
+
+
+def test_filter_reads_too_few_reads(tmp_path):
+    input_fp, output_fp = Path(tmp_path, "reads.fastq"), Path(tmp_path, "filtered.fastq")
+    input_fp.write_text(_record("q40", READS["q40"]))
+    assert filter_reads(input_fp, output_fp, threshold=10).is_err()
+    assert not output_fp.exists()
@@ -0,0 +1,129 @@
+import os
+from pathlib import Path
+
+import polars as pl
+import pytest
+
+import registry
+import utils
+from registry import _apply_manifest, load_registry, select_samples, update_registry
+
+
+def _write_fastq(filepath: Path, lengths: list[int]):
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    filepath.write_text("".join(f"@r{i}\n{'A' * length}\n+\n{'I' * length}\n" for i, length in enumerate(lengths)))
+
+
+@pytest.fixture
+def data_dir(tmp_path) -> Path:
+    data_dir = Path(tmp_path, "data")
+    _write_fastq(Path(data_dir, "Ficus_religiosa_ITS_barcode1", "Ficus_religiosa_ITS_barcode1.fastq"), [100, 200])
+    _write_fastq(Path(data_dir, "Tilia_cordata_matK_rbcL_barcode8", "Tilia_cordata_barcode8.fastq"), [300] * 3)
+    Path(data_dir, "Ficus_religiosa_ITS_barcode1", "Ficus_religiosa_reference_seq.fasta").write_text(">ref\nACGT\n")
+    Path(data_dir, "notes.txt").write_text("not a sample")
+    return data_dir
+
+
+@pytest.fixture
+def counted_stats(monkeypatch) -> list[Path]:
+    """The files whose statistics get computed."""
+    computed = []
+    file_stats = registry.file_stats
+
+    def counting_file_stats(filepath: Path):
+        computed.append(filepath)
+        return file_stats(filepath)
+
+    monkeypatch.setattr(registry, "file_stats", counting_file_stats)
+    return computed
+
+
+def test_update_registry(data_dir, counted_stats, tmp_path):
+    registry_fp = Path(tmp_path, "registry.parquet")
+    filepaths = registry.scan_directory(data_dir)
+    assert len(filepaths) == 3
+
+    df = update_registry(filepaths, registry_fp, max_workers=1)
+    assert df.columns == list(registry.REGISTRY_SCHEMA)
+    assert df.equals(load_registry(registry_fp))
+    assert len(counted_stats) == 3
+    ficus, reference, tilia = df.iter_rows(named=True)
+    assert (ficus["name"], ficus["reference"], ficus["ITS"], ficus["matK"]) == ("Ficus_religiosa", False, True, False)
+    assert (ficus["format"], ficus["reads"], ficus["bases"], ficus["n50"]) == ("fastq", 2, 300, 200)
+    assert ficus["mean_quality"] == pytest.approx(40)
+    assert reference["reference"] and reference["format"] == "fasta" and reference["mean_quality"] is None
+    assert (tilia["matK"], tilia["rbcL"], tilia["ITS"], tilia["reads"]) == (True, True, False, 3)
+
+    # Unchanged files keep their statistics and the registry isn't rewritten
+    mtime_ns = registry_fp.stat().st_mtime_ns
+    assert update_registry(filepaths, registry_fp, max_workers=1).equals(df)
+    assert len(counted_stats) == 3 and registry_fp.stat().st_mtime_ns == mtime_ns
+
+    # Only the modified file is read again, the deleted one is dropped
+    _write_fastq(filepaths[2], [300] * 5)
+    os.utime(filepaths[2], ns=(0, 10**9))
+    filepaths[1].unlink()
+    df = update_registry(registry.scan_directory(data_dir), registry_fp, max_workers=1)
+    assert counted_stats[3:] == [filepaths[2].resolve()]
+    assert df.get_column("reads").to_list() == [2, 5]
+
+
+def test_apply_manifest(data_dir, tmp_path, monkeypatch):
+    df = update_registry(registry.scan_directory(data_dir), Path(tmp_path, "registry.parquet"), max_workers=1)
+    monkeypatch.chdir(tmp_path)
+    manifest_fp = Path(tmp_path, "data.csv")
+    tilia_fp = "data/Tilia_cordata_matK_rbcL_barcode8/Tilia_cordata_barcode8.fastq"
+    manifest_fp.write_text(
+        "name,reference,matk,rbcL,psbA-trnH,ITS,filepath\n"
+        f"Tilia_platyphyllos,false,true,false,false,false,{tilia_fp}\n"
+        "Unknown_sample,false,false,false,false,true,data/missing.fastq\n"
+    )
+
+    updated = _apply_manifest(df, manifest_fp)
+    assert updated.height == df.height
+    tilia = updated.row(by_predicate=pl.col("filepath") == str(Path(tilia_fp).resolve()), named=True)
+    assert (tilia["name"], tilia["matK"], tilia["rbcL"], tilia["reads"]) == ("Tilia_platyphyllos", True, False, 3)
+    assert updated.filter(pl.col("filepath") != tilia["filepath"]).equals(
+        df.filter(pl.col("filepath") != tilia["filepath"])
+    )
+
+
+@pytest.mark.parametrize(
+    ("kwargs", "expected"),
+    [
+        ({}, ["Ficus_religiosa", "Tilia_cordata"]),
+        ({"references": True}, ["Ficus_religiosa"]),
+        ({"marker": "matk"}, ["Tilia_cordata"]),
+        ({"marker": "ITS", "species": "FICUS"}, ["Ficus_religiosa"]),
+        ({"species": "cord"}, ["Tilia_cordata"]),
+        ({"min_reads": 3}, ["Tilia_cordata"]),
+        ({"max_reads": 2}, ["Ficus_religiosa"]),
+        ({"min_reads": 3, "max_reads": 2}, []),
+    ],
+)
+def test_select_samples(data_dir, tmp_path, kwargs, expected):
+    df = update_registry(registry.scan_directory(data_dir), Path(tmp_path, "registry.parquet"), max_workers=1)
+    assert select_samples(df, **kwargs).get_column("name").to_list() == expected
+
+
+def test_select_samples_unknown_marker():
+    with pytest.raises(ValueError, match="Unknown marker"):
+        select_samples(load_registry(Path("missing.parquet")), marker="COI")
+
+
+def test_load_data_df_is_read_only(data_dir, counted_stats, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    Path("data.csv").write_text(
+        "name,reference,matk,rbcL,psbA-trnH,ITS,filepath\nAllium_Ursinum,false,false,false,false,true,a.fastq\n"
+    )
+    registry_fp = Path("data", "registry.parquet")
+
+    # The marker columns of `data.csv` are named like the registry ones
+    assert utils.load_data_df(registry_fp).columns == list(registry.REGISTRY_SCHEMA)[:7]
+    assert not registry_fp.exists()
+
+    df = update_registry(registry.scan_directory(data_dir), registry_fp, max_workers=1)
+    _write_fastq(Path(data_dir, "Allium_ursinum_ITS_barcode2", "Allium_ursinum_ITS_barcode2.fastq"), [100])
+    mtime_ns = registry_fp.stat().st_mtime_ns
+    assert utils.load_data_df(registry_fp).equals(df)
+    assert len(counted_stats) == 3 and registry_fp.stat().st_mtime_ns == mtime_ns
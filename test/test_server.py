@@ -0,0 +1,128 @@
+import asyncio
+import json
+import os
+import tempfile
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pytest
+from safe_result import Err
+
+import server
+from pipeline import PipelineOptions
+from server import PipelineServer, _worker_pool
+
+
+def _dechunk(body: bytes) -> bytes:
+    """Decodes a chunked transfer encoding body, checking its framing."""
+    data = b""
+    while True:
+        size_line, _, body = body.partition(b"\r\n")
+        size = int(size_line, 16)
+        chunk, body = body[:size], body[size:]
+        assert body.startswith(b"\r\n")
+        body = body[2:]
+        if size == 0:
+            assert body == b""
+            return data
+        data += chunk
+
+
+async def _request(pipeline_server: PipelineServer, request: bytes) -> tuple[str, list[dict]]:
+    listener = await asyncio.start_server(pipeline_server.handle, "127.0.0.1", 0)
+    async with listener:
+        port = listener.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request)
+        await writer.drain()
+        response = await reader.read()
+        writer.close()
+
+    head, _, body = response.partition(b"\r\n\r\n")
+    assert b"Transfer-Encoding: chunked" in head
+    events = [json.loads(line) for line in _dechunk(body).decode().splitlines()]
+    return head.split(b"\r\n")[0].decode(), events
+
+
+def _post(body: bytes, content_type: str = "application/json") -> bytes:
+    return f"POST /run HTTP/1.1\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+
+
+@pytest.fixture
+def pipeline_server() -> PipelineServer:
+    return PipelineServer(PipelineOptions(threads=1))
+
+
+def test_health(pipeline_server):
+    status, events = asyncio.run(_request(pipeline_server, b"GET /health HTTP/1.1\r\n\r\n"))
+    assert status == "HTTP/1.1 200 OK"
+    assert events[0]["status"] == "ok" and events[0]["served"] == 0
+
+
+@pytest.mark.parametrize(
+    ("request_bytes", "status"),
+    [
+        (b"GET /nothing HTTP/1.1\r\n\r\n", "HTTP/1.1 404 Not Found"),
+        (b"GET /run HTTP/1.1\r\n\r\n", "HTTP/1.1 405 Method Not Allowed"),
+        (b"POST /run HTTP/1.1\r\n\r\n", "HTTP/1.1 411 Length Required"),
+        (_post(b"[]"), "HTTP/1.1 400 Bad Request"),
+        (_post(b'{"filepath": 3}'), "HTTP/1.1 400 Bad Request"),
+        (_post(b"{not json"), "HTTP/1.1 400 Bad Request"),
+        (_post(b'{"filepath": "does_not_exist.fastq"}'), "HTTP/1.1 400 Bad Request"),
+    ],
+)
+def test_errors(pipeline_server, request_bytes, status):
+    response_status, events = asyncio.run(_request(pipeline_server, request_bytes))
+    assert response_status == status
+    assert len(events) == 1 and "error" in events[0]
+
+
+def test_error_after_the_response_started(pipeline_server, monkeypatch, tmp_path):
+    async def failing_run(input_fp: Path, sample: str, emit):
+        await emit({"event": "stage", "stage": "Pre-processing reads", "status": "started"})
+        raise ValueError("the upload went away")
+
+    monkeypatch.setattr(pipeline_server, "run", failing_run)
+    status, events = asyncio.run(_request(pipeline_server, _post(b"@r1\nACGT\n+\nIIII\n", "text/plain")))
+    assert status == "HTTP/1.1 200 OK"
+    assert [event["event"] for event in events] == ["stage", "error"]
+
+
+@pytest.mark.parametrize("sample", ["a/b", "../../escape", "x" * 300])
+def test_sample_names_stay_in_the_temporary_directory(pipeline_server, monkeypatch, tmp_path, sample):
+    work_dirs: list[Path] = []
+
+    async def recording_pipeline(input_fp: Path, work_dir: Path, *args, **kwargs):
+        work_dirs.append(work_dir)
+        return Err(ValueError("no reads"))
+
+    monkeypatch.setattr(server, "run_pipeline", recording_pipeline)
+    request = b"POST /run HTTP/1.1\r\nX-Sample: %s\r\nContent-Length: 4\r\n\r\nACGT" % sample.encode()
+    status, events = asyncio.run(_request(pipeline_server, request))
+    assert status == "HTTP/1.1 200 OK"
+    assert events[-1] == events[-1] | {"event": "result", "sample": sample, "status": "failed"}
+    # A name too long for a filename fails the setup itself, still reported as a failed result
+    assert all(work_dir.parent == Path(tempfile.gettempdir()) for work_dir in work_dirs)
+
+
+def test_broken_pool_is_replaced(monkeypatch, tmp_path):
+    async def crashing_pipeline(input_fp: Path, work_dir: Path, options: PipelineOptions, *args, **kwargs):
+        # A worker dying the way a segfault or the OOM killer would end it
+        try:
+            await asyncio.wrap_future(options.executor.submit(os._exit, 1))
+        except BrokenProcessPool as error:
+            return Err(error)
+
+    monkeypatch.setattr(server, "run_pipeline", crashing_pipeline)
+    executor = _worker_pool(1)
+    pipeline_server = PipelineServer(PipelineOptions(threads=1, executor=executor))
+    events: list[dict] = []
+
+    async def emit(event: dict):
+        events.append(event)
+
+    asyncio.run(pipeline_server.run(tmp_path, "sample", emit))
+    assert events[-1]["status"] == "failed"
+    assert pipeline_server.options.executor is not executor
+    assert pipeline_server.options.executor.submit(abs, -1).result() == 1
+    pipeline_server.options.executor.shutdown()
@@ -0,0 +1,37 @@
+import asyncio
+import dataclasses
+import json
+from pathlib import Path
+
+import polars as pl
+
+import telemetry
+from telemetry import StageMetrics, Telemetry
+
+
+def test_schema_covers_the_metrics():
+    assert list(telemetry._SCHEMA) == [field.name for field in dataclasses.fields(StageMetrics)]
+
+
+def test_summary_without_records():
+    summary = Telemetry().summary()
+    assert summary.height == 0
+    assert summary.schema["wall_s"] == pl.Float64 and summary.schema["mib_in"] == pl.Float64
+
+
+def test_summary(tmp_path):
+    metrics_fp = Path(tmp_path, "metrics.jsonl")
+    recorder = Telemetry(metrics_fp)
+
+    async def run():
+        async with recorder.measure("sample", Path("reads.fastq"), "Pre-processing reads") as metrics:
+            metrics.reads_in, metrics.bytes_in = 10, 3 * 1024**2
+        async with recorder.measure("sample", Path("reads.fastq"), "Clustering") as metrics:
+            metrics.cached = True
+
+    asyncio.run(run())
+    summary = recorder.summary()
+    assert summary.get_column("stage").to_list() == ["Pre-processing reads", "Clustering"]
+    assert summary.get_column("reads_in").to_list() == [10, None]
+    assert summary.get_column("mib_in").to_list() == [3.0, None]
+    assert [json.loads(line)["stage"] for line in metrics_fp.read_text().splitlines()] == summary["stage"].to_list()
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from utils import canonical_kmer_codes, kmer_codes, reverse_complement
+
+
+def _canonical(sequence: str, k: int) -> list[int]:
+    """The canonical k-mer codes by hand, the windows with anything but ACGT skipped."""
+    encode = {"A": 0, "C": 1, "G": 2, "T": 3}
+    codes = []
+    for i in range(len(sequence) - k + 1):
+        kmer = sequence[i : i + k].upper()
+        if set(kmer) <= set(encode):
+            forward = int("".join(str(encode[base]) for base in kmer), 4)
+            reverse = int("".join(str(3 - encode[base]) for base in reversed(kmer)), 4)
+            codes.append(min(forward, reverse))
+    return codes
+
+
+@pytest.mark.parametrize("sequence", ["ACGTACGTAC", "ACGUACGUAC", "acgNNtgcaRYt", "GATTACA", "AC", ""])
+def test_canonical_kmer_codes(sequence):
+    assert canonical_kmer_codes(sequence, 3).tolist() == _canonical(sequence, 3)
+    assert canonical_kmer_codes(sequence.encode(), 3).tolist() == _canonical(sequence, 3)
+
+
+def test_canonical_kmer_codes_strand_independent():
+    rng = np.random.default_rng(0)
+    sequence = "".join(rng.choice(list("ACGTN"), 500, p=[0.24, 0.24, 0.24, 0.24, 0.04]))
+    forward = canonical_kmer_codes(sequence, 15)
+    assert np.array_equal(forward, canonical_kmer_codes(reverse_complement(sequence), 15)[::-1])
+    assert len(forward) == len(kmer_codes(sequence, 15))
@@ -0,0 +1,64 @@
+import gzip
+import os
+from pathlib import Path
+
+import fastx
+from pipeline import PipelineOptions
+from qc import QcReport
+from watch import StabilityTracker, append_filtered_reads, ready_files, run_finished
+
+
+def _record(name: str, length: int, quality: str = "I") -> str:
+    return f"@{name}\n{'A' * length}\n+\n{quality * length}\n"
+
+
+def test_stability_tracker_needs_consecutive_rounds():
+    tracker = StabilityTracker(rounds=3, tolerance=0.02)
+    assert not tracker.update("Ficus_religiosa", 0.90)
+    assert not tracker.update("Ficus_religiosa", 0.91)
+    assert tracker.update("Ficus_religiosa", 0.905)
+    assert tracker.update("Ficus_religiosa", 0.91)
+
+
+def test_stability_tracker_resets():
+    tracker = StabilityTracker(rounds=2, tolerance=0.02)
+    tracker.update("Ficus_religiosa", 0.9)
+    assert not tracker.update("Tilia_cordata", 0.9)  # another species starts a new streak
+    assert tracker.update("Tilia_cordata", 0.91)
+    assert not tracker.update(None, None)  # a failed round
+    assert not tracker.update("Tilia_cordata", 0.91)
+    assert not tracker.update("Tilia_cordata", 0.99)  # the score moved too much
+
+
+def test_ready_files(tmp_path):
+    passed, failed = Path(tmp_path, "fastq_pass"), Path(tmp_path, "fastq_fail")
+    passed.mkdir(), failed.mkdir()
+    old_fp, new_fp = Path(passed, "a.fastq.gz"), Path(passed, "b.fastq")
+    for fp in (old_fp, new_fp, Path(failed, "c.fastq"), Path(passed, "notes.txt")):
+        fp.write_text("")
+    os.utime(old_fp, (0, 0))
+
+    assert ready_files(tmp_path, set(), settle_s=60) == [old_fp]  # `b.fastq` may still be written
+    assert ready_files(tmp_path, set(), settle_s=0) == [old_fp, new_fp]
+    assert ready_files(tmp_path, {old_fp}, settle_s=0) == [new_fp]
+    assert not run_finished(tmp_path)
+    Path(tmp_path, "final_summary_FAX_1.txt").write_text("")
+    assert run_finished(tmp_path)
+
+
+def test_append_filtered_reads(tmp_path):
+    first_fp, second_fp = Path(tmp_path, "first.fastq"), Path(tmp_path, "second.fastq.gz")
+    first_fp.write_text(_record("r1", 200) + _record("short", 50) + _record("r2", 300))
+    with gzip.open(second_fp, "wt") as file:
+        file.write(_record("r3", 200) + _record("bad", 200, quality="#"))
+
+    reads_fp, report = Path(tmp_path, "work", "filtered_so_far.fastq"), QcReport()
+    reads_fp.parent.mkdir()
+    options = PipelineOptions(threads=1)
+    assert append_filtered_reads([first_fp], reads_fp, options, report) == (3, 2)
+    assert append_filtered_reads([second_fp], reads_fp, options, report) == (2, 1)
+
+    names = [name for batch in fastx.read_batches(reads_fp) for name in batch.names]
+    assert names == [b"r1", b"r2", b"r3"]
+    assert (report.raw.reads, report.filtered.reads) == (5, 3)
+    assert list(reads_fp.parent.iterdir()) == [reads_fp]